@@ -0,0 +1,126 @@
+"""
+Per-request cost of formatting data for the response, before and after
+tables were kept in served format (see `covidapi/tables.py`).
+
+Before, each request turned the DatetimeIndex of its slice into dates with a
+Python callback per row, then filled NaNs and cast to int. Now that's done
+once when data is loaded, so a request only slices and runs `to_dict`.
+
+Runs on a synthetic state table spanning several years, so it needs no
+network access.
+
+Usage
+-----
+`python benchmarks/formatting.py --years 5`
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Callable, Dict
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+from covidapi.tables import Table  # noqa: E402
+
+STATES = [f"State {i}" for i in range(16)]
+COLUMNS = [f"col_{i}" for i in range(12)]
+
+
+def make_state_table(years: int) -> pd.DataFrame:
+    """State table with one row per state per day, and some NaNs"""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-01-25", periods=365 * years, freq="D", name="date")
+    index = dates.repeat(len(STATES))
+    values = rng.integers(0, 10000, size=(len(index), len(COLUMNS))).astype(float)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    df = pd.DataFrame(values, index=index, columns=COLUMNS)
+    df.insert(0, "state", np.tile(STATES, len(dates)))
+    return df
+
+
+def before(df: pd.DataFrame, state: str, start_date, end_date) -> Dict[str, float]:
+    """Per-request path as it was, timing each step"""
+    start = timer()
+    ans = df[df["state"] == state].loc[start_date:end_date].drop(columns="state")
+    select = timer() - start
+
+    start = timer()
+    ans.index = ans.index.map(lambda x: x.date())
+    ans = ans.fillna(value=-9999)
+    ans = ans.astype(int, errors="ignore")
+    formatting = timer() - start
+
+    start = timer()
+    ans.to_dict(orient="index")
+    to_dict = timer() - start
+    return {"select": select, "formatting": formatting, "to_dict": to_dict}
+
+
+def after(table: Table, state: str, start_date, end_date) -> Dict[str, float]:
+    """Per-request path now, with nothing left to format"""
+    start = timer()
+    ans = table.select(start_date, end_date, state=state)
+    select = timer() - start
+
+    start = timer()
+    ans.to_dict(orient="index")
+    to_dict = timer() - start
+    return {"select": select, "to_dict": to_dict}
+
+
+def best_of(fn: Callable, repeat: int, *args) -> Dict[str, float]:
+    """Fastest of `repeat` runs, for the whole call and for each step"""
+    best = {}
+    for _ in range(repeat):
+        start = timer()
+        stages = fn(*args)
+        stages["total"] = timer() - start
+        for stage, elapsed in stages.items():
+            best[stage] = min(best.get(stage, float("inf")), elapsed)
+    return best
+
+
+def main(years: int, repeat: int):
+    df = make_state_table(years)
+
+    start = timer()
+    table = Table(df)
+    print(
+        f"{len(df):,} rows, {years} years of data. "
+        f"Converted to served format once in {(timer() - start) * 1000:.1f} ms\n"
+    )
+
+    start_date = df.index[0].date()
+    print(
+        f"{'range':>10} | {'before ms':>9} {'select':>7} {'format':>7} "
+        f"{'to_dict':>7} | {'after ms':>9} {'select':>7} {'to_dict':>7}"
+    )
+    for days in [5, 30, 365] + [365 * i for i in range(2, years + 1)]:
+        end_date = start_date + pd.Timedelta(days=days - 1)
+        old = best_of(before, repeat, df, STATES[0], start_date, end_date)
+        new = best_of(after, repeat, table, STATES[0], start_date, end_date)
+        print(
+            f"{days:>9}d | {old['total'] * 1000:>9.2f} "
+            f"{old['select'] * 1000:>7.2f} {old['formatting'] * 1000:>7.2f} "
+            f"{old['to_dict'] * 1000:>7.2f} | {new['total'] * 1000:>9.2f} "
+            f"{new['select'] * 1000:>7.2f} {new['to_dict'] * 1000:>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark per-request response formatting, before and after"
+    )
+    parser.add_argument(
+        "--years", type=int, default=5, help="Years of synthetic data to generate"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Runs per range, fastest is kept"
+    )
+    args = parser.parse_args()
+
+    main(args.years, args.repeat)
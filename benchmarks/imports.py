@@ -0,0 +1,103 @@
+"""
+Import-time profile of the API, from `python -X importtime`.
+
+Imports the app the way uvicorn does, serving the bundled fixture data with
+warm-up and prefetching off, so only module imports and opening the data
+source are timed. Prints the slowest imports made by the app by cumulative
+time, and whether modules only some requests or sources need were left
+unimported. `--output` keeps the raw profile, e.g. to view with `tuna`.
+
+Usage
+-----
+`python benchmarks/imports.py --top 15`
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Tuple
+
+APP_DIR = Path(__file__).parents[1] / "gcp-app-engine"
+FIXTURE_DIR = Path(__file__).parents[1] / "fixtures" / "data"
+
+# Imported on demand, by the git data source and GitHub lookups
+DEFERRED = ["git", "requests"]
+
+
+def profile_imports() -> str:
+    """Raw `-X importtime` output from importing the app"""
+    env = dict(
+        os.environ,
+        DATA_SOURCE=f"local:{FIXTURE_DIR}",
+        DATA_PREFETCH="0",
+        WARMUP_ENDPOINTS="",
+        ACCESS_LOG_SAMPLE_RATE="0",
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import importlib; importlib.import_module('gcp-main')",
+        ],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stderr
+
+
+def parse(profile: str) -> List[Tuple[int, str, int, int]]:
+    """(depth, module, self us, cumulative us) for each line of a profile"""
+    ans = []
+    for line in profile.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        ans.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return ans
+
+
+def main(top: int, output: Path):
+    profile = profile_imports()
+    if output is not None:
+        output.write_text(profile)
+        print(f"Wrote profile to {output}\n")
+
+    imports = parse(profile)
+    # Python's own startup imports come first, ending with site
+    startup = [i for i, j in enumerate(imports) if j[:2] == (0, "site")][-1]
+    app_imports = sorted(
+        [i for i in imports[startup + 1 :] if i[0] == 0],
+        key=lambda x: x[3],
+        reverse=True,
+    )
+
+    total = sum(i[3] for i in app_imports)
+    print(f"{'module':<30} {'cumulative ms':>14} {'self ms':>10}")
+    for _, name, self_us, cumulative_us in app_imports[:top]:
+        print(f"{name:<30} {cumulative_us / 1000:>14.1f} {self_us / 1000:>10.1f}")
+    print(f"{'total':<30} {total / 1000:>14.1f}\n")
+
+    imported = {i[1] for i in imports}
+    for name in DEFERRED:
+        print(f"{name}: {'imported' if name in imported else 'not imported'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile importing the API")
+    parser.add_argument(
+        "--top", type=int, default=15, help="Number of slowest imports to show"
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="File to write the raw profile to"
+    )
+    args = parser.parse_args()
+
+    main(args.top, args.output)
@@ -0,0 +1,74 @@
+"""
+Peak memory and time of building the deaths cube from a linelist in chunks
+(see `covidapi/linelist.py`), against reading the whole linelist at once.
+
+The linelist is the fixture's, repeated to about the size of the MoH one.
+Peak memory is what `tracemalloc` sees allocated, which covers pandas and
+numpy arrays.
+
+Usage
+-----
+`python benchmarks/linelist.py --repeat 400`
+"""
+
+import argparse
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from timeit import default_timer as timer
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+from covidapi import linelist  # noqa: E402
+
+LINELIST_FP = (
+    Path(__file__).parents[1] / "fixtures" / "linelist" / "linelist_deaths.csv"
+)
+
+
+def measure(fn):
+    """(seconds, peak MB) taken by `fn()`"""
+    tracemalloc.start()
+    start = timer()
+    fn()
+    elapsed = timer() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1e6
+
+
+def main(repeat: int, chunksize: int):
+    header, *rows = LINELIST_FP.read_text().splitlines(keepends=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fp = Path(tmpdir) / LINELIST_FP.name
+        with open(fp, "w") as f:
+            f.write(header)
+            for _ in range(repeat):
+                f.writelines(rows)
+        print(
+            f"{len(rows) * repeat:,} rows, {fp.stat().st_size / 1e6:.0f}MB on disk, "
+            f"chunks of {chunksize:,}\n"
+        )
+
+        print(f"{'':<20} {'seconds':>8} {'peak MB':>8}")
+        for name, fn in [
+            ("read whole", lambda: pd.read_csv(fp)),
+            ("build cube", lambda: linelist.build_cube(fp, chunksize)),
+        ]:
+            elapsed, peak = measure(fn)
+            print(f"{name:<20} {elapsed:>8.2f} {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark building the deaths cube from a linelist"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=400, help="Copies of the fixture linelist"
+    )
+    parser.add_argument("--chunksize", type=int, default=linelist.CHUNKSIZE)
+    args = parser.parse_args()
+
+    main(args.repeat, args.chunksize)
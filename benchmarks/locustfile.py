@@ -0,0 +1,88 @@
+"""
+Load test harness for the API.
+
+Usage
+-----
+`locust -f benchmarks/locustfile.py --host http://localhost:8000`
+
+By default simulates a mix of summary, detailed and ascii queries. Set
+`REPLAY_LOG` to a captured access log (e.g. `requests.jsonl`) to replay real
+traffic instead, see `benchmarks/replay.py`.
+"""
+
+import itertools
+import os
+import random
+import sys
+import threading
+from pathlib import Path
+
+from locust import HttpUser, constant, task
+
+sys.path.insert(0, str(Path(__file__).parent))
+from replay import load_requests  # noqa: E402
+
+STATES = [
+    "johor",
+    "kedah",
+    "kelantan",
+    "melaka",
+    "negerisembilan",
+    "pahang",
+    "perak",
+    "perlis",
+    "penang",
+    "sabah",
+    "sarawak",
+    "selangor",
+    "terengganu",
+    "kl",
+    "labuan",
+    "putrajaya",
+]
+
+REPLAY_LOG = os.environ.get("REPLAY_LOG")
+
+if REPLAY_LOG is not None:
+    # All simulated users walk through the log together, in logged order
+    replay_urls = itertools.cycle(load_requests(REPLAY_LOG))
+    replay_lock = threading.Lock()
+
+    class ReplayUser(HttpUser):
+        wait_time = constant(0)
+
+        @task
+        def replay(self):
+            with replay_lock:
+                url = next(replay_urls)
+            # Group stats per endpoint rather than per unique URL
+            self.client.get(url, name=url.split("?", 1)[0])
+
+else:
+
+    class MixUser(HttpUser):
+        wait_time = constant(0)
+
+        @task(6)
+        def summary_national(self):
+            self.client.get("/")
+
+        @task(3)
+        def summary_state(self):
+            self.client.get(f"/?state={random.choice(STATES)}", name="/?state=X")
+
+        @task(1)
+        def summary_allstates(self):
+            self.client.get("/?state=allstates")
+
+        @task(2)
+        def detailed_national(self):
+            self.client.get("/detailed")
+
+        @task(1)
+        def detailed_allstates(self):
+            self.client.get("/detailed?state=allstates")
+
+        @task(2)
+        def ascii(self):
+            self.client.get("/ascii")
@@ -0,0 +1,83 @@
+"""
+Memory held by the loaded data, against the memory of an App Engine F1
+instance (see `gcp-app-engine/app.yaml`).
+
+Loads everything a `Dataset` serves from a data source, the bundled fixture
+data by default, and reports the deep memory of each table served by
+`/detailed`, raw and served format together. Tables kept compact (see
+`covidapi/dataset.py`) are also measured as they would be without
+compaction. Peak RSS of the whole process, interpreter and imports
+included, is checked against the F1 limit.
+
+The fixture covers three months, generate a few years of it to see what the
+live data takes:
+
+`python fixtures/make_fixture.py --start-date 2020-01-25 --end-date 2022-12-31 --outdir /tmp/big --linelist-dir /tmp/big-linelist`
+
+Usage
+-----
+`python benchmarks/memory.py --data-source local:/tmp/big`
+"""
+
+import argparse
+import resource
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+from covidapi import sources  # noqa: E402
+from covidapi.aggregation import widen  # noqa: E402
+from covidapi.dataset import COMPACT, Dataset  # noqa: E402
+from covidapi.tables import Table  # noqa: E402
+
+FIXTURE_DIR = Path(__file__).parents[1] / "fixtures" / "data"
+
+# Memory of an F1 instance, the app and everything it loads has to fit
+F1_MB = 384
+
+
+def table_mb(table: Table) -> float:
+    """Deep memory of the raw and served formats of `table`, in MB"""
+    return (
+        table.raw.memory_usage(deep=True).sum()
+        + table.served.memory_usage(deep=True).sum()
+    ) / 1e6
+
+
+def main(spec: str):
+    loaded = Dataset(sources.from_spec(spec))
+    loaded.prefetch()
+
+    print(f"Loaded {spec}\n")
+    print(f"{'table':<25} {'rows':>8} {'MB':>8} {'uncompacted MB':>15}")
+    total = 0.0
+    for tables in [loaded.detailed_malaysia, loaded.detailed_state]:
+        for name, table in tables.items():
+            mb = table_mb(table)
+            total += mb
+            uncompacted = ""
+            if name in COMPACT:
+                uncompacted = f"{table_mb(Table(widen(loaded.frame(name)))):.2f}"
+            print(f"{name:<25} {len(table.raw):>8,} {mb:>8.2f} {uncompacted:>15}")
+    print(f"{'total':<25} {'':>8} {total:>8.2f}\n")
+
+    # ru_maxrss is in KB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    print(f"Peak RSS {rss:.0f}MB of {F1_MB}MB on an F1 instance")
+    if rss > F1_MB:
+        sys.exit("Over the F1 memory budget")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report memory held by the loaded data"
+    )
+    parser.add_argument(
+        "--data-source",
+        type=str,
+        default=f"local:{FIXTURE_DIR}",
+        help="Data source spec, see covidapi/sources.py",
+    )
+    args = parser.parse_args()
+
+    main(args.data_source)
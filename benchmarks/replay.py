@@ -0,0 +1,120 @@
+"""
+Replay captured access logs against the API.
+
+Access logs are written by `covidapi/accesslog.py` as one JSON object per
+line (see `ACCESS_LOG_PATH`). Replaying them benchmarks the API against the
+traffic it actually gets instead of a made-up mix.
+
+Usage
+-----
+In-process, reporting latency percentiles per endpoint:
+`python benchmarks/replay.py requests.jsonl`
+
+In-process runs serve the bundled fixture data unless `--data-source` says
+otherwise (see `covidapi/sources.py`), so they need no network. Dates in the
+log may need to fall within the fixture's range to return any data.
+
+Against a running server, through the locust harness:
+`REPLAY_LOG=requests.jsonl locust -f benchmarks/locustfile.py --host http://localhost:8000`
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Dict, List
+from urllib.parse import urlencode
+
+FIXTURE_DIR = Path(__file__).parents[1] / "fixtures" / "data"
+
+# Not worth replaying, they don't reflect what clients ask for
+SKIPPED_PREFIXES = ("/metrics", "/debug", "/docs", "/openapi.json")
+
+
+def load_requests(path: str, include_errors: bool = False) -> List[str]:
+    """
+    Read an access log and return the GET requests in it as URLs relative
+    to the API root e.g. "/detailed?state=kl", in the order they were logged.
+    """
+    urls = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            record = json.loads(line)
+            # Events logged alongside requests
+            if "path" not in record:
+                continue
+            if record.get("method", "GET") != "GET":
+                continue
+            if record["path"].startswith(SKIPPED_PREFIXES):
+                continue
+            if not include_errors and record.get("status", 200) >= 400:
+                continue
+
+            url = record["path"]
+            if record.get("query"):
+                url += "?" + urlencode(record["query"])
+            urls.append(url)
+
+    return urls
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def main(path: str, repeat: int, data_source: str):
+    urls = load_requests(path)
+    print(f"Replaying {len(urls)} requests from {path}, {repeat} time(s)")
+
+    os.environ["DATA_SOURCE"] = data_source
+    sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+    from fastapi.testclient import TestClient
+
+    app = importlib.import_module("gcp-main").app
+    client = TestClient(app)
+
+    latencies: Dict[str, List[float]] = {}
+    for _ in range(repeat):
+        for url in urls:
+            start = timer()
+            response = client.get(url)
+            elapsed = timer() - start
+            assert response.status_code < 500, f"{url} returned {response.status_code}"
+            endpoint = url.split("?", 1)[0]
+            latencies.setdefault(endpoint, []).append(elapsed)
+
+    print(f"{'endpoint':<12} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        print(
+            f"{endpoint:<12} {len(values):>7} "
+            + " ".join(
+                f"{percentile(values, q) * 1000:>9.2f}" for q in (0.5, 0.95, 0.99)
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a captured access log against the API in-process"
+    )
+    parser.add_argument("logfile", type=str, help="Access log e.g. requests.jsonl")
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of times to replay the log"
+    )
+    parser.add_argument(
+        "--data-source",
+        type=str,
+        default=f"local:{FIXTURE_DIR}",
+        help="Data source to serve, defaults to the bundled fixture data",
+    )
+    args = parser.parse_args()
+
+    main(args.logfile, args.repeat, args.data_source)
@@ -0,0 +1,78 @@
+"""
+Startup cost of loading data from each kind of source (see
+`covidapi/sources.py`), offline against the bundled fixture data.
+
+Compares reading the fixture CSVs (`LocalSource`, what App Engine does with
+the bucket, minus the network) with reading a snapshot of them
+(`SnapshotSource`). Time spent reading tables is reported apart from the
+time until the national summary served by `/` is ready, which only reads the
+tables it needs (`Dataset` loads tables on demand), and the total time to
+read and prepare everything (`Dataset.prefetch`).
+
+Usage
+-----
+`python benchmarks/startup.py --repeat 5`
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from timeit import default_timer as timer
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+from covidapi import sources  # noqa: E402
+from covidapi.dataset import Dataset  # noqa: E402
+
+FIXTURE_DIR = Path(__file__).parents[1] / "fixtures" / "data"
+
+
+def main(data_dir: Path, repeat: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshot_fp = Path(tmpdir) / "snapshot.pkl"
+        loaded = Dataset(sources.LocalSource(data_dir))
+        sources.write_snapshot(
+            snapshot_fp, loaded.tables, loaded.pushed_at, loaded.file_hashes
+        )
+
+        print(f"Loading {data_dir}, fastest of {repeat} runs\n")
+        print(f"{'source':<10} {'read ms':>10} {'first / ms':>10} {'total ms':>10}")
+        for spec in [f"local:{data_dir}", f"snapshot:{snapshot_fp}"]:
+            read = first = total = float("inf")
+            for _ in range(repeat):
+                start = timer()
+                source = sources.from_spec(spec)
+                for name in sources.FILES:
+                    source.read(name)
+                read = min(read, timer() - start)
+
+                start = timer()
+                loaded = Dataset(sources.from_spec(spec))
+                loaded.summary_malaysia
+                first = min(first, timer() - start)
+                loaded.prefetch()
+                total = min(total, timer() - start)
+
+            kind = spec.split(":", 1)[0]
+            print(
+                f"{kind:<10} {read * 1000:>10.1f} {first * 1000:>10.1f}"
+                f" {total * 1000:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading data from each kind of source"
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=FIXTURE_DIR,
+        help="Directory laid out like the data bucket, defaults to the fixture",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per source, fastest is kept"
+    )
+    args = parser.parse_args()
+
+    main(args.data_dir, args.repeat)
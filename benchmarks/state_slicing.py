@@ -0,0 +1,57 @@
+"""
+Cost of picking one state's rows for a date range out of a state table,
+before and after tables kept per-state row offsets (see
+`covidapi/tables.py`).
+
+Before, each request compared every row's state name to build a boolean
+mask, copied the matching rows, then sliced them by date. Now it's two
+`searchsorted` calls on the state's dates and a slice.
+
+Usage
+-----
+`python benchmarks/state_slicing.py --years 5`
+"""
+
+import argparse
+import datetime
+from timeit import default_timer as timer
+
+from formatting import STATES, Table, make_state_table
+
+
+def main(years: int, repeat: int):
+    df = make_state_table(years).sort_index(kind="stable")
+    table = Table(df)
+    print(f"{len(df):,} rows, {years} years of data\n")
+
+    start_date = df.index[0].date()
+    print(f"{'range':>10} {'mask ms':>10} {'offsets ms':>11}")
+    for days in [5, 30, 365, 365 * years]:
+        end_date = start_date + datetime.timedelta(days=days - 1)
+
+        before = after = float("inf")
+        for _ in range(repeat):
+            start = timer()
+            df[df["state"] == STATES[-1]].loc[start_date:end_date]
+            before = min(before, timer() - start)
+
+            start = timer()
+            table.raw.iloc[table.rows(start_date, end_date, STATES[-1])]
+            after = min(after, timer() - start)
+
+        print(f"{days:>9}d {before * 1000:>10.3f} {after * 1000:>11.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark picking a state's rows for a date range"
+    )
+    parser.add_argument(
+        "--years", type=int, default=5, help="Years of synthetic data to generate"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=50, help="Runs per range, fastest is kept"
+    )
+    args = parser.parse_args()
+
+    main(args.years, args.repeat)
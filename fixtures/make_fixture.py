@@ -0,0 +1,334 @@
+"""
+Generate the fixture dataset in `fixtures/data`.
+
+Synthetic data laid out like the data bucket: the same files, columns and
+quirks as the MOH and CITF repos (tests and vaccinations lagging behind
+cases, a state missing from the ICU data), with made-up numbers. Lets the
+API be tested and benchmarked offline with `DATA_SOURCE=local:fixtures/data`.
+
+Also writes a deaths linelist to `fixtures/linelist`, as found in the MOH
+repo, and the cube the refresh function would build from it to the dataset.
+
+Output is deterministic, rerun this after changing it instead of editing the
+CSVs by hand.
+
+Usage
+-----
+`python fixtures/make_fixture.py`
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "gcp-app-engine"))
+from covidapi import linelist, sources  # noqa: E402
+
+STATES = [
+    "Johor",
+    "Kedah",
+    "Kelantan",
+    "Melaka",
+    "Negeri Sembilan",
+    "Pahang",
+    "Perak",
+    "Perlis",
+    "Pulau Pinang",
+    "Sabah",
+    "Sarawak",
+    "Selangor",
+    "Terengganu",
+    "W.P. Kuala Lumpur",
+    "W.P. Labuan",
+    "W.P. Putrajaya",
+]
+PUSHED_AT = "2021-09-30T10:00:00+00:00"
+
+
+def make_linelist(rng: np.random.Generator, dates: pd.DatetimeIndex) -> pd.DataFrame:
+    """A few deaths a day in each state, with ages and doses made up"""
+    deaths = rng.integers(0, 4, (len(dates), len(STATES)))
+    date = np.repeat(np.tile(dates.values, len(STATES)), deaths.T.ravel())
+    n = len(date)
+    df = pd.DataFrame(
+        {
+            "date": date,
+            "date_announced": date + np.timedelta64(1, "D"),
+            "date_positive": date - rng.integers(3, 21, n).astype("timedelta64[D]"),
+        }
+    )
+
+    # First doses up to ten months before testing positive, later doses after
+    # the one before, if any
+    df["date_dose1"] = df["date_positive"] - pd.to_timedelta(
+        rng.integers(-10, 300, n), unit="D"
+    )
+    for i, (low, high) in [(2, (21, 60)), (3, (90, 180))]:
+        df[f"date_dose{i}"] = df[f"date_dose{i - 1}"] + pd.to_timedelta(
+            rng.integers(low, high, n), unit="D"
+        )
+    for i in [1, 2, 3]:
+        df[f"date_dose{i}"] = df[f"date_dose{i}"].where(rng.random(n) < 0.7)
+        if i > 1:
+            df[f"date_dose{i}"] = df[f"date_dose{i}"].where(
+                df[f"date_dose{i - 1}"].notna()
+            )
+    for i in [1, 2, 3]:
+        df[f"brand{i}"] = np.where(df[f"date_dose{i}"].notna(), "Pfizer", "")
+
+    df["state"] = np.repeat(np.repeat(STATES, len(dates)), deaths.T.ravel())
+    df["age"] = rng.integers(0, 100, n).astype(float)
+    df.loc[rng.random(n) < 0.01, "age"] = np.nan
+    df["age"] = df["age"].astype("Int64")
+    for i in ["male", "bid", "malaysian", "comorb"]:
+        df[i] = rng.integers(0, 2, n)
+    df["nric"] = 1
+    return df.sort_values("date", kind="stable")
+
+
+def main(outdir: Path, linelist_dir: Path, start_date: str, end_date: str):
+    rng = np.random.default_rng(0)
+    dates = pd.date_range(start_date, end_date, freq="D", name="date")
+
+    def national_frame(columns: Dict[str, Tuple[int, int]]) -> pd.DataFrame:
+        df = pd.DataFrame(index=dates)
+        for name, (low, high) in columns.items():
+            df[name] = rng.integers(low, high, len(df))
+        return df
+
+    def state_frame(columns: Dict[str, Tuple[int, int]]) -> pd.DataFrame:
+        index = pd.MultiIndex.from_product([dates, STATES], names=["date", "state"])
+        df = pd.DataFrame(index=index)
+        for name, (low, high) in columns.items():
+            df[name] = rng.integers(low, high, len(df))
+        return df.reset_index("state")
+
+    def write(df: pd.DataFrame, fname: str):
+        df.to_csv(outdir / fname, date_format="%Y-%m-%d")
+
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    cases_columns = {
+        "cases_new": (0, 3000),
+        "cases_import": (0, 5),
+        "cases_recovered": (0, 3000),
+        "cases_active": (0, 30000),
+        "cases_cluster": (0, 100),
+        "cases_unvax": (0, 500),
+        "cases_pvax": (0, 300),
+        "cases_fvax": (0, 800),
+        "cases_boost": (0, 200),
+    }
+    cluster_columns = {
+        i: (0, 200)
+        for i in [
+            "cluster_import",
+            "cluster_religious",
+            "cluster_community",
+            "cluster_highRisk",
+            "cluster_education",
+            "cluster_detentionCentre",
+            "cluster_workplace",
+        ]
+    }
+    write(
+        national_frame(
+            {i: (low * 16, high * 16) for i, (low, high) in cases_columns.items()}
+            | cluster_columns
+        ),
+        "cases_malaysia.csv",
+    )
+    write(state_frame(cases_columns), "cases_state.csv")
+
+    deaths_columns = {
+        i: (0, 40)
+        for i in [
+            "deaths_new",
+            "deaths_bid",
+            "deaths_new_dod",
+            "deaths_bid_dod",
+            "deaths_unvax",
+            "deaths_pvax",
+            "deaths_fvax",
+            "deaths_boost",
+            "deaths_tat",
+        ]
+    }
+    write(national_frame(deaths_columns), "deaths_malaysia.csv")
+    write(state_frame(deaths_columns), "deaths_state.csv")
+
+    # Tests lag two days behind cases
+    tests = national_frame({"rtk-ag": (50000, 150000), "pcr": (20000, 60000)})
+    write(tests.iloc[:-2], "tests_malaysia.csv")
+    write(state_frame({"rtk-ag": (1000, 20000), "pcr": (500, 8000)}), "tests_state.csv")
+
+    hospital_columns = [
+        "beds",
+        "beds_covid",
+        "beds_noncrit",
+        "admitted_pui",
+        "admitted_covid",
+        "admitted_total",
+        "discharged_pui",
+        "discharged_covid",
+        "discharged_total",
+        "hosp_covid",
+        "hosp_pui",
+        "hosp_noncovid",
+    ]
+    write(state_frame({i: (0, 3000) for i in hospital_columns}), "hospital.csv")
+
+    icu_columns = [
+        "beds_icu",
+        "beds_icu_rep",
+        "beds_icu_total",
+        "beds_icu_covid",
+        "vent",
+        "vent_port",
+        "icu_covid",
+        "icu_pui",
+        "icu_noncovid",
+        "vent_covid",
+        "vent_pui",
+        "vent_noncovid",
+        "vent_used",
+        "vent_port_used",
+    ]
+    # Putrajaya has no ICU data upstream
+    icu = state_frame({i: (0, 200) for i in icu_columns})
+    write(icu[icu["state"] != "W.P. Putrajaya"], "icu.csv")
+
+    pkrc_columns = [
+        "beds",
+        "admitted_pui",
+        "admitted_covid",
+        "admitted_total",
+        "discharge_pui",
+        "discharge_covid",
+        "discharge_total",
+        "pkrc_covid",
+        "pkrc_pui",
+        "pkrc_noncovid",
+    ]
+    write(state_frame({i: (0, 2000) for i in pkrc_columns}), "pkrc.csv")
+
+    # Vaccinations lag a day behind cases
+    daily_columns = ["daily_partial", "daily_full", "daily_booster"]
+    vax_malaysia = national_frame({i: (0, 300000) for i in daily_columns})
+    vax_state = state_frame({i: (0, 30000) for i in daily_columns})
+    for df, cumul in [
+        (vax_malaysia, vax_malaysia),
+        (vax_state, vax_state.groupby("state")),
+    ]:
+        df["daily"] = df[daily_columns].sum(axis="columns")
+        df["cumul_partial"] = cumul["daily_partial"].cumsum()
+        df["cumul_full"] = cumul["daily_full"].cumsum()
+        df["cumul_booster"] = cumul["daily_booster"].cumsum()
+        df["cumul"] = df[["cumul_partial", "cumul_full", "cumul_booster"]].sum(
+            axis="columns"
+        )
+    write(vax_malaysia.iloc[:-1], "vax_malaysia.csv")
+    write(vax_state[vax_state.index < dates[-1]], "vax_state.csv")
+
+    # Written like the MOH repo, with the cube built from it like the bucket's
+    linelist_dir.mkdir(parents=True, exist_ok=True)
+    linelist_fp = linelist_dir / Path(sources.CUBES["deaths_cube"][1]).name
+    make_linelist(rng, dates).to_csv(linelist_fp, index=False, date_format="%Y-%m-%d")
+    write(linelist.build_cube(linelist_fp), sources.file_name("deaths_cube"))
+
+    # Check-ins from MySejahtera, with some unique locations left blank
+    checkin_columns = {
+        "checkins": (1000000, 30000000),
+        "unique_ind": (500000, 15000000),
+        "unique_loc": (100000, 1000000),
+    }
+    checkin_malaysia = national_frame(checkin_columns)
+    checkin_malaysia["unique_loc"] = checkin_malaysia["unique_loc"].where(
+        rng.random(len(dates)) > 0.05
+    )
+    write(checkin_malaysia, "checkin_malaysia.csv")
+    write(
+        state_frame(
+            {i: (low // 16, high // 16) for i, (low, high) in checkin_columns.items()}
+        ),
+        "checkin_state.csv",
+    )
+    # A column of check-ins for each half hour of the day
+    write(
+        national_frame({str(i): (0, 1000000) for i in range(48)}),
+        "checkin_malaysia_time.csv",
+    )
+    write(
+        national_frame(
+            {
+                "casual_contacts": (0, 100000),
+                "hide_large": (0, 50),
+                "hide_small": (0, 500),
+            }
+        ),
+        "trace_malaysia.csv",
+    )
+
+    # Cumulative vaccine registrations, national ones labelled "Malaysia"
+    vaxreg_columns = [
+        "total",
+        "phase2",
+        "mysj",
+        "call",
+        "web",
+        "children",
+        "elderly",
+        "comorb",
+        "oku",
+    ]
+    vaxreg_state = state_frame({i: (0, 5000) for i in vaxreg_columns})
+    vaxreg_state[vaxreg_columns] = (
+        vaxreg_state.groupby("state")[vaxreg_columns].cumsum() + 100000
+    )
+    vaxreg_malaysia = vaxreg_state.groupby("date")[vaxreg_columns].sum()
+    vaxreg_malaysia.insert(0, "state", "Malaysia")
+    write(vaxreg_malaysia, "vaxreg_malaysia.csv")
+    write(vaxreg_state, "vaxreg_state.csv")
+
+    manifest = {
+        "updated_at": PUSHED_AT,
+        "repos": {
+            "MoH-Malaysia/covid19-public": {"pushed_at": PUSHED_AT},
+            "CITF-Malaysia/citf-public": {"pushed_at": PUSHED_AT},
+        },
+        # MD5s as the bucket reports them, see covidapi/manifest.py
+        "files": {
+            fp.name: base64.b64encode(hashlib.md5(fp.read_bytes()).digest()).decode()
+            for fp in sorted(outdir.glob("*.csv"))
+        },
+    }
+    with open(outdir / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the fixture dataset")
+    parser.add_argument(
+        "--outdir",
+        type=Path,
+        default=Path(__file__).parent / "data",
+        help="Directory to write to, defaults to fixtures/data",
+    )
+    parser.add_argument(
+        "--linelist-dir",
+        type=Path,
+        default=Path(__file__).parent / "linelist",
+        help="Directory to write the linelist to, defaults to fixtures/linelist",
+    )
+    parser.add_argument("--start-date", type=str, default="2021-07-01")
+    parser.add_argument("--end-date", type=str, default="2021-09-30")
+    args = parser.parse_args()
+
+    main(args.outdir, args.linelist_dir, args.start_date, args.end_date)
@@ -0,0 +1,6 @@
+"""
+Supporting modules for the msia-covid-api FastAPI app.
+
+The app itself (routes and data loading) lives in `gcp-main.py`, this package
+holds the pieces that are not specific to any one endpoint.
+"""
@@ -0,0 +1,145 @@
+"""
+Structured access logging, one JSON object per request per line e.g.
+
+    {"ts": "2021-08-13T01:02:03.456+00:00", "method": "GET", "path": "/",
+     "query": {"state": "kl"}, "status": 200, "duration_ms": 12.3,
+     "sample_rate": 1.0}
+
+Records are handed to a queue and written out by a background thread, so
+serving a request never waits on stdout. Logs go to stdout by default, where
+App Engine picks them up as structured logs, or to the file named by
+`ACCESS_LOG_PATH`. The resulting `requests.jsonl` can be replayed with
+`benchmarks/replay.py`.
+
+`ACCESS_LOG_SAMPLE_RATE` (default 1.0) controls the fraction of successful
+requests logged, errors are always logged. Set it to 0 to only log errors.
+
+Things the app does outside of requests (see `log_event`) are logged the
+same way, with an "event" instead of a "path", e.g.
+
+    {"ts": "2021-08-13T01:02:03.456+00:00", "event": "profiling_enabled",
+     "profile_dir": "/tmp/covidapi-profiles"}
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from timeit import default_timer as timer
+
+from covidapi import warmup
+
+ACCESS_LOG_PATH = os.environ.get("ACCESS_LOG_PATH", "-")
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "1.0"))
+
+logger = logging.getLogger("covidapi.access")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+event_logger = logging.getLogger("covidapi.events")
+event_logger.setLevel(logging.INFO)
+event_logger.propagate = False
+
+_listener = None
+
+
+class JSONLineFormatter(logging.Formatter):
+    """Formats the dict passed as the log message as a single line of JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, separators=(",", ":"))
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as-is, leaving JSON encoding to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup(path: str = ACCESS_LOG_PATH):
+    """
+    Route access logs and events through a queue to `path`, or stdout if
+    `path` is "-". Safe to call more than once, only the first call takes
+    effect.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if path == "-":
+        handler = logging.StreamHandler(sys.stdout)
+    else:
+        handler = logging.FileHandler(path)
+    handler.setFormatter(JSONLineFormatter())
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    event_logger.addHandler(_DeferredQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+    # Flush whatever is left in the queue on shutdown
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Stop the background writer thread, flushing queued records"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec="milliseconds"
+    )
+
+
+def log_event(event: str, **fields):
+    """Log `event` with `fields`, next to the access log"""
+    setup()
+    event_logger.info({"ts": _now(), "event": event, **fields})
+
+
+def should_log(status: int) -> bool:
+    if status >= 400:
+        return True
+    return ACCESS_LOG_SAMPLE_RATE >= 1 or random.random() < ACCESS_LOG_SAMPLE_RATE
+
+
+def install(app):
+    """Add the access log middleware to `app`"""
+    from fastapi import Request
+
+    setup()
+
+    @app.middleware("http")
+    async def log_request(request: Request, call_next):
+        start = timer()
+        response = await call_next(request)
+        duration = timer() - start
+
+        # Warm-up requests at startup aren't traffic worth replaying
+        if should_log(response.status_code) and not warmup.is_warmup(request.scope):
+            # Leave out the profiling token, if any
+            query = {i: j for i, j in request.query_params.items() if i != "profile"}
+            logger.info(
+                {
+                    "ts": _now(),
+                    "method": request.method,
+                    "path": request.url.path,
+                    "query": query,
+                    "status": response.status_code,
+                    "duration_ms": round(duration * 1000, 3),
+                    "sample_rate": ACCESS_LOG_SAMPLE_RATE,
+                }
+            )
+
+        return response
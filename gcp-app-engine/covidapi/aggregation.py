@@ -0,0 +1,158 @@
+"""
+Server-side time aggregation for the `granularity` param of `/` and
+`/detailed`.
+
+How each column is aggregated is declared in `COLUMN_POLICY`, matched by
+column name pattern with the first match winning:
+
++ cumulative counts (`cumul*`) take the last value in the period
++ stocks such as active cases and hospital/ICU/PKRC occupancy and capacity
+  take the mean over the period, rounded to a whole number
++ everything else is a daily count, and is summed over the period
+
+Tables whose columns don't follow these names have their own patterns in
+`TABLE_POLICY`, matched by table name pattern and looked up before
+`COLUMN_POLICY`.
+"""
+
+import fnmatch
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class Granularity(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+
+
+# Weeks run Monday to Sunday, periods are labelled by their first day
+RESAMPLE_KWARGS = {
+    Granularity.week: dict(rule="W-MON", label="left", closed="left"),
+    Granularity.month: dict(rule="MS"),
+}
+
+COLUMN_POLICY: List[Tuple[str, str]] = [
+    ("cumul*", "last"),
+    ("cases_active", "mean"),
+    ("beds*", "mean"),
+    ("hosp_*", "mean"),
+    ("icu_*", "mean"),
+    ("vent*", "mean"),
+    ("pkrc_*", "mean"),
+]
+TABLE_POLICY: Dict[str, List[Tuple[str, str]]] = {
+    # Registrations are cumulative, without a cumul_ prefix
+    "vaxreg_*": [
+        (i, "last")
+        for i in [
+            "total",
+            "phase2",
+            "mysj",
+            "call",
+            "web",
+            "children",
+            "elderly",
+            "comorb",
+            "oku",
+        ]
+    ],
+}
+DEFAULT_AGGREGATION = "sum"
+
+
+def aggregation_for(column: str, table: Optional[str] = None) -> str:
+    """
+    Returns how `column` of `table` is aggregated: "sum", "last" or "mean".
+    """
+    policy = COLUMN_POLICY
+    if table is not None:
+        for pattern, table_policy in TABLE_POLICY.items():
+            if fnmatch.fnmatchcase(table, pattern):
+                policy = table_policy + policy
+    for pattern, how in policy:
+        if fnmatch.fnmatchcase(column, pattern):
+            return how
+    return DEFAULT_AGGREGATION
+
+
+def widen(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Undo `tables.downcast`: ints as int64, nullable ints as floats with NaN
+    for missing values, as tables are read. Other columns are left alone.
+    """
+    dtypes = df.dtypes
+    narrow = [
+        pd.api.types.is_integer_dtype(i)
+        and (pd.api.types.is_extension_array_dtype(i) or i.itemsize < 8)
+        for i in dtypes
+    ]
+    if not any(narrow):
+        return df
+
+    columns = []
+    for (_, column), is_narrow, dtype in zip(df.items(), narrow, dtypes):
+        if is_narrow:
+            nullable = pd.api.types.is_extension_array_dtype(dtype)
+            column = column.astype("float64" if nullable else "int64")
+        columns.append(column)
+    return pd.concat(columns, axis="columns")
+
+
+def period_starts(dates: pd.DatetimeIndex, granularity: Granularity) -> pd.Index:
+    """
+    Label of the period each of `dates` is aggregated into by
+    `resample_frame`, i.e. its first day
+    """
+    if granularity == Granularity.day or len(dates) == 0:
+        return dates
+
+    unique = dates.unique().sort_values()
+    # Period labels, and the position in `unique` each period ends at
+    groups = pd.Series(0, index=unique).resample(**RESAMPLE_KWARGS[granularity]).groups
+    ends = np.fromiter(groups.values(), dtype="int64", count=len(groups))
+    which = ends.searchsorted(np.arange(len(unique)), side="right")
+    return pd.DatetimeIndex(list(groups))[which][unique.get_indexer(dates)]
+
+
+def resample_frame(
+    df: pd.DataFrame, granularity: Granularity, table: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Aggregate a date-indexed frame of numeric columns to `granularity`,
+    following the policy for `table` if named, see `aggregation_for`. Column
+    order is kept, duplicate column names are fine.
+
+    Periods are aggregated over the dates present in `df`, so periods cut
+    by the start or end of the requested date range are partial. Narrow
+    columns are widened first, so sums can't overflow.
+    """
+    if granularity == Granularity.day or len(df.columns) == 0:
+        return df
+    df = widen(df)
+
+    hows = np.array([aggregation_for(i, table) for i in df.columns])
+    resampler_kwargs = RESAMPLE_KWARGS[granularity]
+
+    parts = []
+    positions = []
+    for how in ("sum", "last", "mean"):
+        (idx,) = np.nonzero(hows == how)
+        if len(idx) == 0:
+            continue
+        resampled = df.iloc[:, idx].resample(**resampler_kwargs)
+        if how == "sum":
+            # Keep periods with no data at all as NaN instead of 0
+            part = resampled.sum(min_count=1)
+        elif how == "last":
+            part = resampled.last()
+        else:
+            part = resampled.mean().round()
+        parts.append(part)
+        positions.extend(idx)
+
+    ans = pd.concat(parts, axis="columns")
+    return ans.iloc[:, np.argsort(positions, kind="stable")]
@@ -0,0 +1,245 @@
+"""
+Answers to `/` and `/detailed` queries, worked out from a `Dataset`.
+
+Shared by the API handlers and the refresh Cloud Function, which publishes
+the answers for the default dates as static JSON (see `covidapi/static.py`).
+Both encode answers with `encode`, so a published answer is byte for byte
+what the API would have sent, as long as both run the same code. Each
+deploys its own copy, `code_version` tells them apart.
+"""
+
+import datetime
+import hashlib
+import json
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from covidapi import metrics
+from covidapi.aggregation import Granularity
+from covidapi.dataset import Dataset
+from covidapi.tables import projection
+
+TIMEZONE = "Asia/Kuala_Lumpur"
+
+
+class MsianState(str, Enum):
+    johor = "johor"
+    kedah = "kedah"
+    kelantan = "kelantan"
+    melaka = "melaka"
+    ns = "negerisembilan"
+    pahang = "pahang"
+    perak = "perak"
+    perlis = "perlis"
+    penang = "penang"
+    sabah = "sabah"
+    sarawak = "sarawak"
+    selangor = "selangor"
+    terengganu = "terengganu"
+    kl = "kl"
+    labuan = "labuan"
+    putrajaya = "putrajaya"
+    allstates = "allstates"
+
+
+pretty_state_name = {
+    MsianState.johor: "Johor",
+    MsianState.kedah: "Kedah",
+    MsianState.kelantan: "Kelantan",
+    MsianState.melaka: "Melaka",
+    MsianState.ns: "Negeri Sembilan",
+    MsianState.pahang: "Pahang",
+    MsianState.perak: "Perak",
+    MsianState.perlis: "Perlis",
+    MsianState.penang: "Pulau Pinang",
+    MsianState.sabah: "Sabah",
+    MsianState.sarawak: "Sarawak",
+    MsianState.selangor: "Selangor",
+    MsianState.terengganu: "Terengganu",
+    MsianState.kl: "W.P. Kuala Lumpur",
+    MsianState.labuan: "W.P. Labuan",
+    MsianState.putrajaya: "W.P. Putrajaya",
+}
+
+reverse_pretty_state_name: Dict = {j: i for i, j in pretty_state_name.items()}
+
+
+def default_dates(start_date, end_date, now: Optional[pd.Timestamp] = None):
+    """
+    Fill in unspecified dates, defaulting to the five days before `now` (the
+    current time if not given) in GMT+8
+    """
+    if now is None:
+        now = pd.Timestamp.now(tz=TIMEZONE)
+    if start_date is None:
+        start_date: datetime.date = (now - pd.Timedelta("120h")).date()
+    if end_date is None:
+        end_date: datetime.date = now.date()
+    return start_date, end_date
+
+
+def encode(content) -> bytes:
+    """Encode an answer as JSON, the same way FastAPI's `JSONResponse` does"""
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+# Modules whose code decides what the answers are, see `code_version`
+ANSWER_MODULES = ["aggregation", "answers", "dataset", "sources", "summary", "tables"]
+# Encoded by `code_version` to catch changes in encoding, e.g. in `json`
+SAMPLE_ANSWER = {
+    "2021-08-01": {"cases_new": 1, "rate": 0.1234, "state": "Pulau Pinang ✓"}
+}
+
+
+def code_version() -> str:
+    """
+    Version of the code working out and encoding answers: the source of
+    `ANSWER_MODULES`, the pandas and numpy versions, and `SAMPLE_ANSWER` as
+    encoded. The same wherever the same code gives the same answers
+    """
+    fingerprint = hashlib.sha256()
+    for name in ANSWER_MODULES:
+        fingerprint.update((Path(__file__).parent / f"{name}.py").read_bytes())
+    fingerprint.update(f"{pd.__version__} {np.__version__}".encode())
+    fingerprint.update(encode(SAMPLE_ANSWER))
+    return fingerprint.hexdigest()[:12]
+
+
+def summary(
+    data: Dataset,
+    start_date,
+    end_date,
+    state: Optional[MsianState] = None,
+    granularity: Granularity = Granularity.day,
+) -> Dict:
+    """Answer to `/` for dates already filled in, see `return_root`"""
+    # Return national data
+    if state is None:
+        with metrics.stage("slice"):
+            ans = data.summary_malaysia.select(start_date, end_date, granularity)
+
+        # Considering split and index
+        # Ended up preferring index
+        with metrics.stage("to_dict"):
+            ans = ans.to_dict(orient="index")
+
+        return ans
+
+    elif state == MsianState.allstates:
+        ans_list = {}
+
+        with metrics.stage("slice"):
+            selected = data.summary_state.select_allstates(
+                start_date, end_date, granularity
+            )
+
+        for statename, ans in selected:
+            # Considering split and index
+            # Ended up preferring index
+            with metrics.stage("to_dict"):
+                ans = ans.to_dict(orient="index")
+            ans_list[reverse_pretty_state_name.get(statename)] = ans
+
+        return ans_list
+
+    else:
+        with metrics.stage("slice"):
+            ans = data.summary_state.select(
+                start_date, end_date, granularity, state=pretty_state_name.get(state)
+            )
+
+        # Considering split and index
+        # Ended up preferring index
+        with metrics.stage("to_dict"):
+            ans = ans.to_dict(orient="index")
+
+        return ans
+
+
+def detailed(
+    data: Dataset,
+    start_date,
+    end_date,
+    state: Optional[MsianState] = None,
+    granularity: Granularity = Granularity.day,
+    tables: Optional[str] = None,
+    columns: Optional[str] = None,
+) -> Dict:
+    """
+    Answer to `/detailed` for dates already filled in, see `return_detailed`
+
+    Raises
+    ------
+    ValueError for unknown `tables` or `columns`
+    """
+    projected = projection(
+        data.detailed_malaysia if state is None else data.detailed_state,
+        tables,
+        columns,
+    )
+
+    # Return national data
+    if state is None:
+        ans = {}
+
+        # Add each set of national data to the response
+        for i, projected_columns in projected.items():
+            with metrics.stage("slice"):
+                formatted_data = data.detailed_malaysia[i].select(
+                    start_date,
+                    end_date,
+                    granularity=granularity,
+                    columns=projected_columns,
+                )
+
+            # Considering split and index
+            # Ended up preferring index
+            with metrics.stage("to_dict"):
+                ans[i] = formatted_data.to_dict(orient="index")
+
+        return ans
+
+    elif state == MsianState.allstates:
+        ans = {}
+        for i, _ in pretty_state_name.items():
+            ans[i] = detailed(
+                data,
+                start_date,
+                end_date,
+                state=i,
+                granularity=granularity,
+                tables=tables,
+                columns=columns,
+            )
+        return ans
+
+    else:
+        ans = {}
+
+        # Add each set of state data to the response
+        for i, projected_columns in projected.items():
+            with metrics.stage("slice"):
+                formatted_data = data.detailed_state[i].select(
+                    start_date,
+                    end_date,
+                    state=pretty_state_name.get(state),
+                    granularity=granularity,
+                    columns=projected_columns,
+                )
+
+            # Considering split and index
+            # Ended up preferring index
+            with metrics.stage("to_dict"):
+                ans[i] = formatted_data.to_dict(orient="index")
+
+        return ans
@@ -0,0 +1,53 @@
+"""
+Helpers for `/batch`, which answers many queries in one request.
+
+Queries for the same endpoint and state are grouped, and their date ranges
+merged where they overlap or touch. Each merged range is computed once, and
+each query is answered by trimming the merged answer to its own range.
+Rows are shared between answers rather than copied.
+"""
+
+import datetime
+from typing import Dict, Iterable, List, Tuple
+
+DateRange = Tuple[datetime.date, datetime.date]
+
+
+def merge_ranges(ranges: Iterable[DateRange]) -> List[DateRange]:
+    """Merge overlapping or adjacent date ranges, returned sorted by start"""
+    merged: List[DateRange] = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + datetime.timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def containing_range(ranges: List[DateRange], start, end) -> int:
+    """Index of the range in `ranges` that covers `start` to `end`"""
+    for i, (range_start, range_end) in enumerate(ranges):
+        if range_start <= start and end <= range_end:
+            return i
+    raise ValueError(f"No range covers {start} to {end}")
+
+
+def trim_dates(
+    ans: Dict, start_date: str, end_date: str, depth: int = 0, drop_empty=False
+) -> Dict:
+    """
+    Keep entries of a response between ISO dates `start_date` and `end_date`.
+    Responses are keyed by date `depth` levels down e.g. 1 for
+    {state: {date: row}}. With `drop_empty`, entries left without any dates
+    are dropped too.
+    """
+    if depth == 0:
+        return {i: j for i, j in ans.items() if start_date <= i <= end_date}
+
+    trimmed = {
+        i: trim_dates(j, start_date, end_date, depth - 1, drop_empty)
+        for i, j in ans.items()
+    }
+    if drop_empty:
+        trimmed = {i: j for i, j in trimmed.items() if len(j) > 0}
+    return trimmed
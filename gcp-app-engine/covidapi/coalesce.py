@@ -0,0 +1,122 @@
+"""
+Single-flight coalescing of identical requests in flight at the same time.
+
+When the data refreshes, or at midnight in KL when the default dates move on,
+dashboards send the same query (e.g. `/detailed?state=allstates`) from many
+clients at once. Each used to work out the whole answer in its own
+threadpool thread, all of them contending for the GIL. Now the first request
+for a query works it out, and identical requests arriving while it is in
+flight wait for it and get a copy of its response, already encoded.
+
+Requests are identical when they are GETs for the same path with the same
+query params, in any order, on the same data version. The version is
+whatever `version()` returns when the request comes in, e.g. the data served
+and the default date range.
+
+Only the first request runs through the handler, so only it shows up in
+handler stage timings and profiles. Every request still goes through the
+request metrics and access log, which sit in front of this. Requests asking
+to be profiled are never coalesced. If the first request fails, those
+waiting on it are worked out on their own.
+"""
+
+import asyncio
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from covidapi import metrics, profiling
+
+# Paths whose responses only depend on the query and the data served
+COALESCED_PATHS = ("/", "/detailed", "/derived", "/linelist/deaths", "/ascii")
+
+
+class Coalescer:
+    """
+    ASGI middleware sharing one response between identical requests in
+    flight, see the module docstring
+
+    Args
+    ----
+    app: ASGI app to send requests on to
+    version: returns the current data version, part of what makes requests
+        identical
+    paths: paths of requests that can be coalesced
+    """
+
+    def __init__(
+        self,
+        app,
+        version: Callable[[], Hashable],
+        paths: Tuple[str, ...] = COALESCED_PATHS,
+    ):
+        self.app = app
+        self.version = version
+        self.paths = set(paths)
+        # Responses being worked out, as the ASGI messages sent for them
+        self.in_flight: Dict[Hashable, "asyncio.Future[Optional[List]]"] = {}
+
+    def key(self, scope: Dict) -> Optional[Hashable]:
+        """What identical requests have in common, None if not coalesced"""
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or scope["path"] not in self.paths
+        ):
+            return None
+
+        if profiling.carries_token(scope):
+            return None
+        query = tuple(
+            sorted(parse_qsl(scope["query_string"].decode(), keep_blank_values=True))
+        )
+        return scope["path"], query, self.version()
+
+    async def __call__(self, scope, receive, send):
+        key = self.key(scope)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        future = self.in_flight.get(key)
+        # Futures can only be awaited from their own event loop
+        if future is not None and future.get_loop() is loop:
+            metrics.record_cache_lookup("coalesce", True)
+            # Waiters being cancelled mustn't cancel the response being shared
+            messages = await asyncio.shield(future)
+            if messages is None:
+                await self.app(scope, receive, send)
+                return
+            for message in messages:
+                await send(message)
+            return
+
+        metrics.record_cache_lookup("coalesce", False)
+        future = loop.create_future()
+        self.in_flight[key] = future
+
+        messages: List = []
+
+        async def capture(message):
+            messages.append(message)
+
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+            # Complete even if it failed or was cancelled, for those waiting
+            complete = (
+                len(messages) > 0
+                and messages[-1]["type"] == "http.response.body"
+                and not messages[-1].get("more_body", False)
+            )
+            future.set_result(messages if complete else None)
+
+        for message in messages:
+            await send(message)
+
+
+def install(app, version: Callable[[], Hashable]):
+    """Coalesce identical requests to `app` on the same `version()`"""
+    app.add_middleware(Coalescer, version=version)
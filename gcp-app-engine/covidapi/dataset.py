@@ -0,0 +1,262 @@
+"""
+Everything served by the API, prepared from one load of a data source.
+
+Loading used to be module-level code in each app, reading from wherever that
+app got its data. The tables are read through a `covidapi.sources` source
+instead, so the same preparation runs on App Engine, Heroku, and in tests and
+benchmarks against the bundled fixture data.
+
+Tables are read and prepared the first time an endpoint needs them, then kept
+for as long as the `Dataset` is served. The summary served by `/` and `/ascii`
+only needs cases, deaths, vaccinations and tests, so a cold start doesn't wait
+on the hospital, ICU and PKRC tables only `/detailed` serves. `prefetch` reads
+the rest ahead of requests, e.g. in a background thread after startup.
+"""
+
+import hashlib
+import json
+import threading
+import uuid
+from typing import Callable, Dict, Iterator, List, Mapping, Tuple
+
+import pandas as pd
+
+from covidapi import derived
+from covidapi.linelist import Cube
+from covidapi.sources import CUBES, FILES, DataSource
+from covidapi.summary import SummaryTable
+from covidapi.tables import Table, downcast
+
+# Tables served by /detailed, in the order they are served
+DETAILED_MALAYSIA = [
+    "cases_malaysia",
+    "deaths_malaysia",
+    "vax_malaysia",
+    "tests_malaysia",
+    "hospital_malaysia",
+    "icu_malaysia",
+    "pkrc_malaysia",
+    "checkin_malaysia",
+    "checkin_malaysia_time",
+    "trace_malaysia",
+    "vaxreg_malaysia",
+]
+DETAILED_STATE = [
+    "cases_state",
+    "deaths_state",
+    "vax_state",
+    "tests_state",
+    "hospital_state",
+    "icu_state",
+    "pkrc_state",
+    "checkin_state",
+    "vaxreg_state",
+]
+
+# National tables summed up from state tables
+NATIONAL_SUMS = {
+    "hospital_malaysia": "hospital_state",
+    "icu_malaysia": "icu_state",
+    "pkrc_malaysia": "pkrc_state",
+}
+
+# Tables kept in compact dtypes, see `tables.downcast`. The MySejahtera and
+# registration tables are the largest, with a column per half hour of the day
+# or a row per state and day since registration opened
+COMPACT = {
+    "checkin_malaysia",
+    "checkin_malaysia_time",
+    "checkin_state",
+    "trace_malaysia",
+    "vaxreg_malaysia",
+    "vaxreg_state",
+}
+
+
+def data_version(file_hashes: Dict[str, str]) -> str:
+    """
+    Version of data read from files with `file_hashes`, see
+    `DataSource.file_hashes`. The same for every load of the same files, so
+    instances can share what they work out from them. Loads from files
+    without hashes each get a version of their own.
+    """
+    if len(file_hashes) == 0:
+        return uuid.uuid4().hex
+    hashed = json.dumps(sorted(file_hashes.items())).encode()
+    return hashlib.sha256(hashed).hexdigest()[:16]
+
+
+class LazyTables(Mapping):
+    """Tables by name, each built the first time it is looked up"""
+
+    def __init__(self, names: List[str], build: Callable[[str], Table]):
+        self.names = names
+        self.build = build
+
+    def __getitem__(self, name: str) -> Table:
+        if name not in self.names:
+            raise KeyError(name)
+        return self.build(name)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+class Dataset:
+    """
+    Tables served by each endpoint, built on first use. Safe to use from
+    several threads, each table is read and prepared once.
+    """
+
+    def __init__(self, source: DataSource):
+        self.source = source
+        self.pushed_at: Dict[str, str] = source.pushed_at()
+        self.file_hashes: Dict[str, str] = source.file_hashes()
+        # Key for responses worked out from this data, see `data_version`
+        self.version = data_version(self.file_hashes)
+
+        self._built: Dict[Tuple[str, str], object] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+        # Keep tables served by /detailed in the format they are served in
+        self.detailed_malaysia: Mapping[str, Table] = LazyTables(
+            DETAILED_MALAYSIA, self._detailed
+        )
+        self.detailed_state: Mapping[str, Table] = LazyTables(
+            DETAILED_STATE, self._detailed
+        )
+
+    def _memoized(self, key: Tuple[str, str], build: Callable[[], object]):
+        """Result of `build`, only called the first time `key` is asked for"""
+        if key in self._built:
+            return self._built[key]
+
+        # Requests wanting the same table wait for one another, not for others
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._built:
+                self._built[key] = build()
+        return self._built[key]
+
+    def table(self, name: str) -> pd.DataFrame:
+        """
+        Source table or cube `name` as read, see `sources.FILES`. Tables in
+        `COMPACT` are downcast, holding the same values
+        """
+
+        def read() -> pd.DataFrame:
+            df = self.source.read(name)
+            return downcast(df) if name in COMPACT else df
+
+        return self._memoized(("table", name), read)
+
+    @property
+    def tables(self) -> Dict[str, pd.DataFrame]:
+        """
+        Every source table and cube, unmodified, e.g. to snapshot with
+        `sources.write_snapshot`. Reads any not read yet.
+        """
+        return {i: self.table(i) for i in list(FILES) + list(CUBES)}
+
+    def frame(self, name: str) -> pd.DataFrame:
+        """Table `name` ready to serve, including those worked out from others"""
+        return self._memoized(("frame", name), lambda: self._prepare(name))
+
+    def _prepare(self, name: str) -> pd.DataFrame:
+        if name in NATIONAL_SUMS:
+            return (
+                self.table(NATIONAL_SUMS[name]).groupby("date").sum(numeric_only=True)
+            )
+
+        df = self.table(name)
+        if name == "cases_malaysia":
+            # Round out the no-clusters column for national cases
+            df = df.assign(
+                cluster_none=df["cases_new"]
+                - df.drop(columns=["cases_new"]).sum(axis="columns")
+            )
+        elif name == "tests_malaysia":
+            # Add a total tests column
+            df = df.assign(total_tests=df.sum(axis="columns"))
+        elif name == "vaxreg_malaysia":
+            # National registrations are labelled state "Malaysia"
+            df = df.drop(columns="state", errors="ignore")
+        return df
+
+    def _detailed(self, name: str) -> Table:
+        return self._memoized(
+            ("detailed", name),
+            lambda: Table(self.frame(name), compact=name in COMPACT, name=name),
+        )
+
+    # Join the summary view served by / once, instead of on every request
+    @property
+    def summary_malaysia(self) -> SummaryTable:
+        return self._memoized(
+            ("summary", "malaysia"),
+            lambda: SummaryTable.national(
+                cases_malaysia=self.frame("cases_malaysia"),
+                deaths_malaysia=self.frame("deaths_malaysia"),
+                vax_malaysia=self.frame("vax_malaysia"),
+                tests_malaysia=self.frame("tests_malaysia"),
+            ),
+        )
+
+    @property
+    def summary_state(self) -> SummaryTable:
+        return self._memoized(
+            ("summary", "state"),
+            lambda: SummaryTable.by_state(
+                cases_state=self.frame("cases_state"),
+                deaths_state=self.frame("deaths_state"),
+                vax_state=self.frame("vax_state"),
+            ),
+        )
+
+    def _derived(self) -> Tuple[Table, Table]:
+        """Precompute rolling averages, positivity rates and vax deltas"""
+        derived_malaysia, derived_state = derived.compute_derived(
+            cases_malaysia=self.frame("cases_malaysia"),
+            cases_state=self.frame("cases_state"),
+            deaths_malaysia=self.frame("deaths_malaysia"),
+            deaths_state=self.frame("deaths_state"),
+            tests_malaysia=self.frame("tests_malaysia"),
+            tests_state=self.frame("tests_state"),
+            vax_malaysia=self.frame("vax_malaysia"),
+            vax_state=self.frame("vax_state"),
+        )
+        # Averages and rates stay as floats
+        return (
+            Table(derived_malaysia, int_columns=derived.INT_COLUMNS),
+            Table(derived_state, int_columns=derived.INT_COLUMNS),
+        )
+
+    @property
+    def derived_malaysia(self) -> Table:
+        return self._memoized(("derived", "all"), self._derived)[0]
+
+    @property
+    def derived_state(self) -> Table:
+        return self._memoized(("derived", "all"), self._derived)[1]
+
+    @property
+    def deaths_cube(self) -> Cube:
+        """Deaths from the linelist, served by /linelist/deaths"""
+        return self._memoized(
+            ("cube", "deaths"), lambda: Cube(self.table("deaths_cube"))
+        )
+
+    def prefetch(self):
+        """Build everything not built yet, most requested first"""
+        self.summary_malaysia
+        self.summary_state
+        self.derived_malaysia
+        for tables in [self.detailed_malaysia, self.detailed_state]:
+            for name in tables:
+                tables[name]
+        self.deaths_cube
@@ -0,0 +1,146 @@
+"""
+Derived series computed once when data is loaded, served by `/derived`.
+
+Saves clients from pulling months of raw data to work these out themselves:
+
++ `cases_new_7d`, `deaths_new_7d`: 7-day rolling average of new cases/deaths,
+  over the past 7 calendar days, unknown if any of them is missing
++ `positivity_rate`: cases_new / total_tests for the day
++ `positivity_rate_7d`: 7-day rolling sum of cases_new / total_tests
++ `daily_partial_delta`, `daily_full_delta`: change in `cumul_partial` and
+  `cumul_full` since the day before, unknown if that day is missing
+"""
+
+from typing import Tuple
+
+import pandas as pd
+
+# State name used for national rows while computing all series in one pass
+NATIONAL = "Malaysia"
+
+ROLLING_WINDOW = 7
+
+DERIVED_COLUMNS = [
+    "cases_new_7d",
+    "deaths_new_7d",
+    "positivity_rate",
+    "positivity_rate_7d",
+    "daily_partial_delta",
+    "daily_full_delta",
+]
+
+# Decimal places kept for each derived series
+ROUNDING = {
+    "cases_new_7d": 2,
+    "deaths_new_7d": 2,
+    "positivity_rate": 4,
+    "positivity_rate_7d": 4,
+}
+
+# Whole-number series, served as int once NaNs are filled
+INT_COLUMNS = ["daily_partial_delta", "daily_full_delta"]
+
+
+def _to_long(national: pd.DataFrame, state: pd.DataFrame, columns) -> pd.DataFrame:
+    """Stack national and state rows into one frame keyed by (state, date)"""
+    national = national[columns].assign(state=NATIONAL)
+    state = state[columns + ["state"]]
+    ans = (
+        pd.concat([national, state])
+        .rename_axis("date")
+        .reset_index()
+        .set_index(["state", "date"])
+    )
+    # Keep the latest of duplicate rows, as tables do
+    return ans[~ans.index.duplicated(keep="last")]
+
+
+def _every_day(frame: pd.DataFrame) -> pd.DataFrame:
+    """`frame` with a row for every day between each state's first and last"""
+    dates = frame.index.get_level_values("date")
+    spans = pd.Series(dates, index=frame.index.get_level_values("state"))
+    spans = spans.groupby(level=0, sort=False).agg(["min", "max"])
+    index = pd.MultiIndex.from_tuples(
+        [
+            (state, date)
+            for state, (start, end) in spans.iterrows()
+            for date in pd.date_range(start, end)
+        ],
+        names=frame.index.names,
+    )
+    return frame.reindex(index)
+
+
+def compute_derived(
+    cases_malaysia: pd.DataFrame,
+    cases_state: pd.DataFrame,
+    deaths_malaysia: pd.DataFrame,
+    deaths_state: pd.DataFrame,
+    tests_malaysia: pd.DataFrame,
+    tests_state: pd.DataFrame,
+    vax_malaysia: pd.DataFrame,
+    vax_state: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compute derived series for national and state data together.
+
+    Returns
+    -------
+    (derived_malaysia, derived_state): national frame indexed by date, and
+    state frame indexed by date with a `state` column, same layout as the
+    source tables. Values missing from the source data are left as NaN.
+    """
+    # State tests only come as separate test types
+    if "total_tests" not in tests_state.columns:
+        tests_state = tests_state.assign(
+            total_tests=tests_state.drop(columns="state").sum(axis="columns")
+        )
+
+    frame = pd.concat(
+        [
+            _to_long(cases_malaysia, cases_state, ["cases_new"]),
+            _to_long(deaths_malaysia, deaths_state, ["deaths_new"]),
+            _to_long(tests_malaysia, tests_state, ["total_tests"]),
+            _to_long(vax_malaysia, vax_state, ["cumul_partial", "cumul_full"]),
+        ],
+        axis="columns",
+    ).sort_index()
+
+    # Windows and day-on-day changes span calendar days, days missing from
+    # the data leave them unknown instead of reaching further back
+    given = frame.index
+    frame = _every_day(frame)
+
+    # Groups come out in the same order as the sorted frame, so results
+    # can be assigned back positionally
+    grouped = frame.groupby(level="state", sort=False)
+    rolling_sums = (
+        grouped[["cases_new", "deaths_new", "total_tests"]]
+        .rolling(ROLLING_WINDOW, min_periods=ROLLING_WINDOW)
+        .sum()
+    )
+    deltas = grouped[["cumul_partial", "cumul_full"]].diff()
+
+    derived = pd.DataFrame(index=frame.index)
+    derived["cases_new_7d"] = rolling_sums["cases_new"].to_numpy() / ROLLING_WINDOW
+    derived["deaths_new_7d"] = rolling_sums["deaths_new"].to_numpy() / ROLLING_WINDOW
+    derived["positivity_rate"] = frame["cases_new"] / frame["total_tests"]
+    derived["positivity_rate_7d"] = (
+        rolling_sums["cases_new"] / rolling_sums["total_tests"]
+    ).to_numpy()
+    derived["daily_partial_delta"] = deltas["cumul_partial"]
+    derived["daily_full_delta"] = deltas["cumul_full"]
+
+    # Only the days in the data
+    derived = derived.loc[given]
+
+    # Zero tests on a day gives inf, treat as unknown
+    derived = derived.replace([float("inf"), float("-inf")], float("nan"))
+    derived = derived.round(ROUNDING)
+
+    derived = derived.reset_index(level="state")
+    derived_malaysia = derived[derived["state"] == NATIONAL].drop(columns="state")
+    derived_state = derived[derived["state"] != NATIONAL]
+    derived_state = derived_state[["state"] + DERIVED_COLUMNS].sort_index(kind="stable")
+
+    return derived_malaysia, derived_state
@@ -0,0 +1,215 @@
+"""
+Pre-aggregated cubes of the MoH linelists, served by `/linelist/deaths`.
+
+The MoH repo has a row per death in `epidemic/linelist/linelist_deaths.csv`,
+tens of MB that used to be cloned and never used. `build_cube` streams it in
+chunks, reading only the columns needed with compact dtypes, and sums up each
+chunk into deaths by (date, state, age band, vaccination status). Only those
+small partial sums are kept while reading, so the raw linelist never has to
+fit in memory.
+
+The refresh Cloud Function builds the cube and uploads it to the bucket next
+to the CSVs, so the API only ever reads the cube. The git source builds it
+from the clone instead.
+
+Vaccination status follows the `deaths_*vax` columns of `deaths_malaysia`:
+a dose counts once it was given `PROTECTION_DAYS` days before testing
+positive. Boosted is 3 doses, fully vaccinated 2, partially vaccinated 1.
+"""
+
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from covidapi.aggregation import Granularity, period_starts
+from covidapi.tables import date_rows, iso_dates, state_offsets
+
+DIMENSIONS = ["state", "age_band", "vax_status"]
+# Dimensions deaths can be broken down by besides state
+BREAKDOWNS = ["age_band", "vax_status"]
+# Deaths, those brought in dead, and those with comorbidities
+MEASURES = ["deaths", "bid", "comorb"]
+
+# Lower age of each band, the last band is open-ended
+AGE_BANDS = [0, 12, 18, 30, 40, 50, 60, 70, 80]
+AGE_BAND_LABELS = [f"{i}-{j - 1}" for i, j in zip(AGE_BANDS, AGE_BANDS[1:])] + [
+    f"{AGE_BANDS[-1]}+"
+]
+UNKNOWN_AGE = "unknown"
+
+VAX_STATUSES = ["unvax", "pvax", "fvax", "boost"]
+PROTECTION_DAYS = 14
+
+DATE_COLUMNS = ["date", "date_positive", "date_dose1", "date_dose2", "date_dose3"]
+# Columns read from the linelist, everything else is skipped while parsing
+DTYPES = {"state": "category", "age": "float32", "bid": "int8", "comorb": "int8"}
+CHUNKSIZE = 100_000
+
+
+def age_bands(ages: pd.Series) -> pd.Categorical:
+    """Band of each age, `UNKNOWN_AGE` where missing"""
+    bands = pd.cut(
+        ages,
+        bins=AGE_BANDS + [np.inf],
+        labels=AGE_BAND_LABELS,
+        right=False,
+    )
+    return bands.cat.add_categories([UNKNOWN_AGE]).fillna(UNKNOWN_AGE)
+
+
+def vax_statuses(chunk: pd.DataFrame) -> pd.Categorical:
+    """Vaccination status of each death when testing positive"""
+    tested = chunk["date_positive"].fillna(chunk["date"])
+    protected_by = tested - pd.Timedelta(days=PROTECTION_DAYS)
+
+    doses = np.zeros(len(chunk), dtype="int8")
+    for i in [1, 2, 3]:
+        doses += (chunk[f"date_dose{i}"] <= protected_by).to_numpy(dtype="int8")
+    # Partially vaccinated from the first dose, protected or not
+    doses = np.maximum(doses, (chunk["date_dose1"] <= tested).to_numpy(dtype="int8"))
+
+    return pd.Categorical.from_codes(doses, categories=VAX_STATUSES)
+
+
+def read_chunks(fp, chunksize: int = CHUNKSIZE) -> Iterable[pd.DataFrame]:
+    """The linelist at `fp` in chunks of rows, columns missing upstream filled in"""
+    wanted = set(DATE_COLUMNS) | set(DTYPES)
+    for chunk in pd.read_csv(
+        fp,
+        usecols=lambda x: x in wanted,
+        dtype=DTYPES,
+        chunksize=chunksize,
+    ):
+        for name in DATE_COLUMNS:
+            if name not in chunk.columns:
+                chunk[name] = pd.NaT
+            chunk[name] = pd.to_datetime(chunk[name], format="%Y-%m-%d")
+        for name in ["bid", "comorb"]:
+            if name not in chunk.columns:
+                chunk[name] = np.int8(0)
+        yield chunk
+
+
+def build_cube(fp, chunksize: int = CHUNKSIZE) -> pd.DataFrame:
+    """
+    Deaths in the linelist at `fp` summed up by date and `DIMENSIONS`.
+
+    Returns
+    -------
+    Frame indexed by date, sorted, with a column for each of `DIMENSIONS`
+    and `MEASURES`. Only combinations with any deaths have a row
+    """
+    partials = []
+    for chunk in read_chunks(fp, chunksize):
+        cells = pd.DataFrame(
+            {
+                "date": chunk["date"],
+                "state": chunk["state"],
+                "age_band": age_bands(chunk["age"]),
+                "vax_status": vax_statuses(chunk),
+                "deaths": np.int32(1),
+                "bid": chunk["bid"].astype("int32"),
+                "comorb": chunk["comorb"].astype("int32"),
+            }
+        )
+        partials.append(
+            cells.groupby(["date"] + DIMENSIONS, observed=True)[MEASURES].sum()
+        )
+
+    if len(partials) == 0:
+        return pd.DataFrame(
+            columns=DIMENSIONS + MEASURES, index=pd.DatetimeIndex([], name="date")
+        )
+
+    # Cells split across chunks are summed up again
+    cube = pd.concat(partials).groupby(level=list(range(4)), observed=True).sum()
+    cube = cube.reset_index(DIMENSIONS).sort_index(kind="stable")
+    for name in DIMENSIONS:
+        cube[name] = cube[name].astype(str)
+    return cube
+
+
+def breakdowns(by: Optional[str] = None) -> List[str]:
+    """
+    Dimensions to break down by from a comma-separated `by` query param,
+    all of `BREAKDOWNS` if not given, none if empty.
+
+    Raises
+    ------
+    ValueError for anything not in `BREAKDOWNS`
+    """
+    if by is None:
+        return list(BREAKDOWNS)
+    names = [i.strip() for i in by.split(",") if len(i.strip()) > 0]
+    unknown = [i for i in names if i not in BREAKDOWNS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown breakdowns {unknown}, expected any of {BREAKDOWNS}")
+    return [i for i in BREAKDOWNS if i in names]
+
+
+class Cube:
+    """
+    A cube built by `build_cube`, kept compact and sorted by state then date,
+    with per-state row offsets like `tables.Table`
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        df = df.sort_index(kind="stable").sort_values("state", kind="stable")
+        self.offsets = state_offsets(df["state"].astype(str).to_numpy())
+        self.dates = df.index.to_numpy()
+        self.df = df.assign(
+            **{i: df[i].astype("category") for i in DIMENSIONS},
+            **{i: df[i].astype("int32") for i in MEASURES},
+        )
+
+    def rows(self, start_date, end_date, state: Optional[str] = None) -> np.ndarray:
+        """Positions of rows between `start_date` and `end_date` in `state`"""
+        if state is None:
+            offsets = list(self.offsets.values())
+        elif state in self.offsets:
+            offsets = [self.offsets[state]]
+        else:
+            offsets = []
+        slices = [
+            date_rows(self.dates, lo, hi, start_date, end_date) for lo, hi in offsets
+        ]
+        return np.concatenate(
+            [np.arange(i.start, i.stop) for i in slices] + [np.arange(0)]
+        )
+
+    def select(
+        self,
+        start_date,
+        end_date,
+        state: Optional[str] = None,
+        by: Optional[List[str]] = None,
+        granularity: Granularity = Granularity.day,
+    ) -> pd.DataFrame:
+        """
+        Deaths from `start_date` to `end_date` in `state`, or nationwide,
+        summed up by period and the `by` dimensions (all by default).
+
+        Returns
+        -------
+        Frame with a column for the ISO start date of each period, then the
+        `by` dimensions and `MEASURES`, one row per combination with deaths
+        """
+        if by is None:
+            by = DIMENSIONS
+
+        rows = self.df.iloc[self.rows(start_date, end_date, state)]
+        dates = iso_dates(period_starts(rows.index, granularity))
+        ans = rows.groupby([dates] + by, observed=True)[MEASURES].sum().reset_index()
+        return ans.rename(columns={ans.columns[0]: "date"})
+
+
+def to_served(selected: pd.DataFrame) -> dict:
+    """
+    Rows of `selected` grouped by date, e.g. {"2021-09-01": [{"age_band":
+    "60-69", "vax_status": "unvax", "deaths": 3, ...}, ...]}
+    """
+    ans = {}
+    for date, rows in selected.groupby("date", sort=True):
+        ans[date] = rows.drop(columns="date").to_dict(orient="records")
+    return ans
@@ -0,0 +1,113 @@
+"""
+When the upstream data repos were last updated.
+
+The refresh Cloud Function publishes `manifest.json` to the data bucket
+alongside the CSVs, recording when each repo was last pushed to, and the MD5
+of each file it uploaded as the bucket reports it:
+
+    {"updated_at": "...", "repos": {"MoH-Malaysia/covid19-public":
+        {"pushed_at": "2021-08-13T09:27:11+00:00"}, ...},
+     "files": {"cases_malaysia.csv": "1B2M2Y8AsgTpgAmY7PhCfg==", ...}}
+
+The file hashes identify the data served, see `Dataset.version`.
+
+The API reads it along with the data. Only if it's missing or incomplete
+does the API ask the GitHub API instead, in the background and with a
+timeout, so a slow or rate-limited GitHub never holds up or fails startup.
+"""
+
+import base64
+import hashlib
+import json
+import threading
+from typing import Dict, Iterable, Optional
+
+import pandas as pd
+
+MANIFEST_NAME = "manifest.json"
+MOH_REPO = "MoH-Malaysia/covid19-public"
+CITF_REPO = "CITF-Malaysia/citf-public"
+GITHUB_API_URL = "https://api.github.com"
+TIMEOUT = 10
+TIMEZONE = "Asia/Kuala_Lumpur"
+
+
+def pushed_at(manifest: Dict) -> Dict[str, str]:
+    """Push time of each repo in a parsed manifest"""
+    return {
+        repo: info["pushed_at"]
+        for repo, info in manifest.get("repos", {}).items()
+        if info.get("pushed_at")
+    }
+
+
+def file_hashes(manifest: Dict) -> Dict[str, str]:
+    """Hash of each file in a parsed manifest, empty for older manifests"""
+    return dict(manifest.get("files", {}))
+
+
+def md5_hash(body: bytes) -> str:
+    """Base64 MD5 of `body`, as the bucket reports it and manifests list it"""
+    return base64.b64encode(hashlib.md5(body).digest()).decode()
+
+
+def fetch_manifest(url: str) -> Dict:
+    """Parsed manifest at `url`, empty if unreadable"""
+    # urllib is what pandas reads the bucket CSVs with, so cold starts don't
+    # also have to import requests
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as resp:
+            return json.load(resp)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read manifest from {url}: {e}")
+        return {}
+
+
+class CommitTimes:
+    """Last push time of each repo, None until known"""
+
+    def __init__(self, repos: Iterable[str] = (MOH_REPO, CITF_REPO)):
+        self.times: Dict[str, Optional[pd.Timestamp]] = {i: None for i in repos}
+
+    def get(self, repo: str) -> Optional[pd.Timestamp]:
+        return self.times.get(repo)
+
+    def age(self, repo: str) -> Optional[float]:
+        """Seconds since `repo` was last pushed to, None if unknown"""
+        pushed_at = self.get(repo)
+        if pushed_at is None:
+            return None
+        return (pd.Timestamp.now(tz=TIMEZONE) - pushed_at).total_seconds()
+
+    def set(self, repo: str, pushed_at: str):
+        self.times[repo] = pd.Timestamp(pushed_at).tz_convert(TIMEZONE)
+
+    def missing(self):
+        return [i for i, j in self.times.items() if j is None]
+
+    def update(self, pushed_at: Dict[str, str]) -> bool:
+        """Set push times of known repos, returns if all are now found"""
+        for repo, time in pushed_at.items():
+            if repo in self.times:
+                self.set(repo, time)
+        return len(self.missing()) == 0
+
+    def lookup_github(self):
+        """Ask the GitHub API for repos without a push time yet"""
+        # Only needed if the manifest is missing, see the module docstring
+        import requests
+
+        for repo in self.missing():
+            try:
+                resp = requests.get(f"{GITHUB_API_URL}/repos/{repo}", timeout=TIMEOUT)
+                resp.raise_for_status()
+                self.set(repo, resp.json()["pushed_at"])
+            except (requests.RequestException, KeyError, ValueError) as e:
+                print(f"Failed to look up {repo} on GitHub: {e}")
+
+    def lookup_github_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.lookup_github, daemon=True)
+        thread.start()
+        return thread
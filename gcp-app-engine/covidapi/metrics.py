@@ -0,0 +1,262 @@
+"""
+Minimal Prometheus-style metrics for the API.
+
+Keeps counters, gauges and histograms in memory and renders them in the
+Prometheus text exposition format, served by the `/metrics` endpoint.
+Written in-house instead of pulling in `prometheus_client`, as the app only
+needs a handful of metric types and runs on a single small instance.
+"""
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds in seconds, tuned for handlers that take a few ms to a few s
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Endpoint label for the request being served, set by the request middleware
+# so that stage timings don't need to be told which endpoint they belong to
+current_endpoint: contextvars.ContextVar = contextvars.ContextVar(
+    "current_endpoint", default="none"
+)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Tuple, labelvalues: Tuple, extra: str = "") -> str:
+    pairs = [f'{i}="{_escape(j)}"' for i, j in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        assert set(labels.keys()) == set(
+            self.labelnames
+        ), f"{self.name} expects labels {self.labelnames}, got {tuple(labels.keys())}"
+        return tuple(str(labels[i]) for i in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labelstr, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labelstr} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [("", _format_labels(self.labelnames, k), v) for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], Optional[float]]] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn: Callable[[], Optional[float]], **labels):
+        """
+        Evaluate `fn` at scrape time instead of storing a value.
+        Returning None from `fn` omits the sample.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = fn
+
+    def get(self, **labels) -> Optional[float]:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            value = fn()
+            if value is not None:
+                values[key] = value
+        return [
+            ("", _format_labels(self.labelnames, k), v)
+            for k, v in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple = (),
+        buckets: Tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per label set: [bucket counts..., sum, count]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [0] * (len(self.buckets) + 2)
+                self._values[key] = state
+            for idx, upper in enumerate(self.buckets):
+                if value <= upper:
+                    state[idx] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return 0 if state is None else state[-1]
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        samples = []
+        for key, state in items:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, state):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(upper) + '"'
+                samples.append(
+                    ("_bucket", _format_labels(self.labelnames, key, le), cumulative)
+                )
+            samples.append(("_sum", _format_labels(self.labelnames, key), state[-2]))
+            samples.append(("_count", _format_labels(self.labelnames, key), state[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(i.render() for i in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+## Metrics exposed by the API -------------------------------
+
+REQUESTS = REGISTRY.register(
+    Counter(
+        "covidapi_requests_total",
+        "Requests served, by endpoint, state and status code.",
+        ("endpoint", "state", "status"),
+    )
+)
+REQUEST_LATENCY = REGISTRY.register(
+    Histogram(
+        "covidapi_request_duration_seconds",
+        "End-to-end request latency, by endpoint and state.",
+        ("endpoint", "state"),
+    )
+)
+STAGE_LATENCY = REGISTRY.register(
+    Histogram(
+        "covidapi_handler_stage_duration_seconds",
+        "Time spent in each stage of a handler, by endpoint and stage.",
+        ("endpoint", "stage"),
+    )
+)
+STARTUP_PHASE = REGISTRY.register(
+    Gauge(
+        "covidapi_startup_phase_seconds",
+        "Duration of each phase of app startup.",
+        ("phase",),
+    )
+)
+SNAPSHOT_AGE = REGISTRY.register(
+    Gauge(
+        "covidapi_data_snapshot_age_seconds",
+        "Time since the upstream data repo was last updated.",
+        ("repo",),
+    )
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "covidapi_cache_requests_total",
+        "Cache lookups, by cache name and result (hit or miss).",
+        ("cache", "result"),
+    )
+)
+
+
+@contextmanager
+def stage(name: str, endpoint: Optional[str] = None) -> Iterator[None]:
+    """
+    Time a block of handler code, e.g. `with stage("slice"): ...`.
+    Endpoint label defaults to the one set for the current request.
+    """
+    if endpoint is None:
+        endpoint = current_endpoint.get()
+    start = timer()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(timer() - start, endpoint=endpoint, stage=name)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
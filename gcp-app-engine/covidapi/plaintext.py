@@ -0,0 +1,150 @@
+"""
+Plain-text tables served by `/ascii`, for terminal users.
+
+The endpoint used to build the JSON answer of `/`, turn it back into a
+DataFrame, format it with a Python lambda per cell through `to_string`, and
+then patch in separator lines with repeated splits and concatenation.
+Instead, the summary table slice is formatted a column at a time with numpy
+string operations, and laid out the same way `to_string` did.
+
+Rendered tables are cached per query and data version. The "data updated"
+header changes by the minute, so it is not cached but prepended per request.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from covidapi import metrics
+
+# Column names as printed
+COLUMN_NAMES = {
+    "cases_new": "New cases",
+    "deaths_new": "Deaths",
+    "cumul_partial": "Sum partially vax'ed",
+    "cumul_full": "Sum fully vax'ed",
+    "total_tests": "Daily tests",
+}
+LINE_WIDTH = 60
+
+
+def format_thousands(values: np.ndarray) -> np.ndarray:
+    """Format ints with thousands separators like "{:,}", a column at a time"""
+    values = np.asarray(values, dtype=np.int64)
+    rest = np.abs(values)
+
+    # Split into groups of three digits, least significant first
+    groups = [rest % 1000]
+    rest = rest // 1000
+    while rest.any():
+        groups.append(rest % 1000)
+        rest = rest // 1000
+
+    ans = np.char.mod("%d", groups[-1])
+    started = groups[-1] > 0
+    for group in reversed(groups[:-1]):
+        ans = np.where(
+            started,
+            np.char.add(np.char.add(ans, ","), np.char.mod("%03d", group)),
+            np.char.mod("%d", group),
+        )
+        started |= group > 0
+
+    return np.where(values < 0, np.char.add("-", ans), ans)
+
+
+def _bins(widths: List[int], line_width: int) -> List[int]:
+    """End of each run of columns that fits in `line_width`, as `to_string`"""
+    bins = []
+    current = 0
+    for i, width in enumerate(widths):
+        current += width + 1
+        # Leave room for the continuation marker, except on the last column
+        margin = 1 if i == len(widths) - 1 else 2
+        if current + margin > line_width and i > 0:
+            bins.append(i)
+            current = width + 1
+    bins.append(len(widths))
+    return bins
+
+
+def render_table(df: pd.DataFrame, line_width: int = LINE_WIDTH) -> str:
+    """
+    Lay out a date-indexed frame of ints as text, wrapping columns to
+    `line_width` with a separator line under each header row
+    """
+    index = np.asarray(df.index, dtype=str)
+    index_width = int(np.char.str_len(index).max())
+    index = np.char.ljust(np.concatenate([[""], index]), index_width)
+
+    columns = []
+    for name in df.columns:
+        column = np.concatenate(
+            [[COLUMN_NAMES.get(name, name)], format_thousands(df[name].to_numpy())]
+        )
+        columns.append(np.char.rjust(column, int(np.char.str_len(column).max())))
+
+    bins = _bins([len(i[0]) for i in columns], line_width - index_width - 1)
+    blocks = []
+    start = 0
+    for i, end in enumerate(bins):
+        cells = [index] + columns[start:end]
+        if len(bins) > 1:
+            # Marks that the table continues below
+            last = i == len(bins) - 1
+            cells.append(np.full(len(index), " " if last else "  "))
+            if not last:
+                cells[-1][0] = " \\"
+        lines = [" ".join(row) for row in zip(*cells)]
+        blocks.append(lines)
+        start = end
+
+    # Separator lines are as wide as the first header row
+    separator = "-" * len(blocks[0][0])
+    return "\n\n".join("\n".join([lines[0], separator] + lines[1:]) for lines in blocks)
+
+
+def render_sections(sections: Iterable[Tuple[Optional[str], pd.DataFrame]]) -> str:
+    """Render (title, frame) pairs one after another, skipping empty frames"""
+    ans = []
+    for title, df in sections:
+        if len(df) == 0:
+            continue
+        ans.append(
+            render_table(df) if title is None else f"{title}\n\n{render_table(df)}"
+        )
+
+    if len(ans) == 0:
+        return "No data for this date range"
+    return "\n\n\n".join(ans)
+
+
+class RenderCache:
+    """
+    Rendered tables keyed by query and data version, dropping the least
+    recently used past `maxsize`
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        # Handlers run in a thread pool
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self.lock:
+            ans = self.entries.get(key)
+            if ans is not None:
+                self.entries.move_to_end(key)
+        metrics.record_cache_lookup("ascii", ans is not None)
+        return ans
+
+    def put(self, key: Hashable, value: str):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
@@ -0,0 +1,253 @@
+"""
+Opt-in per-request profiling for diagnosing slow queries in production.
+
+Disabled unless the `PROFILING_TOKEN` environment variable is set. When it
+is, a request is profiled if it carries the token in an `X-Profile` header or
+a `profile` query param, e.g.
+
+    $ curl -H "X-Profile: $PROFILING_TOKEN" "$API/detailed?state=allstates"
+
+The response then has an `X-Profile-Id` header, and the report can be
+fetched from `/debug/profiles/<id>` using the same token. A fraction of
+ordinary requests can also be sampled with `PROFILE_SAMPLE_RATE`; the slowest
+`PROFILE_KEEP_SLOWEST` sampled profiles are kept in `PROFILE_DIR` together
+with a `slowest.json` index for later analysis.
+
+Handlers run under pyinstrument if it is installed, otherwise cProfile.
+Profiles only cover the handler itself, not JSON encoding of the response.
+
+When disabled, `profiled` returns handlers unchanged and `install` adds
+nothing to the app, so profiling costs nothing.
+"""
+
+import contextvars
+import functools
+import heapq
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from covidapi import accesslog
+
+if TYPE_CHECKING:
+    import pstats
+
+PROFILING_TOKEN: Optional[str] = os.environ.get("PROFILING_TOKEN") or None
+ENABLED: bool = PROFILING_TOKEN is not None
+
+PROFILE_DIR = Path(
+    os.environ.get("PROFILE_DIR", Path(tempfile.gettempdir()) / "covidapi-profiles")
+)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP_SLOWEST = int(os.environ.get("PROFILE_KEEP_SLOWEST", "10"))
+PROFILER = os.environ.get("PROFILER", "auto")  # auto, pyinstrument or cprofile
+
+
+class _RequestProfile:
+    """Profile state for one request, shared between middleware and handler"""
+
+    def __init__(self, requested: bool):
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.requested = requested
+        self.active = False
+        self.report: Optional[str] = None
+        self.stats: Optional["pstats.Stats"] = None
+
+
+_current_profile: contextvars.ContextVar = contextvars.ContextVar(
+    "current_profile", default=None
+)
+
+
+def _use_pyinstrument() -> bool:
+    if PROFILER == "cprofile":
+        return False
+    try:
+        import pyinstrument  # noqa: F401
+    except ImportError:
+        if PROFILER == "pyinstrument":
+            raise
+        return False
+    return True
+
+
+def _run_profiled(fn: Callable, profile: _RequestProfile, args, kwargs):
+    if _use_pyinstrument():
+        from pyinstrument import Profiler
+
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.stop()
+            profile.report = profiler.output_text(unicode=False, color=False)
+    else:
+        # Not imported unless profiling, which is off by default
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            buf = io.StringIO()
+            stats = pstats.Stats(profiler, stream=buf)
+            stats.sort_stats("cumulative").print_stats(40)
+            profile.stats = stats
+            profile.report = buf.getvalue()
+
+
+def profiled(fn: Callable) -> Callable:
+    """
+    Decorator for route handlers, runs the handler under a profiler when the
+    current request asked for it. Returns `fn` unchanged when disabled.
+    """
+    if not ENABLED:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profile = _current_profile.get()
+        # Handlers calling other handlers e.g. /ascii or allstates recursion
+        # are covered by the outermost profile
+        if profile is None or profile.active:
+            return fn(*args, **kwargs)
+
+        profile.active = True
+        try:
+            return _run_profiled(fn, profile, args, kwargs)
+        finally:
+            profile.active = False
+
+    return wrapper
+
+
+class ProfileStore:
+    """
+    Writes profiles to disk, keeping every explicitly requested profile
+    and only the slowest `keep_slowest` of the sampled ones
+    """
+
+    def __init__(self, directory: Path, keep_slowest: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.keep_slowest = keep_slowest
+        # Min-heap of (duration, profile_id, request info) for sampled profiles
+        self._slowest: List[Tuple[float, str, dict]] = []
+        self._lock = threading.Lock()
+
+    def _paths(self, profile_id: str) -> List[Path]:
+        return [
+            self.directory / f"{profile_id}.txt",
+            self.directory / f"{profile_id}.prof",
+        ]
+
+    def save(self, profile: _RequestProfile, duration: float, info: dict):
+        txt_path, prof_path = self._paths(profile.profile_id)
+        txt_path.write_text(profile.report or "")
+        if profile.stats is not None:
+            profile.stats.dump_stats(prof_path)
+
+        if profile.requested:
+            return
+
+        with self._lock:
+            entry = (duration, profile.profile_id, info)
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, entry)
+                evicted = None
+            else:
+                evicted = heapq.heappushpop(self._slowest, entry)
+
+            if evicted is not None:
+                for i in self._paths(evicted[1]):
+                    i.unlink(missing_ok=True)
+
+            index = [
+                {"profile_id": j, "duration_s": round(i, 6), **k}
+                for i, j, k in sorted(self._slowest, reverse=True)
+            ]
+            (self.directory / "slowest.json").write_text(json.dumps(index, indent=2))
+
+    def load(self, profile_id: str) -> Optional[str]:
+        txt_path = self._paths(profile_id)[0]
+        # Guard against paths sneaking in through the id
+        if txt_path.parent != self.directory or not txt_path.exists():
+            return None
+        return txt_path.read_text()
+
+
+def _token_from(request) -> Optional[str]:
+    return request.headers.get("x-profile") or request.query_params.get("profile")
+
+
+def carries_token(scope: Dict) -> bool:
+    """
+    Whether the request with ASGI `scope` carries a profiling token, valid or
+    not. Such requests need to reach the handler, not a shared response
+    """
+    query = parse_qsl(scope.get("query_string", b"").decode(), keep_blank_values=True)
+    return any(i == "profile" for i, _ in query) or any(
+        i == b"x-profile" for i, _ in scope.get("headers", [])
+    )
+
+
+def install(app):
+    """
+    Add the profiling middleware and `/debug/profiles/{profile_id}` route to
+    `app`. Does nothing unless `PROFILING_TOKEN` is set.
+    """
+    if not ENABLED:
+        return
+
+    from fastapi import HTTPException, Request
+    from fastapi.responses import PlainTextResponse
+
+    store = ProfileStore(PROFILE_DIR, PROFILE_KEEP_SLOWEST)
+    accesslog.log_event("profiling_enabled", profile_dir=str(store.directory))
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        requested = _token_from(request) == PROFILING_TOKEN
+        if not requested and random.random() >= PROFILE_SAMPLE_RATE:
+            return await call_next(request)
+
+        profile = _RequestProfile(requested=requested)
+        _current_profile.set(profile)
+        start = timer()
+        response = await call_next(request)
+        duration = timer() - start
+
+        if profile.report is not None:
+            # Don't keep the token around in stored request info
+            query = {i: j for i, j in request.query_params.items() if i != "profile"}
+            info = {"path": request.url.path, "query": query}
+            store.save(profile, duration, info)
+            if requested:
+                response.headers["X-Profile-Id"] = profile.profile_id
+
+        return response
+
+    @app.get(
+        "/debug/profiles/{profile_id}",
+        response_class=PlainTextResponse,
+        include_in_schema=False,
+    )
+    def return_profile(profile_id: str, request: Request):
+        if _token_from(request) != PROFILING_TOKEN:
+            raise HTTPException(status_code=403)
+        report = store.load(profile_id)
+        if report is None:
+            raise HTTPException(status_code=404)
+        return report
@@ -0,0 +1,294 @@
+"""
+Encoded responses cached per query and data version, in two tiers.
+
+Every App Engine instance (and Heroku dyno) used to start with a cold cache
+and work out the same popular queries again. Responses are now kept as the
+bytes sent, in an LRU in each instance and optionally in a backend shared
+by all of them:
+
++ `LRUBackend`: in-process, bounded by total size, always used
++ `RedisBackend`: anything speaking the Redis protocol, e.g. Memorystore,
+  Heroku Redis or a local `redis-server`. Needs the `redis` package
++ `FileBackend`: a directory of files, for tests and single-host setups
+
+The shared backend is set with `RESPONSE_CACHE`, see `from_spec`. Lookups go
+to the local LRU first, then to the shared backend, whose hits are kept
+locally too. Keys include the data version (see `Dataset.version`), which is
+the same on instances serving the same files, so entries never need to be
+invalidated. They expire after `RESPONSE_CACHE_TTL` seconds in the shared
+backend, and are evicted from the LRU past `RESPONSE_CACHE_MB`.
+
+Many keys are looked up and stored in one round trip (`get_many`,
+`set_many`), pipelined for Redis, so `/batch` fans out to the shared backend
+once rather than once per query.
+
+A shared backend that fails is treated as a miss, responses are still
+served from the local tier or worked out.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from covidapi import metrics, profiling, warmup
+
+RESPONSE_CACHE: str = os.environ.get("RESPONSE_CACHE", "")
+RESPONSE_CACHE_MB = float(os.environ.get("RESPONSE_CACHE_MB", "32"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600)))
+
+# Deployed versions may answer differently, each keeps to its own entries
+NAMESPACE = os.environ.get("GAE_VERSION", "")
+
+# GET endpoints whose JSON responses only depend on the query and the data
+CACHED_PATHS = ("/", "/detailed", "/derived", "/linelist/deaths")
+
+
+def make_key(version: str, path: str, params: Dict[str, str]) -> str:
+    """Key of the response to `path` with query `params` on data `version`"""
+    return f"covidapi:{NAMESPACE}:{version}:{path}?{urlencode(sorted(params.items()))}"
+
+
+class CacheBackend:
+    """Stores bytes by string key"""
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """Value of each of `keys`, None where missing"""
+        raise NotImplementedError
+
+    def set_many(self, items: Dict[str, bytes]):
+        raise NotImplementedError
+
+
+class LRUBackend(CacheBackend):
+    """In-process, dropping the least recently used past `maxbytes` in total"""
+
+    def __init__(self, maxbytes: int):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        # Handlers run in a thread pool
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        ans = []
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                ans.append(value)
+        return ans
+
+    def set_many(self, items: Dict[str, bytes]):
+        with self.lock:
+            for key, value in items.items():
+                if len(value) > self.maxbytes:
+                    continue
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= len(old)
+                self.entries[key] = value
+                self.nbytes += len(value)
+            while self.nbytes > self.maxbytes:
+                _, value = self.entries.popitem(last=False)
+                self.nbytes -= len(value)
+
+
+class FileBackend(CacheBackend):
+    """A file per key in `path`, expiring `ttl` seconds after being written"""
+
+    def __init__(self, path, ttl: int = RESPONSE_CACHE_TTL):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+
+    def _fp(self, key: str) -> Path:
+        return self.path / hashlib.sha256(key.encode()).hexdigest()
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        ans = []
+        for key in keys:
+            fp = self._fp(key)
+            try:
+                if time.time() - fp.stat().st_mtime > self.ttl:
+                    ans.append(None)
+                    continue
+                ans.append(fp.read_bytes())
+            except OSError:
+                ans.append(None)
+        return ans
+
+    def set_many(self, items: Dict[str, bytes]):
+        for key, value in items.items():
+            fp = self._fp(key)
+            # Written whole then moved into place, readers never see half
+            tmp_fp = fp.with_name(f"{fp.name}.{threading.get_ident()}.tmp")
+            tmp_fp.write_bytes(value)
+            os.replace(tmp_fp, fp)
+
+
+class RedisBackend(CacheBackend):
+    """A Redis-protocol server at `url`, e.g. "redis://localhost:6379/0" """
+
+    def __init__(self, url: str, ttl: int = RESPONSE_CACHE_TTL):
+        # Only needed here, and only installed where there's a server
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        return pipe.execute()
+
+    def set_many(self, items: Dict[str, bytes]):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(key, value, ex=self.ttl)
+        pipe.execute()
+
+
+def from_spec(spec: str) -> Optional[CacheBackend]:
+    """
+    Shared backend described by `spec`, None if empty:
+
+    + "redis://...", "rediss://..." or "unix://..." for `RedisBackend`
+    + "file:<dir>" for `FileBackend`
+    """
+    if spec == "":
+        return None
+    kind, _, location = spec.partition(":")
+    if kind in ["redis", "rediss", "unix"]:
+        return RedisBackend(spec)
+    elif kind == "file" and len(location) > 0:
+        return FileBackend(location)
+    raise ValueError(f"Unknown response cache {spec!r}")
+
+
+class TieredCache:
+    """Looks up `local` first, then `shared` if there is one"""
+
+    def __init__(self, local: CacheBackend, shared: Optional[CacheBackend] = None):
+        self.local = local
+        self.shared = shared
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        ans = self.local.get_many(keys)
+        for i in ans:
+            metrics.record_cache_lookup("response", i is not None)
+
+        missing = [i for i, j in enumerate(ans) if j is None]
+        if self.shared is None or len(missing) == 0:
+            return ans
+
+        try:
+            found = self.shared.get_many([keys[i] for i in missing])
+        except Exception as e:
+            print(f"Failed to read from the shared response cache: {e!r}")
+            found = [None] * len(missing)
+
+        hits = {}
+        for i, value in zip(missing, found):
+            metrics.record_cache_lookup("response_shared", value is not None)
+            if value is not None:
+                ans[i] = hits[keys[i]] = value
+        self.local.set_many(hits)
+        return ans
+
+    def set_many(self, items: Dict[str, bytes]):
+        self.local.set_many(items)
+        if self.shared is None:
+            return
+        try:
+            self.shared.set_many(items)
+        except Exception as e:
+            print(f"Failed to write to the shared response cache: {e!r}")
+
+
+def from_env() -> TieredCache:
+    """Cache configured by `RESPONSE_CACHE` and `RESPONSE_CACHE_MB`"""
+    return TieredCache(
+        LRUBackend(int(RESPONSE_CACHE_MB * 1e6)), from_spec(RESPONSE_CACHE)
+    )
+
+
+class ResponseCacheMiddleware:
+    """
+    ASGI middleware answering GETs for `paths` from `cache`, keyed by
+    `key(path, params)`. Only 200s are stored. Requests carrying a profiling
+    token, and warm-up requests, always reach the handler.
+    """
+
+    def __init__(
+        self,
+        app,
+        cache: TieredCache,
+        key: Callable[[str, Dict[str, str]], str],
+        paths: Tuple[str, ...] = CACHED_PATHS,
+    ):
+        self.app = app
+        self.cache = cache
+        self.key = key
+        self.paths = set(paths)
+
+    async def _call(self, fn, *args):
+        # Shared backends do network or disk I/O, keep it off the event loop
+        if self.cache.shared is None:
+            return fn(*args)
+        from starlette.concurrency import run_in_threadpool
+
+        return await run_in_threadpool(fn, *args)
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or scope["path"] not in self.paths
+            or profiling.carries_token(scope)
+            or warmup.is_warmup(scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        params = dict(parse_qsl(scope["query_string"].decode(), keep_blank_values=True))
+        key = self.key(scope["path"], params)
+        (body,) = await self._call(self.cache.get_many, [key])
+        if body is not None:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-length", str(len(body)).encode()),
+                        (b"content-type", b"application/json"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        status = []
+        body_parts = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            elif message["type"] == "http.response.body":
+                body_parts.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive, capture)
+        if status == [200]:
+            await self._call(self.cache.set_many, {key: b"".join(body_parts)})
+
+
+def install(app, cache: TieredCache, key: Callable[[str, Dict[str, str]], str]):
+    """Answer GETs to `app` from `cache` where possible"""
+    app.add_middleware(ResponseCacheMiddleware, cache=cache, key=key)
@@ -0,0 +1,308 @@
+"""
+Where the source data is loaded from.
+
+Every source reads the same tables by name, from somewhere different:
+
++ `BucketSource`: the CSVs the refresh Cloud Function uploads to the data
+bucket, read over HTTP. Used on App Engine.
++ `GitSource`: clones of the MOH and CITF repos. Used on Heroku.
++ `LocalSource`: a directory laid out like the bucket, e.g. the bundled
+fixture dataset in `fixtures/data`, for tests and benchmarks without network.
++ `SnapshotSource`: tables already parsed, pickled by `write_snapshot`.
+Quickest to start from.
+
+`from_spec` picks one from a string such as "bucket", "git:/var/cache/covid",
+"local:fixtures/data" or "snapshot:/tmp/snapshot.pkl", which the app reads
+from the `DATA_SOURCE` environment variable.
+"""
+
+import io
+import json
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from covidapi import linelist, manifest
+
+BUCKET_URL = "https://storage.googleapis.com/msia-covid-api-data-bucket/"
+# Reads of a bucket file before giving up on it matching the manifest
+READ_ATTEMPTS = 2
+REPO_URLS = {
+    manifest.MOH_REPO: "https://github.com/MoH-Malaysia/covid19-public",
+    manifest.CITF_REPO: "https://github.com/CITF-Malaysia/citf-public",
+}
+
+# Table name: (repo, path in repo). The bucket keeps each file by its name
+FILES: Dict[str, Tuple[str, str]] = {
+    "cases_malaysia": (manifest.MOH_REPO, "epidemic/cases_malaysia.csv"),
+    "cases_state": (manifest.MOH_REPO, "epidemic/cases_state.csv"),
+    "deaths_malaysia": (manifest.MOH_REPO, "epidemic/deaths_malaysia.csv"),
+    "deaths_state": (manifest.MOH_REPO, "epidemic/deaths_state.csv"),
+    "tests_malaysia": (manifest.MOH_REPO, "epidemic/tests_malaysia.csv"),
+    "tests_state": (manifest.MOH_REPO, "epidemic/tests_state.csv"),
+    "hospital_state": (manifest.MOH_REPO, "epidemic/hospital.csv"),
+    "icu_state": (manifest.MOH_REPO, "epidemic/icu.csv"),
+    "pkrc_state": (manifest.MOH_REPO, "epidemic/pkrc.csv"),
+    "vax_malaysia": (manifest.CITF_REPO, "vaccination/vax_malaysia.csv"),
+    "vax_state": (manifest.CITF_REPO, "vaccination/vax_state.csv"),
+    "checkin_malaysia": (manifest.MOH_REPO, "mysejahtera/checkin_malaysia.csv"),
+    "checkin_malaysia_time": (
+        manifest.MOH_REPO,
+        "mysejahtera/checkin_malaysia_time.csv",
+    ),
+    "checkin_state": (manifest.MOH_REPO, "mysejahtera/checkin_state.csv"),
+    "trace_malaysia": (manifest.MOH_REPO, "mysejahtera/trace_malaysia.csv"),
+    "vaxreg_malaysia": (manifest.CITF_REPO, "registration/vaxreg_malaysia.csv"),
+    "vaxreg_state": (manifest.CITF_REPO, "registration/vaxreg_state.csv"),
+}
+
+# Cube name: (repo, path of the linelist it is built from). Cubes are built by
+# the refresh function, see covidapi/linelist.py, and kept as "<name>.csv"
+CUBES: Dict[str, Tuple[str, str]] = {
+    "deaths_cube": (manifest.MOH_REPO, "epidemic/linelist/linelist_deaths.csv"),
+}
+
+
+def file_name(name: str) -> str:
+    """Name of the file holding table or cube `name` in the bucket"""
+    if name in CUBES:
+        return f"{name}.csv"
+    return Path(FILES[name][1]).name
+
+
+def read_csv(fp) -> pd.DataFrame:
+    return pd.read_csv(fp, index_col=0, parse_dates=[0])
+
+
+class DataSource:
+    """Reads source tables and cubes by name, see `FILES` and `CUBES`"""
+
+    def read(self, name: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def pushed_at(self) -> Dict[str, str]:
+        """When each repo was last pushed to, leaving out those unknown"""
+        return {}
+
+    def file_hashes(self) -> Dict[str, str]:
+        """
+        What identifies the content of the files tables are read from, e.g.
+        their hashes as published. Empty if unknown
+        """
+        return {}
+
+    def read_object(self, name: str) -> Optional[bytes]:
+        """
+        Object `name` published next to the tables, e.g. the static answers
+        in `covidapi/static.py`. None if missing or the source has none
+        """
+        return None
+
+    def object_url(self, name: str) -> Optional[str]:
+        """Public URL of object `name`, None if the source has none"""
+        return None
+
+
+class BucketSource(DataSource):
+    def __init__(self, base_url: str = BUCKET_URL):
+        self.base_url = base_url
+        self._manifest: Optional[Dict] = None
+
+    def manifest(self) -> Dict:
+        """The manifest published with the data, read once"""
+        if self._manifest is None:
+            self._manifest = manifest.fetch_manifest(
+                self.base_url + manifest.MANIFEST_NAME
+            )
+        return self._manifest
+
+    def read(self, name: str) -> pd.DataFrame:
+        # A cached copy older than the manifest, or a refresh after it was
+        # read, would otherwise be served under the manifest's version
+        expected = self.file_hashes().get(file_name(name))
+        for _ in range(READ_ATTEMPTS):
+            body = self._get(file_name(name))
+            if expected is None or manifest.md5_hash(body) == expected:
+                return read_csv(io.BytesIO(body))
+        raise ValueError(f"{file_name(name)} doesn't match the manifest")
+
+    def pushed_at(self) -> Dict[str, str]:
+        return manifest.pushed_at(self.manifest())
+
+    def file_hashes(self) -> Dict[str, str]:
+        return manifest.file_hashes(self.manifest())
+
+    def _get(self, name: str) -> bytes:
+        # Same as reading the manifest, without requests
+        import urllib.request
+
+        with urllib.request.urlopen(
+            self.object_url(name), timeout=manifest.TIMEOUT
+        ) as resp:
+            return resp.read()
+
+    def read_object(self, name: str) -> Optional[bytes]:
+        try:
+            return self._get(name)
+        except OSError:
+            return None
+
+    def object_url(self, name: str) -> Optional[str]:
+        return self.base_url + name
+
+
+class LocalSource(DataSource):
+    """A directory of CSVs laid out like the bucket, manifest included"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self, name: str) -> pd.DataFrame:
+        return read_csv(self.path / file_name(name))
+
+    def manifest(self) -> Dict:
+        try:
+            with open(self.path / manifest.MANIFEST_NAME, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read manifest from {self.path}: {e}")
+            return {}
+
+    def pushed_at(self) -> Dict[str, str]:
+        return manifest.pushed_at(self.manifest())
+
+    def file_hashes(self) -> Dict[str, str]:
+        return manifest.file_hashes(self.manifest())
+
+    def read_object(self, name: str) -> Optional[bytes]:
+        try:
+            return (self.path / name).read_bytes()
+        except OSError:
+            return None
+
+
+class GitSource(DataSource):
+    """
+    Shallow clones of the source repos, in `path` if given or temp dirs
+    otherwise. Clones already in `path` are fetched up to date instead of
+    cloned again, unless `update` is False. `updated` is whether all of them
+    are.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        repo_urls: Optional[Dict[str, str]] = None,
+        update: bool = True,
+    ):
+        # Only needed here, and not installed on App Engine
+        import git
+
+        if repo_urls is None:
+            repo_urls = REPO_URLS
+
+        if path is None:
+            # Cleaned up along with the source
+            self.tempdir = tempfile.TemporaryDirectory()
+            path = self.tempdir.name
+
+        self.repos = {}
+        self.updated = True
+        for repo, url in repo_urls.items():
+            fp = Path(path) / repo.split("/")[1]
+            if not (fp / ".git").exists():
+                self.repos[repo] = git.Repo.clone_from(url, fp, depth=1)
+                continue
+
+            self.repos[repo] = git.Repo(fp)
+            if not update:
+                self.updated = False
+                continue
+            try:
+                branch = self.repos[repo].active_branch.name
+                self.repos[repo].git.fetch("--depth=1", "origin", branch)
+                self.repos[repo].git.reset("--hard", "FETCH_HEAD")
+            except git.GitCommandError as e:
+                print(f"Failed to fetch {repo}, reading the clone as it is: {e}")
+                self.updated = False
+
+    def read(self, name: str) -> pd.DataFrame:
+        if name in CUBES:
+            repo, path = CUBES[name]
+            return linelist.build_cube(Path(self.repos[repo].working_dir) / path)
+        repo, path = FILES[name]
+        return read_csv(Path(self.repos[repo].working_dir) / path)
+
+    def pushed_at(self) -> Dict[str, str]:
+        return {
+            i: j.commit().committed_datetime.isoformat() for i, j in self.repos.items()
+        }
+
+    def file_hashes(self) -> Dict[str, str]:
+        # Every file is read from these commits
+        return {i: j.commit().hexsha for i, j in self.repos.items()}
+
+
+class SnapshotSource(DataSource):
+    """Tables pickled by `write_snapshot`, all read at once"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+        # Snapshots from before file hashes were kept have none
+        self.tables, self.times, self.hashes = (*snapshot, {})[:3]
+
+    def read(self, name: str) -> pd.DataFrame:
+        return self.tables[name]
+
+    def pushed_at(self) -> Dict[str, str]:
+        return self.times
+
+    def file_hashes(self) -> Dict[str, str]:
+        return self.hashes
+
+
+def write_snapshot(
+    path,
+    tables: Dict[str, pd.DataFrame],
+    pushed_at: Dict[str, str],
+    file_hashes: Optional[Dict[str, str]] = None,
+):
+    """Pickle `tables` to `path` for `SnapshotSource`, replacing it atomically"""
+    path = Path(path)
+    tmp_fp = path.with_name(path.name + ".tmp")
+    with open(tmp_fp, "wb") as f:
+        pickle.dump(
+            (tables, pushed_at, file_hashes or {}),
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp_fp, path)
+
+
+def from_spec(spec: str, update: bool = True) -> DataSource:
+    """
+    Source described by `spec`, "<kind>" or "<kind>:<location>":
+
+    + "bucket" or "bucket:<base url>"
+    + "git" to clone to temp dirs, or "git:<dir>" to keep clones in <dir>,
+      fetched up to date unless `update` is False
+    + "local:<dir>"
+    + "snapshot:<file>"
+    """
+    kind, _, location = spec.partition(":")
+    location: Optional[str] = location if len(location) > 0 else None
+
+    if kind == "bucket":
+        return BucketSource(BUCKET_URL if location is None else location)
+    elif kind == "git":
+        return GitSource(location, update=update)
+    elif kind == "local" and location is not None:
+        return LocalSource(location)
+    elif kind == "snapshot" and location is not None:
+        return SnapshotSource(location)
+    raise ValueError(f"Unknown data source {spec!r}")
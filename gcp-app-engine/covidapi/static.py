@@ -0,0 +1,232 @@
+"""
+Static answers for the default dates, published next to the data.
+
+Most traffic is `/` and `/detailed` for the default dates (the past five
+days), nationally, for a state or for all states. Their answers only change
+when upstream pushes, or when the dates move on at midnight in KL. After each
+refresh the Cloud Function works them out with the API's own code (see
+`covidapi/answers.py`) and publishes them, gzipped, to the bucket:
+
+    static/<code version>/<data version>/<last date>/<summary|detailed>/<state>.json
+
+with "national" for the national answers. Names include the version of the
+code answering (see `answers.code_version`), the data version (see
+`Dataset.version`) and the last of the default dates, so a published object
+never changes and can be cached for long. An API deployed with code that
+answers differently from the function's looks for names that aren't there,
+and works answers out itself until the function is deployed too. Answers are published for
+today's and tomorrow's default dates in KL, so the rollover at midnight is
+covered until the next refresh.
+
+The API answers queries with no params besides `state` from these, as set by
+`STATIC_RESPONSES`:
+
++ "proxy" (default): read from the data source and sent as is, then kept in
+  the response cache (see `covidapi/responsecache.py`)
++ "redirect": redirect to the object's public URL in the bucket, falling
+  back to "proxy" for sources without one
++ "off": always work out answers
+
+Objects not published, e.g. for data loaded from git, are only looked for
+once per instance before the API goes back to working answers out. Warm-up
+requests (see `covidapi/warmup.py`) always reach the handlers.
+"""
+
+import datetime
+import gzip
+import os
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import pandas as pd
+
+from covidapi import answers, metrics, profiling, warmup
+from covidapi.answers import MsianState
+from covidapi.dataset import Dataset
+from covidapi.sources import DataSource
+
+STATIC_RESPONSES = os.environ.get("STATIC_RESPONSES", "proxy")
+
+STATIC_DIR = "static"
+# Published answers for each path, worked out by these
+STATIC_PATHS = {"/": "summary", "/detailed": "detailed"}
+ANSWERS = {"/": answers.summary, "/detailed": answers.detailed}
+# Days after today to publish answers for, in KL
+DAYS_AHEAD = [0, 1]
+# Of the code deployed with this copy of covidapi
+CODE_VERSION = answers.code_version()
+
+
+def object_name(
+    version: str,
+    end_date: datetime.date,
+    path: str,
+    state: Optional[str],
+    code_version: str = CODE_VERSION,
+) -> str:
+    """
+    Name of the published answer to `path` for `state` or nationally, on data
+    `version`, worked out by code `code_version`
+    """
+    state = "national" if state is None else state
+    kind = STATIC_PATHS[path]
+    return f"{STATIC_DIR}/{code_version}/{version}/{end_date}/{kind}/{state}.json"
+
+
+def locate(
+    version: str,
+    path: str,
+    params: Dict[str, str],
+    now: Optional[pd.Timestamp] = None,
+) -> Optional[str]:
+    """Name of the published answer to a query, None if it can't have one"""
+    if path not in STATIC_PATHS or not set(params) <= {"state"}:
+        return None
+    state = params.get("state")
+    if state is not None and state not in {i.value for i in MsianState}:
+        return None
+    _, end_date = answers.default_dates(None, None, now)
+    return object_name(version, end_date, path, state)
+
+
+def build(data: Dataset, now: pd.Timestamp) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yields (name, encoded answer) for every published answer for the default
+    dates at `now`
+    """
+    start_date, end_date = answers.default_dates(None, None, now)
+    for path, answer in ANSWERS.items():
+        for state in [None] + list(MsianState):
+            content = answer(data, start_date, end_date, state)
+            name = object_name(
+                data.version, end_date, path, None if state is None else state.value
+            )
+            yield name, answers.encode(content)
+
+
+def decode(body: bytes) -> bytes:
+    """Published answer as sent by the API, whether still gzipped or not"""
+    if body[:2] == b"\x1f\x8b":
+        return gzip.decompress(body)
+    return body
+
+
+class StaticResponses:
+    """
+    Finds published answers in the data source, remembering which aren't
+
+    Args
+    ----
+    version: returns the version of the data served
+    source: returns the source the data served was loaded from
+    mode: see `STATIC_RESPONSES`
+    """
+
+    def __init__(
+        self,
+        version: Callable[[], str],
+        source: Callable[[], DataSource],
+        mode: str = STATIC_RESPONSES,
+    ):
+        self.version = version
+        self.source = source
+        self.mode = mode
+        # Names looked for, and whether they were found
+        self.missing = set()
+        self.found = set()
+        self.lock = threading.Lock()
+
+    def locate(self, path: str, params: Dict[str, str]) -> Optional[str]:
+        """Name of the published answer to a query, if it may have one"""
+        if self.mode == "off":
+            return None
+        name = locate(self.version(), path, params)
+        if name is None or name in self.missing:
+            return None
+        return name
+
+    def read(self, name: str) -> Optional[bytes]:
+        """Published answer `name`, None if there isn't one"""
+        body = self.source().read_object(name)
+        metrics.record_cache_lookup("static", body is not None)
+        with self.lock:
+            (self.missing if body is None else self.found).add(name)
+        return None if body is None else decode(body)
+
+    def url(self, name: str) -> Optional[str]:
+        """
+        Public URL to redirect to for published answer `name`, if redirecting
+        and there is one. Checks it was published the first time
+        """
+        if self.mode != "redirect":
+            return None
+        url = self.source().object_url(name)
+        if url is None or (name not in self.found and self.read(name) is None):
+            return None
+        return url
+
+
+class StaticMiddleware:
+    """ASGI middleware answering GETs from published answers, see module docs"""
+
+    def __init__(self, app, static: StaticResponses):
+        self.app = app
+        self.static = static
+
+    async def __call__(self, scope, receive, send):
+        name = None
+        if (
+            scope["type"] == "http"
+            and scope["method"] == "GET"
+            and not profiling.carries_token(scope)
+            # Warm-up is there to run the handlers
+            and not warmup.is_warmup(scope)
+        ):
+            params = dict(
+                parse_qsl(scope["query_string"].decode(), keep_blank_values=True)
+            )
+            name = self.static.locate(scope["path"], params)
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        from starlette.concurrency import run_in_threadpool
+
+        # Reads go over the network for the bucket, keep them off the event loop
+        url = None
+        if self.static.mode == "redirect":
+            url = await run_in_threadpool(self.static.url, name)
+        if url is not None:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 307,
+                    "headers": [(b"location", url.encode()), (b"content-length", b"0")],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        body = None
+        if name not in self.static.missing:
+            body = await run_in_threadpool(self.static.read, name)
+        if body is None:
+            await self.app(scope, receive, send)
+            return
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-length", str(len(body)).encode()),
+                    (b"content-type", b"application/json"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def install(app, static: StaticResponses):
+    """Answer GETs to `app` from answers published by the refresh function"""
+    app.add_middleware(StaticMiddleware, static=static)
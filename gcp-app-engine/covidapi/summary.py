@@ -0,0 +1,165 @@
+"""
+Summary view served by `/`, materialized once per data load.
+
+Joining cases, deaths, vaccination and test data on every request was most
+of the work done by `/`. Instead, the join is done once into a wide table
+keyed by date (national) or (state, date), already in the format it is
+served in (see `covidapi.tables`). A request is then one slice of that table.
+
+The unfilled table is kept alongside for time aggregation, which needs to
+tell missing values apart from real ones.
+"""
+
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+
+from covidapi.aggregation import Granularity, resample_frame
+from covidapi.tables import iso_date, to_served
+
+NATIONAL_COLUMNS = [
+    "cases_new",
+    "deaths_new",
+    "cumul_partial",
+    "cumul_full",
+    "total_tests",
+]
+STATE_COLUMNS = ["cases_new", "deaths_new", "cumul_partial", "cumul_full"]
+
+
+def _latest(df):
+    """`df` without duplicate keys, keeping the last row as tables do"""
+    return df[~df.index.duplicated(keep="last")]
+
+
+class SummaryTable:
+    """
+    Summary data, indexed by date for national data, or by (state, date)
+    for state data.
+
+    Args
+    ----
+    raw: wide table of summary columns, with NaNs where data is missing
+    complete: for state data, flags rows present in all source tables.
+        `allstates` queries only return these rows.
+    """
+
+    def __init__(self, raw: pd.DataFrame, complete: Optional[pd.Series] = None):
+        self.raw = raw
+        self.filled = to_served(raw)
+        self.complete = complete
+        # Changes along with the data, to key caches of rendered answers on
+        self.version = format(int(pd.util.hash_pandas_object(raw).sum()), "x")
+        if isinstance(raw.index, pd.MultiIndex):
+            self.states = set(raw.index.get_level_values("state"))
+
+    @classmethod
+    def national(
+        cls,
+        cases_malaysia: pd.DataFrame,
+        deaths_malaysia: pd.DataFrame,
+        vax_malaysia: pd.DataFrame,
+        tests_malaysia: pd.DataFrame,
+    ) -> "SummaryTable":
+        raw = pd.concat(
+            [
+                _latest(cases_malaysia["cases_new"]),
+                _latest(deaths_malaysia["deaths_new"]),
+                _latest(vax_malaysia[["cumul_partial", "cumul_full"]]),
+                _latest(tests_malaysia["total_tests"]),
+            ],
+            axis="columns",
+        ).sort_index()
+        return cls(raw[NATIONAL_COLUMNS])
+
+    @classmethod
+    def by_state(
+        cls,
+        cases_state: pd.DataFrame,
+        deaths_state: pd.DataFrame,
+        vax_state: pd.DataFrame,
+    ) -> "SummaryTable":
+        def keyed(df: pd.DataFrame, columns) -> pd.DataFrame:
+            return _latest(df.set_index("state", append=True).swaplevel()[columns])
+
+        parts = [
+            keyed(cases_state, ["cases_new"]),
+            keyed(deaths_state, ["deaths_new"]),
+            keyed(vax_state, ["cumul_partial", "cumul_full"]),
+        ]
+        raw = pd.concat(parts, axis="columns").sort_index()
+        raw.index.names = ["state", "date"]
+
+        # Rows that an inner join of the source tables would give
+        complete = pd.Series(True, index=raw.index)
+        for i in parts:
+            complete &= raw.index.isin(i.index)
+
+        return cls(raw[STATE_COLUMNS], complete)
+
+    def _key(self, state: Optional[str], start_date, end_date):
+        dates = slice(start_date, end_date)
+        if not isinstance(self.raw.index, pd.MultiIndex):
+            return dates
+        return (slice(None) if state is None else state, dates)
+
+    def _select(
+        self,
+        state: Optional[str],
+        start_date,
+        end_date,
+        granularity: Granularity,
+        only_complete: bool = False,
+    ) -> pd.DataFrame:
+        # Rows of the raw and filled tables line up, so the raw key also
+        # picks out the matching rows of `complete`
+        raw_key = self._key(state, pd.Timestamp(start_date), pd.Timestamp(end_date))
+        if granularity == Granularity.day:
+            ans = self.filled.loc[
+                self._key(state, iso_date(start_date), iso_date(end_date)), :
+            ]
+        else:
+            ans = self.raw.loc[raw_key, :]
+        if only_complete:
+            ans = ans[self.complete.loc[raw_key].to_numpy()]
+        if granularity == Granularity.day:
+            return ans
+
+        if isinstance(ans.index, pd.MultiIndex):
+            ans = ans.groupby(level="state").apply(
+                lambda x: resample_frame(x.droplevel("state"), granularity)
+            )
+        else:
+            ans = resample_frame(ans, granularity)
+        return to_served(ans)
+
+    def select(
+        self,
+        start_date,
+        end_date,
+        granularity: Granularity = Granularity.day,
+        state: Optional[str] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns rows between `start_date` and `end_date` as a date-indexed
+        frame, for `state` if given
+        """
+        if state is not None and state not in self.states:
+            return self.filled.iloc[0:0].droplevel("state")
+
+        ans = self._select(state, start_date, end_date, granularity)
+        return ans.droplevel("state") if isinstance(ans.index, pd.MultiIndex) else ans
+
+    def select_allstates(
+        self,
+        start_date,
+        end_date,
+        granularity: Granularity = Granularity.day,
+    ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """
+        Yields (state, date-indexed frame) for states with data between
+        `start_date` and `end_date`, in order of state name
+        """
+        ans = self._select(None, start_date, end_date, granularity, only_complete=True)
+        for statename, state_ans in ans.groupby(level="state", sort=False):
+            yield statename, state_ans.droplevel("state")
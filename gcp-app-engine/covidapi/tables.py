@@ -0,0 +1,270 @@
+"""
+Data tables, kept in the format they are served in.
+
+Responses are keyed by ISO date strings, with NaNs returned as -9999 and
+numbers as ints. Doing that conversion on every request meant a Python
+callback per row to turn timestamps into dates, plus fillna and astype on
+freshly sliced copies. Instead, each table is converted once when loaded,
+and requests slice the converted table directly.
+
+The raw table is kept alongside for time aggregation, which needs to tell
+missing values apart from real ones.
+
+State tables interleave all states by date. They are sorted once by state
+then date, so each state's rows are contiguous. A (state, date range) query
+is then two `searchsorted` calls on that state's dates, and the answer is a
+slice of the table rather than a filtered copy.
+
+Larger tables can be kept compact, see `downcast`: both the raw and served
+tables hold numbers in the smallest int type that fits them. They are served
+as the same JSON, and widened again before time aggregation.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from covidapi import accesslog
+from covidapi.aggregation import Granularity, resample_frame
+
+
+def iso_date(date) -> str:
+    """Format a date as a "YYYY-MM-DD" string, to slice served tables with"""
+    return pd.Timestamp(date).strftime("%Y-%m-%d")
+
+
+def iso_dates(index: pd.Index) -> pd.Index:
+    """
+    Format a DatetimeIndex as "YYYY-MM-DD" strings, vectorized. For a
+    MultiIndex, the last level is taken to be the date.
+    """
+    if isinstance(index, pd.MultiIndex):
+        return index.set_levels(iso_dates(index.levels[-1]), level=-1)
+    return pd.Index(np.datetime_as_string(index.values, unit="D"), name=index.name)
+
+
+def fill(df: pd.DataFrame, int_columns: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Replace NaNs with -9999 and cast `int_columns` to int, defaulting to all
+    numeric columns. Non-numeric columns e.g. `state` are left alone.
+    """
+    if int_columns is None:
+        int_columns = df.select_dtypes("number").columns
+    # Rather return an obviously wrong answer than return ambiguous 0
+    numeric = df.select_dtypes("number").columns
+    ans = df.fillna({i: -9999 for i in numeric})
+    return ans.astype({i: int for i in int_columns})
+
+
+def downcast(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    `df` in the smallest dtypes holding its values: `state` as a category,
+    ints downcast, and floats that are all whole numbers or NaN as nullable
+    ints. Other floats are left as they are.
+    """
+    ans = {}
+    for name, column in df.items():
+        if name == "state":
+            column = column.astype("category")
+        elif pd.api.types.is_float_dtype(column):
+            values = column.dropna()
+            if (values == values.round()).all():
+                column = pd.to_numeric(column.astype("Int64"), downcast="integer")
+        elif pd.api.types.is_integer_dtype(column):
+            column = pd.to_numeric(column, downcast="integer")
+        ans[name] = column
+    return pd.DataFrame(ans, index=df.index)
+
+
+def to_served(
+    df: pd.DataFrame, int_columns: Optional[Iterable[str]] = None
+) -> pd.DataFrame:
+    """Convert a date-indexed frame to the format it is served in"""
+    ans = fill(df, int_columns)
+    ans.index = iso_dates(ans.index)
+    return ans
+
+
+def state_offsets(states: np.ndarray) -> Dict[str, Tuple[int, int]]:
+    """(start, stop) rows of each state in `states`, grouped by state"""
+    if len(states) == 0:
+        return {}
+    starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]])
+    stops = np.r_[starts[1:], len(states)]
+    return {states[i]: (i, j) for i, j in zip(starts, stops)}
+
+
+def date_rows(dates: np.ndarray, lo: int, hi: int, start_date, end_date) -> slice:
+    """Rows between `start_date` and `end_date` of `dates[lo:hi]`, sorted"""
+    dates = dates[lo:hi]
+    start = dates.searchsorted(pd.Timestamp(start_date).to_datetime64(), "left")
+    end = dates.searchsorted(pd.Timestamp(end_date).to_datetime64(), "right")
+    return slice(lo + start, lo + max(start, end))
+
+
+class Table:
+    """
+    One table of data, indexed by date. State tables have a `state` column,
+    which is moved out of the stored tables into per-state row offsets.
+
+    Args
+    ----
+    df: table as read from the data repos, indexed by date
+    int_columns: columns served as int, defaults to all numeric columns
+    compact: keep the raw and served tables in the smallest int types that
+        fit, see `downcast`
+    name: name of the table, for its aggregation policy, see
+        `aggregation.aggregation_for`
+
+    Raises
+    ------
+    ValueError if the table isn't indexed by valid dates
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        int_columns: Optional[Iterable[str]] = None,
+        compact: bool = False,
+        name: Optional[str] = None,
+    ):
+        if not isinstance(df.index, pd.DatetimeIndex) or df.index.hasnans:
+            raise ValueError("Tables need to be indexed by dates, without blanks")
+
+        self.int_columns = int_columns
+        self.name = name
+        self.by_state = "state" in df.columns
+
+        # Rows sorted by date, then grouped by state
+        df = df.sort_index(kind="stable")
+        if self.by_state:
+            df = df.sort_values("state", kind="stable")
+            keys = pd.MultiIndex.from_arrays([df["state"], df.index])
+        else:
+            keys = df.index
+
+        # Can't be served keyed by date, keep the latest row
+        duplicated = keys.duplicated(keep="last")
+        self.dropped = int(duplicated.sum())
+        if self.dropped > 0:
+            accesslog.log_event("duplicate_dates", table=name, dropped=self.dropped)
+            df = df[~duplicated]
+
+        # Row offsets of each state, the whole table for national tables
+        if self.by_state:
+            self.offsets: Dict[Optional[str], Tuple[int, int]] = state_offsets(
+                df["state"].to_numpy()
+            )
+            df = df.drop(columns="state")
+        else:
+            self.offsets = {None: (0, len(df))}
+
+        self.raw = df
+        self.served = to_served(df, int_columns)
+        if compact:
+            self.raw = downcast(self.raw)
+            self.served = downcast(self.served)
+        self.columns = df.columns.unique()
+        self.dates = df.index.to_numpy()
+
+    @property
+    def states(self) -> List[str]:
+        return sorted(i for i in self.offsets if i is not None)
+
+    def rows(self, start_date, end_date, state: Optional[str] = None) -> slice:
+        """Rows between `start_date` and `end_date` for `state`"""
+        if state not in self.offsets:
+            return slice(0, 0)
+
+        return date_rows(self.dates, *self.offsets[state], start_date, end_date)
+
+    def select(
+        self,
+        start_date,
+        end_date,
+        state: Optional[str] = None,
+        granularity: Granularity = Granularity.day,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Returns rows between `start_date` and `end_date` in served format.
+        State tables need a `state`, and are returned without the `state`
+        column. If `columns` is given, only those columns are returned.
+        """
+        if self.by_state and state is None:
+            raise ValueError("Select a state from state tables")
+
+        frame = self.served if granularity == Granularity.day else self.raw
+        ans = frame.iloc[self.rows(start_date, end_date, state)]
+        if columns is not None:
+            ans = ans[columns]
+
+        if granularity != Granularity.day:
+            ans = to_served(
+                resample_frame(ans, granularity, self.name), self.int_columns
+            )
+        return ans
+
+    def select_allstates(
+        self, start_date, end_date, granularity: Granularity = Granularity.day
+    ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """
+        Yields (state, frame) for states with rows between `start_date` and
+        `end_date`, in order of state name
+        """
+        for state in self.states:
+            ans = self.select(start_date, end_date, state, granularity)
+            if len(ans) > 0:
+                yield state, ans
+
+
+def _split(param: str) -> List[str]:
+    return [i.strip() for i in param.split(",") if len(i.strip()) > 0]
+
+
+def projection(
+    available: Dict[str, Table],
+    tables: Optional[str] = None,
+    columns: Optional[str] = None,
+) -> Dict[str, Optional[List[str]]]:
+    """
+    Work out which tables and columns to serve from comma-separated `tables`
+    and `columns` query params e.g. "cases_malaysia,vax_malaysia".
+
+    Columns are picked from every selected table that has them, tables with
+    none of the requested columns are left out.
+
+    Returns
+    -------
+    {table name: columns to serve, None for all}, in the order of `available`
+
+    Raises
+    ------
+    ValueError if a table or column isn't in the loaded data
+    """
+    if tables is None:
+        names = list(available)
+    else:
+        names = _split(tables)
+        unknown = [i for i in names if i not in available]
+        if len(unknown) > 0:
+            raise ValueError(
+                f"Unknown tables {unknown}, expected any of {list(available)}"
+            )
+    names = [i for i in available if i in names]
+    if columns is None:
+        return {i: None for i in names}
+
+    wanted = _split(columns)
+    ans = {}
+    for i in names:
+        table_columns = [j for j in available[i].columns if j in wanted]
+        if len(table_columns) > 0:
+            ans[i] = table_columns
+
+    found = {j for i in ans.values() for j in i}
+    unknown = [i for i in wanted if i not in found]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown columns {unknown} for tables {names}")
+    return ans
@@ -0,0 +1,119 @@
+"""
+Warm-up requests sent through the app before it starts serving.
+
+The first request to each endpoint used to be much slower than the rest:
+pandas imports its groupby, merge and formatting code the first time it is
+used, FastAPI works out how to validate params and encode responses on the
+first call, and nothing is cached yet. `run` sends a few requests to each
+endpoint in-process, through routing, validation, the handler and JSON
+encoding, so real requests don't pay for any of that. Responses cached along
+the way (e.g. `/ascii` for the default dates, what watch loops ask for) stay
+cached.
+
+Endpoints warmed up are set with `WARMUP_ENDPOINTS`, comma-separated, all of
+`QUERIES` by default. Set it to "/,/ascii" to only load the summary tables
+before serving (see `covidapi/dataset.py`), or to "" to skip warm-up.
+
+Warm-up requests are left out of request metrics and the access log, see
+`is_warmup`.
+"""
+
+import asyncio
+import os
+import threading
+from timeit import default_timer as timer
+from typing import Dict, List
+from urllib.parse import urlencode
+
+# Queries sent to each endpoint: national, one state and all states
+QUERIES: Dict[str, List[Dict[str, str]]] = {
+    "/": [{}, {"state": "selangor"}, {"state": "allstates"}],
+    "/detailed": [{}, {"state": "selangor"}, {"state": "allstates"}],
+    "/derived": [{}, {"state": "selangor"}, {"state": "allstates"}],
+    "/linelist/deaths": [{}, {"state": "selangor"}, {"state": "allstates"}],
+    "/ascii": [{}],
+}
+
+WARMUP_ENDPOINTS: List[str] = [
+    i.strip()
+    for i in os.environ.get("WARMUP_ENDPOINTS", ",".join(QUERIES)).split(",")
+    if len(i.strip()) > 0
+]
+
+# Set on the ASGI scope of warm-up requests, which clients can't do
+SCOPE_KEY = "covidapi.warmup"
+
+
+def is_warmup(scope: Dict) -> bool:
+    """Whether the request with ASGI `scope` was sent by `run`"""
+    return scope.get(SCOPE_KEY, False)
+
+
+async def _get(app, path: str, query: Dict[str, str]) -> int:
+    """Send a GET request straight to the ASGI `app`, returning the status"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(query).encode(),
+        "root_path": "",
+        "headers": [(b"host", b"warmup")],
+        "client": None,
+        "server": None,
+        SCOPE_KEY: True,
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def _run(app, endpoints: List[str]) -> List[str]:
+    failed = []
+    for path in endpoints:
+        for query in QUERIES.get(path, [{}]):
+            status = await _get(app, path, query)
+            if status != 200:
+                failed.append(f"{path}?{urlencode(query)} ({status})")
+    return failed
+
+
+def run(app, endpoints: List[str] = WARMUP_ENDPOINTS) -> float:
+    """
+    Send warm-up requests for `endpoints` to `app`, waiting for all of them.
+
+    Runs in a thread with its own event loop, so it works whether or not the
+    caller is already in one, e.g. while uvicorn imports the app.
+
+    Returns
+    -------
+    Seconds taken. Requests that fail are printed, not raised, so warm-up
+    never stops the app from starting
+    """
+    start = timer()
+    failed = []
+
+    def warmup():
+        try:
+            failed.extend(asyncio.run(_run(app, endpoints)))
+        except Exception as e:
+            failed.append(repr(e))
+
+    thread = threading.Thread(target=warmup)
+    thread.start()
+    thread.join()
+
+    if len(failed) > 0:
+        print(f"Warm-up requests failed: {', '.join(failed)}")
+    return timer() - start
@@ -3,32 +3,77 @@ from timeit import default_timer as timer
 start_init_timer = timer()
 
 import datetime
+import os
+import threading
 from enum import Enum
+from pathlib import Path
 
-import requests
-from typing import Optional, Dict
-from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse
+from typing import Optional, Dict, List, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel
 import pandas as pd
-import numpy as np
 
-app = FastAPI()
+from covidapi import (
+    accesslog,
+    answers,
+    batch,
+    coalesce,
+    linelist,
+    manifest,
+    metrics,
+    plaintext,
+    profiling,
+    responsecache,
+    sources,
+    static,
+    warmup,
+)
+from covidapi.answers import (
+    MsianState,
+    default_dates,
+    pretty_state_name,
+    reverse_pretty_state_name,
+)
+from covidapi.dataset import Dataset
+from covidapi.aggregation import Granularity
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records time spent encoding the response body"""
+
+    def render(self, content) -> bytes:
+        with metrics.stage("json_encode"):
+            return answers.encode(content)
+
 
+app = FastAPI(default_response_class=TimedJSONResponse)
+# Innermost, so cached and coalesced requests are still profiled, logged and
+# counted. Concurrent identical requests then only look up the cache once, and
+# answers published by the refresh function are cached once read
+static_responses = static.StaticResponses(lambda: data.version, lambda: data.source)
+static.install(app, static_responses)
+response_cache = responsecache.from_env()
+responsecache.install(app, response_cache, lambda *args: response_key(*args))
+coalesce.install(app, lambda: request_version())
+profiling.install(app)
+accesslog.install(app)
+
+metrics.STARTUP_PHASE.set(timer() - start_init_timer, phase="imports")
 print(f"{timer()- start_init_timer:5.1f}s: FastAPI instance initialized")
 
-## Hard-coded variables
-bucket_url = "https://storage.googleapis.com/msia-covid-api-data-bucket/"
-cases_malaysia_url = bucket_url + "cases_malaysia.csv"
-cases_state_url = bucket_url + "cases_state.csv"
-deaths_malaysia_url = bucket_url + "deaths_malaysia.csv"
-deaths_state_url = bucket_url + "deaths_state.csv"
-tests_malaysia_url = bucket_url + "tests_malaysia.csv"
-tests_state_url = bucket_url + "tests_state.csv"
-hospital_state_url = bucket_url + "hospital.csv"
-icu_state_url = bucket_url + "icu.csv"
-pkrc_state_url = bucket_url + "pkrc.csv"
-vax_malaysia_url = bucket_url + "vax_malaysia.csv"
-vax_state_url = bucket_url + "vax_state.csv"
+## Configuration
+# Where data is loaded from, see covidapi/sources.py for options
+DATA_SOURCE = os.environ.get("DATA_SOURCE", "bucket")
+
+# Optional directory for a snapshot of the loaded data. If there is one at
+# boot it is served right away, while the source is loaded in the background
+DATA_CACHE_DIR = os.environ.get("DATA_CACHE_DIR")
+SNAPSHOT_FILENAME = "snapshot.pkl"
+
+# Read tables only /detailed serves in the background after startup, instead
+# of when first requested. Set to 0 to only ever read them on demand
+DATA_PREFETCH = os.environ.get("DATA_PREFETCH", "1") != "0"
 
 
 def pprint_time(total_seconds):
@@ -48,110 +93,206 @@ def pprint_time(total_seconds):
         return f"{int(days)}d {int(hours)}h {int(minutes)}m ago"
 
 
+def request_version():
+    """
+    What answers depend on besides the query: the data served, and the dates
+    requests without dates default to
+    """
+    return data.version, default_dates(None, None)
+
+
+def response_key(path: str, params: Dict[str, str]) -> str:
+    """
+    Response cache key of a query on the data served, with default dates
+    filled in so queries for the same dates share answers
+    """
+    start_date, end_date = default_dates(
+        params.get("start_date"), params.get("end_date")
+    )
+    params = {**params, "start_date": str(start_date), "end_date": str(end_date)}
+    return responsecache.make_key(data.version, path, params)
+
+
+def pprint_age(total_seconds: Optional[float]) -> str:
+    if total_seconds is None:
+        return "at an unknown time"
+    return pprint_time(total_seconds)
+
+
 ## Retrieve data to memory -------------------------------
+def finish_loading(loaded: Dataset):
+    """Prepare all of `loaded`, then snapshot it if there's a cache dir"""
+    start = timer()
+    loaded.prefetch()
+    metrics.STARTUP_PHASE.set(timer() - start, phase="prefetch")
+    if DATA_CACHE_DIR is not None:
+        sources.write_snapshot(
+            Path(DATA_CACHE_DIR) / SNAPSHOT_FILENAME,
+            loaded.tables,
+            loaded.pushed_at,
+            loaded.file_hashes,
+        )
 
-# MOH repo
-cases_malaysia: pd.DataFrame = pd.read_csv(
-    cases_malaysia_url, index_col=0, parse_dates=[0]
-)
-cases_state: pd.DataFrame = pd.read_csv(cases_state_url, index_col=0, parse_dates=[0])
-deaths_malaysia: pd.DataFrame = pd.read_csv(
-    deaths_malaysia_url, index_col=0, parse_dates=[0]
-)
-deaths_state: pd.DataFrame = pd.read_csv(deaths_state_url, index_col=0, parse_dates=[0])
-tests_malaysia: pd.DataFrame = pd.read_csv(
-    tests_malaysia_url, index_col=0, parse_dates=[0]
-)
-tests_state: pd.DataFrame = pd.read_csv(tests_state_url, index_col=0, parse_dates=[0])
-hospital_state: pd.DataFrame = pd.read_csv(
-    hospital_state_url, index_col=0, parse_dates=[0]
-)
-hospital_malaysia: pd.DataFrame = hospital_state.groupby("date").sum(numeric_only=True)
-icu_state: pd.DataFrame = pd.read_csv(icu_state_url, index_col=0, parse_dates=[0])
-icu_malaysia: pd.DataFrame = icu_state.groupby("date").sum(numeric_only=True)
-pkrc_state: pd.DataFrame = pd.read_csv(pkrc_state_url, index_col=0, parse_dates=[0])
-pkrc_malaysia: pd.DataFrame = pkrc_state.groupby("date").sum(numeric_only=True)
-
-# CITF repo
-vax_malaysia: pd.DataFrame = pd.read_csv(vax_malaysia_url, index_col=0, parse_dates=[0])
-vax_state: pd.DataFrame = pd.read_csv(vax_state_url, index_col=0, parse_dates=[0])
-
-print(f"{timer()- start_init_timer:5.1f}s: Retrieved data from GCP bucket")
-
-# Round out the no-clusters column for national cases
-cases_malaysia["cluster_none"] = cases_malaysia["cases_new"] - cases_malaysia.drop(
-    columns=["cases_new"]
-).sum(axis="columns")
-
-# Add a total tests column
-tests_malaysia["total_tests"] = tests_malaysia.sum(axis="columns")
-
-# Figure out last commit times
-last_mohrepo_commit_dt = requests.get(
-    "https://api.github.com/repos/MoH-Malaysia/covid19-public"
-).json()["pushed_at"]
-last_mohrepo_commit_dt = pd.Timestamp(last_mohrepo_commit_dt).tz_convert(
-    "Asia/Kuala_Lumpur"
+
+def prefetch_in_background(loaded: Dataset):
+    """Prepare tables not requested yet, without holding up startup"""
+
+    def prefetch():
+        try:
+            finish_loading(loaded)
+            print(f"{timer() - start_init_timer:5.1f}s: Prefetched all tables")
+        except Exception as e:
+            print("Failed to prefetch tables, loading them on demand:")
+            print(e)
+
+    threading.Thread(target=prefetch, daemon=True).start()
+
+
+def refresh_in_background(source_spec: str, stale: Optional[Dataset] = None):
+    """
+    Load data from the source, then swap it in for the endpoints. `stale` is
+    data served from where the source is about to update, e.g. git clones,
+    read in full first so it isn't changed under it.
+    """
+
+    def refresh():
+        global data
+        try:
+            if stale is not None:
+                stale.prefetch()
+            loaded = Dataset(sources.from_spec(source_spec))
+            # Swapped in fully loaded, so requests don't wait on it again
+            finish_loading(loaded)
+            data = loaded
+            commit_times.update(data.pushed_at)
+            print(f"{timer() - start_init_timer:5.1f}s: Data refreshed from source")
+        except Exception as e:
+            print("Failed to refresh data, still serving what was loaded at boot:")
+            print(e)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def open_data() -> Tuple[Dataset, bool]:
+    """
+    Data to serve right away: the snapshot if there is one, otherwise the
+    source without waiting on updates, otherwise the bucket. Returns it and
+    whether it needs catching up with the source.
+    """
+    if snapshot_fp is not None and snapshot_fp.exists():
+        try:
+            loaded = Dataset(sources.SnapshotSource(snapshot_fp))
+            print(
+                f"{timer()- start_init_timer:5.1f}s: Loaded snapshot from {snapshot_fp}"
+            )
+            return loaded, True
+        except Exception as e:
+            # Unpickling fails in many ways, e.g. written by other versions
+            print(f"Failed to load snapshot from {snapshot_fp}: {e!r}")
+
+    try:
+        source = sources.from_spec(DATA_SOURCE, update=False)
+        print(f"{timer()- start_init_timer:5.1f}s: Opened data source {DATA_SOURCE}")
+    except Exception as e:
+        print(f"Failed to open data source {DATA_SOURCE}, reading the bucket: {e!r}")
+        return Dataset(sources.BucketSource()), False
+    return Dataset(source), isinstance(source, sources.GitSource) and not source.updated
+
+
+start_fetch_timer = timer()
+
+snapshot_fp = None
+if DATA_CACHE_DIR is not None:
+    try:
+        Path(DATA_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        snapshot_fp = Path(DATA_CACHE_DIR) / SNAPSHOT_FILENAME
+    except OSError as e:
+        print(f"Can't use {DATA_CACHE_DIR} for snapshots: {e}")
+        DATA_CACHE_DIR = None
+
+# Tables are only read and prepared once needed, see covidapi/dataset.py.
+# Git clones already there are served as they are, and fetched below
+data, stale = open_data()
+serving_snapshot = isinstance(data.source, sources.SnapshotSource)
+
+metrics.STARTUP_PHASE.set(timer() - start_fetch_timer, phase="fetch_data")
+
+# Tables rendered by /ascii
+ascii_cache = plaintext.RenderCache()
+
+# Figure out last commit times, e.g. published to the bucket by the refresh
+# function. Only fall back to asking GitHub if that's missing, without
+# holding up startup
+start_lookup_timer = timer()
+commit_times = manifest.CommitTimes()
+if not commit_times.update(data.pushed_at):
+    commit_times.lookup_github_in_background()
+metrics.STARTUP_PHASE.set(timer() - start_lookup_timer, phase="commit_times")
+
+# Catch up with the source now that the snapshot or clones are being served.
+# Otherwise read the tables nobody asked for yet, snapshots need all of them
+if serving_snapshot:
+    refresh_in_background(DATA_SOURCE)
+elif stale:
+    refresh_in_background(DATA_SOURCE, stale=data)
+elif DATA_PREFETCH or DATA_CACHE_DIR is not None:
+    prefetch_in_background(data)
+
+# Data snapshot age is worked out when /metrics is scraped
+metrics.SNAPSHOT_AGE.set_function(
+    lambda: commit_times.age(manifest.MOH_REPO), repo="moh"
 )
-last_citfrepo_commit_dt = requests.get(
-    "https://api.github.com/repos/CITF-Malaysia/citf-public"
-).json()["pushed_at"]
-last_citfrepo_commit_dt = pd.Timestamp(last_citfrepo_commit_dt).tz_convert(
-    "Asia/Kuala_Lumpur"
+metrics.SNAPSHOT_AGE.set_function(
+    lambda: commit_times.age(manifest.CITF_REPO), repo="citf"
 )
 
 
 ## Prepare the API ------------------------------------
-class MsianState(str, Enum):
-    johor = "johor"
-    kedah = "kedah"
-    kelantan = "kelantan"
-    melaka = "melaka"
-    ns = "negerisembilan"
-    pahang = "pahang"
-    perak = "perak"
-    perlis = "perlis"
-    penang = "penang"
-    sabah = "sabah"
-    sarawak = "sarawak"
-    selangor = "selangor"
-    terengganu = "terengganu"
-    kl = "kl"
-    labuan = "labuan"
-    putrajaya = "putrajaya"
-    allstates = "allstates"
-
-
-pretty_state_name = {
-    MsianState.johor: "Johor",
-    MsianState.kedah: "Kedah",
-    MsianState.kelantan: "Kelantan",
-    MsianState.melaka: "Melaka",
-    MsianState.ns: "Negeri Sembilan",
-    MsianState.pahang: "Pahang",
-    MsianState.perak: "Perak",
-    MsianState.perlis: "Perlis",
-    MsianState.penang: "Pulau Pinang",
-    MsianState.sabah: "Sabah",
-    MsianState.sarawak: "Sarawak",
-    MsianState.selangor: "Selangor",
-    MsianState.terengganu: "Terengganu",
-    MsianState.kl: "W.P. Kuala Lumpur",
-    MsianState.labuan: "W.P. Labuan",
-    MsianState.putrajaya: "W.P. Putrajaya",
-}
-
-reverse_pretty_state_name: Dict = {j: i for i, j in pretty_state_name.items()}
+# Paths served by the API, anything else is lumped together in metrics
+# to keep label cardinality bounded
+endpoint_paths = (
+    "/",
+    "/detailed",
+    "/derived",
+    "/linelist/deaths",
+    "/batch",
+    "/ascii",
+    "/ping",
+    "/metrics",
+)
 
-end_init_timer = timer()
-print(f"{end_init_timer - start_init_timer:5.1f}s: API init complete")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if warmup.is_warmup(request.scope):
+        return await call_next(request)
+
+    endpoint = request.url.path
+    if endpoint not in endpoint_paths:
+        endpoint = "other"
+
+    state = request.query_params.get("state")
+    if state is None:
+        state = "national"
+    elif state not in [i.value for i in MsianState]:
+        state = "invalid"
+
+    metrics.current_endpoint.set(endpoint)
+    start = timer()
+    response = await call_next(request)
+    metrics.REQUEST_LATENCY.observe(timer() - start, endpoint=endpoint, state=state)
+    metrics.REQUESTS.inc(endpoint=endpoint, state=state, status=response.status_code)
+
+    return response
 
 
 @app.get("/")
+@profiling.profiled
 def return_root(
     start_date: Optional[datetime.date] = None,
     end_date: Optional[datetime.date] = None,
     state: Optional[MsianState] = None,
+    granularity: Granularity = Granularity.day,
 ):
     """
     Returns key COVID19 epidemic data for Malaysia between the specified
@@ -187,6 +328,13 @@ def return_root(
 
     + If `state` is specified as "allstates", returns data for all states
 
+    `granularity`: str
+    + One of "day", "week" or "month", defaults to "day"
+    + Data is aggregated over each week (starting Monday) or month, labelled by
+    the first date of the period. Daily counts are summed, cumulative counts
+    take the last value, and stocks such as hospital occupancy are averaged
+    + Periods cut by `start_date` or `end_date` only cover dates in the range
+
     Returns
     -------
     `ans`: JSON response
@@ -199,125 +347,19 @@ def return_root(
     slower cycle, leaving blank entries
 
     """
-    print(f"start_date: {start_date}, end_date: {end_date}, state: {state}")
-    if start_date is None:
-        start_date: datetime.date = (
-            pd.Timestamp.now(tz="Asia/Kuala_Lumpur") - pd.Timedelta("120h")
-        ).date()
-    if end_date is None:
-        end_date: datetime.date = pd.Timestamp.now(tz="Asia/Kuala_Lumpur").date()
-
-    # Return national data
-    if state is None:
-        ans = pd.concat(
-            [
-                cases_malaysia.loc[start_date:end_date, "cases_new"],
-                deaths_malaysia.loc[start_date:end_date, "deaths_new"],
-                vax_malaysia.loc[
-                    start_date:end_date, ["cumul_partial", "cumul_full", "cumul_full"]
-                ],
-                tests_malaysia.loc[start_date:end_date, "total_tests"],
-            ],
-            axis="columns",
-        )
-
-        # Change pd.DatetimeIndex to datetime.date
-        ans.index = ans.index.map(lambda x: x.date())
-
-        # Purge NaNs as JSON can't serialize them
-        # Rather return an obviously wrong answer than return ambiguous 0
-        ans = ans.fillna(value=-9999)
-
-        # Get all numeric data to be int, ignoring strings
-        ans = ans.astype(int, errors="ignore")
-
-        # Considering split and index
-        # Ended up preferring index
-        ans = ans.to_dict(orient="index")
-
-        return ans
-
-    elif state == MsianState.allstates:
-        ans_list = {}
-
-        # Here is where I wish this was SQL instead
-        # TODO: Must be a cleaner way to do this
-        cases_state_selected = cases_state.loc[
-            start_date:end_date, ["cases_new", "state"]
-        ].reset_index(drop=False)
-        deaths_state_selected = deaths_state.loc[
-            start_date:end_date, ["deaths_new", "state"]
-        ].reset_index(drop=False)
-        pregrouped_ans = cases_state_selected.merge(
-            deaths_state_selected, on=["state", "date"], how="inner"
-        )
-        vax_state_selected = vax_state.loc[
-            start_date:end_date, ["cumul_partial", "cumul_full", "cumul_full", "state"]
-        ].reset_index(drop=False)
-        pregrouped_ans = pregrouped_ans.merge(
-            vax_state_selected, on=["state", "date"], how="inner"
-        )
-
-        for statename, ans in pregrouped_ans.groupby("state"):
-            # Change pd.DatetimeIndex to datetime.date
-            ans = ans.set_index("date")
-            ans.index = ans.index.map(lambda x: x.date())
-
-            # Purge NaNs as JSON can't serialize them
-            # Rather return an obviously wrong answer than return ambiguous 0
-            ans = ans.fillna(value=-9999)
-
-            # Remove the state column
-            ans = ans.drop(columns="state")
-
-            # Get all numeric data to be int, ignoring strings
-            ans = ans.astype(int, errors="ignore")
-
-            # Considering split and index
-            # Ended up preferring index
-            ans = ans.to_dict(orient="index")
-            ans_list[reverse_pretty_state_name.get(statename)] = ans
-
-        return ans_list
-
-    else:
-        ans = pd.concat(
-            [
-                cases_state[cases_state["state"] == pretty_state_name.get(state)].loc[
-                    start_date:end_date, "cases_new"
-                ],
-                deaths_state[deaths_state["state"] == pretty_state_name.get(state)].loc[
-                    start_date:end_date, "deaths_new"
-                ],
-                vax_state[vax_state["state"] == pretty_state_name.get(state)].loc[
-                    start_date:end_date, ["cumul_partial", "cumul_full", "cumul_full"]
-                ],
-            ],
-            axis="columns",
-        )
-
-        # Change pd.DatetimeIndex to datetime.date
-        ans.index = ans.index.map(lambda x: x.date())
-
-        # Purge NaNs as JSON can't serialize them
-        # Rather return an obviously wrong answer than return ambiguous 0
-        ans = ans.fillna(value=-9999)
-
-        # Get all numeric data to be int, ignoring strings
-        ans = ans.astype(int, errors="ignore")
-
-        # Considering split and index
-        # Ended up preferring index
-        ans = ans.to_dict(orient="index")
-
-        return ans
+    start_date, end_date = default_dates(start_date, end_date)
+    return answers.summary(data, start_date, end_date, state, granularity)
 
 
 @app.get("/detailed")
+@profiling.profiled
 def return_detailed(
     start_date: Optional[datetime.date] = None,
     end_date: Optional[datetime.date] = None,
     state: Optional[MsianState] = None,
+    granularity: Granularity = Granularity.day,
+    tables: Optional[str] = None,
+    columns: Optional[str] = None,
 ):
     """
     Returns detailed COVID19 epidemic data for Malaysia between the specified
@@ -351,6 +393,10 @@ def return_detailed(
         + (MoH) icu/hospital.csv --> aggregated to national level
         + (MoH) pkrc/hospital.csv --> aggregated to national level
         + (CITF) vaccination/vax_malaysia.csv
+        + (MoH) mysejahtera/checkin_malaysia.csv
+        + (MoH) mysejahtera/checkin_malaysia_time.csv
+        + (MoH) mysejahtera/trace_malaysia.csv
+        + (CITF) registration/vaxreg_malaysia.csv
 
     + If `state` is specified, returns state level data which includes all columns in the
         following files from the MoH and CITF data repos:
@@ -361,9 +407,28 @@ def return_detailed(
         + (MoH) icu/hospital.csv
         + (MoH) pkrc/hospital.csv
         + (CITF) vaccination/vax_state.csv
+        + (MoH) mysejahtera/checkin_state.csv
+        + (CITF) registration/vaxreg_state.csv
 
     + If `state` is specified as "allstates", returns data for all states
 
+    `granularity`: str
+    + One of "day", "week" or "month", defaults to "day"
+    + Data is aggregated over each week (starting Monday) or month, labelled by
+    the first date of the period. Daily counts are summed, cumulative counts
+    take the last value, and stocks such as hospital occupancy are averaged
+    + Periods cut by `start_date` or `end_date` only cover dates in the range
+
+    `tables`: str
+    + Comma-separated tables to return e.g. "cases_malaysia,vax_malaysia", or
+    "cases_state,vax_state" along with `state`
+    + If `tables` is not specified, returns all tables
+
+    `columns`: str
+    + Comma-separated columns to return e.g. "cases_new,cumul_full", taken from
+    every returned table that has them. Tables with none of them are left out
+    + If `columns` is not specified, returns all columns
+
     Returns
     -------
     `ans`: JSON response
@@ -376,207 +441,367 @@ def return_detailed(
     slower cycle, leaving blank entries
 
     """
-    print(f"start_date: {start_date}, end_date: {end_date}, state: {state}")
-    if start_date is None:
-        start_date: datetime.date = (
-            pd.Timestamp.now(tz="Asia/Kuala_Lumpur") - pd.Timedelta("120h")
-        ).date()
-    if end_date is None:
-        end_date: datetime.date = pd.Timestamp.now(tz="Asia/Kuala_Lumpur").date()
+    start_date, end_date = default_dates(start_date, end_date)
+    try:
+        return answers.detailed(
+            data, start_date, end_date, state, granularity, tables, columns
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def format_derived(ans: pd.DataFrame) -> Dict:
+    """Format a slice of derived data for the response"""
+    with metrics.stage("to_dict"):
+        return ans.to_dict(orient="index")
+
+
+@app.get("/derived")
+@profiling.profiled
+def return_derived(
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    state: Optional[MsianState] = None,
+):
+    """
+    Returns series derived from COVID19 epidemic data for Malaysia between the
+    specified `start_date` and `end_date`. Precomputed when data is loaded, so
+    there is no need to retrieve long ranges of data to work these out.
+
+    Args
+    ----
+    Same as the `/` endpoint.
+
+    Returns
+    -------
+    `ans`: JSON response, with the following for each date:
+    + `cases_new_7d`: 7-day rolling average of daily new cases
+    + `deaths_new_7d`: 7-day rolling average of daily deaths
+    + `positivity_rate`: daily new cases divided by daily tests
+    + `positivity_rate_7d`: new cases divided by tests, over the past 7 days
+    + `daily_partial_delta`: change in cumulative count of partially vaccinated
+    + `daily_full_delta`: change in cumulative count of fully vaccinated
+
+    Notes
+    -----
+    + 7-day values are only available from the 7th day of data onwards
+    + NaNs in the data will be returned as -9999. Some of the data updates on a
+    slower cycle, leaving blank entries
+
+    """
+    start_date, end_date = default_dates(start_date, end_date)
 
     # Return national data
     if state is None:
-        ans = {}
+        with metrics.stage("slice"):
+            ans = data.derived_malaysia.select(start_date, end_date)
+        return format_derived(ans)
+
+    elif state == MsianState.allstates:
+        with metrics.stage("slice"):
+            selected = list(data.derived_state.select_allstates(start_date, end_date))
+
+        ans_list = {}
+        for statename, ans in selected:
+            ans_list[reverse_pretty_state_name.get(statename)] = format_derived(ans)
+        return ans_list
 
-        # Add each set of national data to the response
-        ans["cases_malaysia"] = cases_malaysia.loc[start_date:end_date]
-        ans["deaths_malaysia"] = deaths_malaysia.loc[start_date:end_date]
-        ans["vax_malaysia"] = vax_malaysia.loc[start_date:end_date]
-        ans["tests_malaysia"] = tests_malaysia.loc[start_date:end_date]
-        ans["hospital_malaysia"] = hospital_malaysia.loc[start_date:end_date]
-        ans["icu_malaysia"] = icu_malaysia.loc[start_date:end_date]
-        ans["pkrc_malaysia"] = pkrc_malaysia.loc[start_date:end_date]
+    else:
+        with metrics.stage("slice"):
+            ans = data.derived_state.select(
+                start_date, end_date, state=pretty_state_name.get(state)
+            )
+        return format_derived(ans)
+
+
+@app.get("/linelist/deaths")
+@profiling.profiled
+def return_linelist_deaths(
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    state: Optional[MsianState] = None,
+    granularity: Granularity = Granularity.day,
+    by: Optional[str] = None,
+):
+    """
+    Returns COVID19 deaths in Malaysia between the specified `start_date` and
+    `end_date`, broken down by age band and vaccination status. Counted from
+    the MoH linelist of deaths, one row per death, which isn't available
+    from the other endpoints.
 
-        # Format each set
-        for i in ans.keys():
-            formatted_data = ans[i]
-            # Change pd.DatetimeIndex to datetime.date
-            formatted_data.index = formatted_data.index.map(lambda x: x.date())
+    Args
+    ----
+    `start_date`, `end_date`, `state`, `granularity`: same as the `/` endpoint
 
-            # Purge NaNs as JSON can't serialize them
-            # Rather return an obviously wrong answer than return ambiguous 0
-            formatted_data = formatted_data.fillna(value=-9999)
+    `by`: str
+    + Comma-separated breakdowns, any of "age_band" and "vax_status"
+    + If `by` is not specified, breaks down by both. If empty, returns totals
 
-            # Get all numeric data to be int, ignoring strings
-            formatted_data = formatted_data.astype(int, errors="ignore")
+    Returns
+    -------
+    `ans`: JSON response, with a list for each date of one entry per
+    breakdown with any deaths, e.g. `{"2021-09-01": [{"age_band": "60-69",
+    "vax_status": "unvax", "deaths": 12, "bid": 3, "comorb": 10}, ...]}`
+    + `age_band`: one of "0-11", "12-17", "18-29", "30-39", "40-49", "50-59",
+    "60-69", "70-79", "80+" or "unknown"
+    + `vax_status`: "unvax", "pvax", "fvax" or "boost", from the doses given
+    at least 14 days before testing positive, as in the `deaths_*vax` columns
+    of `/detailed`
+    + `deaths`: count of deaths
+    + `bid`: of which brought in dead
+    + `comorb`: of which had comorbidities
 
-            # Considering split and index
-            # Ended up preferring index
-            formatted_data = formatted_data.to_dict(orient="index")
+    Notes
+    -----
+    + Data source is the [MoH linelist of deaths]
+    (https://github.com/MoH-Malaysia/covid19-public/tree/main/epidemic/linelist)
+    + Dates without any deaths are left out
 
-            # Assign to response
-            ans[i] = formatted_data
+    """
+    start_date, end_date = default_dates(start_date, end_date)
+    try:
+        breakdowns = linelist.breakdowns(by)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-        return ans
+    # Return national data
+    if state is None:
+        with metrics.stage("slice"):
+            ans = data.deaths_cube.select(
+                start_date, end_date, by=breakdowns, granularity=granularity
+            )
+        with metrics.stage("to_dict"):
+            return linelist.to_served(ans)
 
     elif state == MsianState.allstates:
-        ans = {}
-        for i, _ in pretty_state_name.items():
-            ans[i] = return_detailed(start_date=start_date, end_date=end_date, state=i)
-        return ans
+        with metrics.stage("slice"):
+            ans = data.deaths_cube.select(
+                start_date, end_date, by=["state"] + breakdowns, granularity=granularity
+            )
+
+        ans_list = {}
+        with metrics.stage("to_dict"):
+            for statename, rows in ans.groupby("state", observed=True):
+                ans_list[reverse_pretty_state_name.get(statename)] = linelist.to_served(
+                    rows.drop(columns="state")
+                )
+        return ans_list
 
     else:
-        ans = {}
-
-        # Add each set of state data to the response
-        ans["cases_state"] = cases_state[
-            cases_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["deaths_state"] = deaths_state[
-            deaths_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["vax_state"] = vax_state[
-            vax_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["tests_state"] = tests_state[
-            tests_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["hospital_state"] = hospital_state[
-            hospital_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["icu_state"] = icu_state[
-            icu_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-        ans["pkrc_state"] = pkrc_state[
-            pkrc_state["state"] == pretty_state_name.get(state)
-        ].loc[start_date:end_date]
-
-        # Format each set
-        for i in ans.keys():
-            formatted_data = ans[i]
-
-            # Drop the state column
-            formatted_data = formatted_data.drop(columns="state")
-
-            # Change pd.DatetimeIndex to datetime.date
-            formatted_data.index = formatted_data.index.map(lambda x: x.date())
-
-            # Purge NaNs as JSON can't serialize them
-            # Rather return an obviously wrong answer than return ambiguous 0
-            formatted_data = formatted_data.fillna(value=-9999)
-
-            # Get all numeric data to be int, ignoring strings
-            formatted_data = formatted_data.astype(int, errors="ignore")
-
-            # Considering split and index
-            # Ended up preferring index
-            formatted_data = formatted_data.to_dict(orient="index")
-
-            # Assign to response
-            ans[i] = formatted_data
-
-        return ans
+        with metrics.stage("slice"):
+            ans = data.deaths_cube.select(
+                start_date,
+                end_date,
+                state=pretty_state_name.get(state),
+                by=breakdowns,
+                granularity=granularity,
+            )
+        with metrics.stage("to_dict"):
+            return linelist.to_served(ans)
 
 
-@app.get("/ascii", response_class=PlainTextResponse)
-def return_ascii():
+class BatchEndpoint(str, Enum):
+    summary = "/"
+    detailed = "/detailed"
+    derived = "/derived"
+
+
+class BatchQuery(BaseModel):
+    endpoint: BatchEndpoint = BatchEndpoint.summary
+    state: Optional[MsianState] = None
+    start_date: Optional[datetime.date] = None
+    end_date: Optional[datetime.date] = None
+
+
+MAX_BATCH_QUERIES = 200
+
+
+@app.post("/batch")
+@profiling.profiled
+def return_batch(queries: List[BatchQuery]):
     """
-    Returns a terminal-friendly printout of latest national stats.
-    Equivalent to calling the root API with no parameters. Refer
-    to the docstring of the root API for more info.
+    Answers many queries in one request. Send a JSON list of queries, each
+    with the following keys:
 
-    Intended usage in terminal:
-    ```
-    $ curl msiacovidapi.herokuapp.com/ascii
+    + `endpoint`: one of "/", "/detailed" or "/derived", defaults to "/"
+    + `state`, `start_date`, `end_date`: same as the GET params of the endpoint
 
-    Latest update - Msia COVID19
-    MOH data updated 3h 5m ago
-    Vax data updated 8h 49m ago
+    e.g. `[{"state": "kl", "start_date": "2021-08-01", "end_date": "2021-08-10"},
+    {"endpoint": "/detailed", "start_date": "2021-08-05"}]`
+
+    Returns
+    -------
+    `ans`: JSON list with the answer to each query, in the same order. Each
+    answer is the same as calling the endpoint with GET
 
-                cases_new  deaths_new  dose1_cumul  \
-    -------------------------------------------------
-    2021-08-09     17,236         212   15,959,596
-    2021-08-10     19,991         201   16,119,916
-    2021-08-11     20,780         211   16,347,422
-    2021-08-12     21,668         318   16,545,384
-    2021-08-13     21,468         277   16,707,566
-
-                dose2_cumul  total_cumul  total_tests
-    -------------------------------------------------
-    2021-08-09    9,048,634   25,008,230      153,561
-    2021-08-10    9,246,295   25,366,211      144,565
-    2021-08-11    9,516,141   25,863,563      169,444
-    2021-08-12    9,843,521   26,388,905      171,982
-    2021-08-13   10,144,199   26,851,765       -9,999
+    Notes
+    -----
+    + Up to 200 queries per request
+    + Queries for the same endpoint and state are answered together, so
+    overlapping date ranges are only worked out once
+    + Answers are cached along with those to GET requests
 
-    ```
     """
-    ans = pd.DataFrame.from_dict(return_root(), orient="index")
-
-    # Rename some column names
-    ans = ans.rename(
-        columns={
-            "cases_new": "New cases",
-            "deaths_new": "Deaths",
-            "cumul_partial": "Sum partially vax'ed",
-            "cumul_full": "Sum fully vax'ed",
-            "total_tests": "Daily tests",
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Up to {MAX_BATCH_QUERIES} queries per batch, got {len(queries)}",
+        )
+    handlers = {
+        BatchEndpoint.summary: return_root,
+        BatchEndpoint.detailed: return_detailed,
+        BatchEndpoint.derived: return_derived,
+    }
+
+    # Resolve default dates up front so queries can be grouped
+    resolved = []
+    for query in queries:
+        start_date, end_date = default_dates(query.start_date, query.end_date)
+        resolved.append((query.endpoint, query.state, start_date, end_date))
+
+    # Look up every distinct query in the response cache in one go, answers
+    # are the same as to the GETs
+    keys: Dict = {}
+    for key in resolved:
+        endpoint, state, start_date, end_date = key
+        params = {
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
         }
-    )
+        if state is not None:
+            params["state"] = state.value
+        keys[key] = response_key(endpoint.value, params)
+    with metrics.stage("cache"):
+        cached = response_cache.get_many(list(keys.values()))
+    answered: Dict = {i: j for i, j in zip(keys, cached) if j is not None}
+    missing = [i for i in keys if i not in answered]
+
+    ranges: Dict = {}
+    for endpoint, state, start_date, end_date in missing:
+        # Empty ranges still need a range to be trimmed from
+        ranges.setdefault((endpoint, state), []).append(
+            (start_date, max(start_date, end_date))
+        )
 
-    # Add space to columns for better spacing
-    # Easiest workaround
-    ans.columns = [f" {i}" for i in ans.columns]
-
-    ans_string = ans.to_string(
-        line_width=60,
-        justify="right",  # complements spacing workaround
-        # ref: https://stackoverflow.com/a/41447478/13095028
-        formatters=[
-            lambda x: "{:,}".format(x)
-            for _, dtype in ans.dtypes.items()
-            if dtype in [np.dtype("int64"), np.dtype("float64")]
-        ],
-    )
+    # Work out each merged range once
+    merged: Dict = {}
+    for (endpoint, state), group_ranges in ranges.items():
+        merged_ranges = batch.merge_ranges(group_ranges)
+        merged[(endpoint, state)] = (
+            merged_ranges,
+            [
+                handlers[endpoint](start_date=start, end_date=end, state=state)
+                for start, end in merged_ranges
+            ],
+        )
 
-    # Further format the ASCII return
-    # Calculate the line width
-    lwidth = len(ans_string.split("\n", 1)[0])
-
-    # Add "table line" (what's this called?)
-    columnrow, body = ans_string.split("\n", 1)
-    ans_string = columnrow + "\n" + "-" * lwidth + "\n" + body
-
-    # Add "table line" for subsequent rows
-    # Not proud with how I did this
-    pieces = ans_string.split("\n\n")
-    ans_string = pieces[0]
-    for i in pieces[1:]:
-        front_piece, back_piece = i.split("\n", 1)
-        ans_string = (
-            ans_string + "\n\n" + front_piece + "\n" + "-" * lwidth + "\n" + back_piece
+    # Then trim to each query, answering repeated queries once
+    for key in missing:
+        endpoint, state, start_date, end_date = key
+        merged_ranges, merged_ans = merged[(endpoint, state)]
+        i = batch.containing_range(merged_ranges, start_date, max(start_date, end_date))
+
+        # Answers are keyed by date one level further down for each of
+        # allstates and /detailed. Only /detailed lists states without data
+        depth = int(state == MsianState.allstates)
+        depth += int(endpoint == BatchEndpoint.detailed)
+        trimmed = batch.trim_dates(
+            merged_ans[i],
+            start_date.isoformat(),
+            end_date.isoformat(),
+            depth,
+            drop_empty=endpoint != BatchEndpoint.detailed,
         )
+        # Encoded as the GET would be, to be cached for it
+        answered[key] = TimedJSONResponse(trimmed).body
+    response_cache.set_many({keys[i]: answered[i] for i in missing})
 
-    time_since_last_citfrepo_commit = (
-        pd.Timestamp.now(tz="Asia/Kuala_Lumpur") - last_citfrepo_commit_dt
-    )
-    time_since_last_mohrepo_commit = (
-        pd.Timestamp.now(tz="Asia/Kuala_Lumpur") - last_mohrepo_commit_dt
+    return Response(
+        b"[" + b",".join(answered[i] for i in resolved) + b"]",
+        media_type="application/json",
     )
 
-    # Add a header printout
-    header = "\nLatest update - Msia COVID19\n"
-    # header += f"Source: {MOHREPO_URL}\n\n"
-    header += f"MOH data updated {pprint_time(time_since_last_mohrepo_commit.total_seconds())}\n"
-    header += f"Vax data updated {pprint_time(time_since_last_citfrepo_commit.total_seconds())}\n\n"
-    ans_string = header + ans_string
 
-    # Add a footer
-    # footer = f"\nData last updated {pprint_time(time_since_last_mohrepo_commit.total_seconds())}\n\n"
-    footer = "\n\n"
-    ans_string = ans_string + footer
+@app.get("/ascii", response_class=PlainTextResponse)
+@profiling.profiled
+def return_ascii(
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    state: Optional[MsianState] = None,
+):
+    """
+    Returns a terminal-friendly printout of key stats. Takes the same
+    `start_date`, `end_date` and `state` as the root API, and returns the
+    same data. Refer to the docstring of the root API for more info.
+
+    Intended usage in terminal:
+    ```
+    $ curl msiacovidapi.herokuapp.com/ascii
+
+    Latest update - Msia COVID19
+    MOH data updated 3h 5m ago
+    Vax data updated 8h 49m ago
 
-    return ans_string
+               New cases Deaths Sum partially vax'ed  \\
+    ---------------------------------------------------
+    2021-09-25    14,401     99           20,227,604
+    2021-09-26     5,382     56           20,322,851
+    2021-09-27    15,573     36           20,400,335
+    2021-09-28     1,988    115           20,445,590
+    2021-09-29    11,831     62           20,526,116
+
+               Sum fully vax'ed Daily tests
+    ---------------------------------------------------
+    2021-09-25       17,375,220     148,223
+    2021-09-26       17,413,500     164,040
+    2021-09-27       17,465,485     153,518
+    2021-09-28       17,612,513     136,590
+    2021-09-29       17,723,495      -9,999
+
+    $ curl "msiacovidapi.herokuapp.com/ascii?state=selangor&start_date=2021-09-01"
+    ```
+    """
+    start_date, end_date = default_dates(start_date, end_date)
+
+    # Same query on the same data renders the same table
+    key = (
+        data.summary_malaysia.version,
+        data.summary_state.version,
+        state,
+        start_date,
+        end_date,
+    )
+    with metrics.stage("cache"):
+        ans_string = ascii_cache.get(key)
+
+    if ans_string is None:
+        with metrics.stage("slice"):
+            if state is None:
+                sections = [(None, data.summary_malaysia.select(start_date, end_date))]
+            elif state == MsianState.allstates:
+                sections = list(
+                    data.summary_state.select_allstates(start_date, end_date)
+                )
+            else:
+                pretty = pretty_state_name.get(state)
+                sections = [
+                    (
+                        None,
+                        data.summary_state.select(start_date, end_date, state=pretty),
+                    )
+                ]
+
+        with metrics.stage("render"):
+            ans_string = plaintext.render_sections(sections)
+        ascii_cache.put(key, ans_string)
+
+    # Add a header printout, ages change by the minute so aren't cached
+    place = "Msia" if state is None else pretty_state_name.get(state, "All states")
+    header = f"\nLatest update - {place} COVID19\n"
+    header += f"MOH data updated {pprint_age(commit_times.age(manifest.MOH_REPO))}\n"
+    header += f"Vax data updated {pprint_age(commit_times.age(manifest.CITF_REPO))}\n\n"
+
+    return header + ans_string + "\n\n"
 
 
 @app.get("/ping")  # , response_class=PlainTextResponse)
@@ -585,3 +810,25 @@ def return_ping():
     Ping endpoint to check API status
     """
     return {"pong"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def return_metrics():
+    """
+    Prometheus-style metrics: request counts and latencies per endpoint and
+    state, per-stage handler timings, startup phase durations, data snapshot
+    age and cache hit rates.
+    """
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+## Warm up ----------------------------------------------
+# Only done importing, and so ready to serve, once handlers have run once
+metrics.STARTUP_PHASE.set(warmup.run(app), phase="warmup")
+print(f"{timer()- start_init_timer:5.1f}s: Warmed up {warmup.WARMUP_ENDPOINTS}")
+
+end_init_timer = timer()
+metrics.STARTUP_PHASE.set(end_init_timer - start_init_timer, phase="total")
+print(f"{end_init_timer - start_init_timer:5.1f}s: API init complete")
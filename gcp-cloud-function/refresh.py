@@ -1,62 +1,431 @@
-import git
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import tempfile
+from typing import Dict, Optional
+
+import git
+import pandas as pd
+import requests
+from google.api_core.exceptions import GoogleAPIError, NotFound
 from google.cloud import storage
 
+# Linelist cubes and static answers are worked out with the API's own code,
+# deployed next to this file (see README.md) or found in the repo when run
+# from it
+sys.path.append(str(Path(__file__).resolve().parents[1] / "gcp-app-engine"))
+from covidapi import linelist, manifest, sources, static  # noqa: E402
+from covidapi.dataset import Dataset  # noqa: E402
+
 MOHREPO_URL = "https://github.com/MoH-Malaysia/covid19-public"
 CITFREPO_URL = "https://github.com/CITF-Malaysia/citf-public"
+BUCKET_NAME = "msia-covid-api-data-bucket"
 
-def hello_pubsub(event, context):
-    """Triggered from a message on a Cloud Pub/Sub topic.
-    Args:
-         event (dict): Event payload.
-         context (google.cloud.functions.Context): Metadata for the event.
+# "http" downloads only the files uploaded to the bucket, skipping those
+# unchanged since the last run. "git" clones both repos as before
+FETCH_MODE = os.environ.get("FETCH_MODE", "http")
+RAW_BASE_URL = os.environ.get("RAW_BASE_URL", "https://raw.githubusercontent.com")
+HTTP_TIMEOUT = 60
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+
+# Published alongside the data, read by the API to tell how fresh it is
+MANIFEST_NAME = "manifest.json"
+
+# Data files and the manifest change with every refresh and must be read
+# together, don't let either be served stale
+DATA_CACHE_CONTROL = "no-cache"
+# Static answers are never changed once published, see covidapi/static.py
+STATIC_CACHE_CONTROL = "public, max-age=86400"
+
+EPIDEMIC_FILES = [
+    "cases_malaysia.csv",
+    "cases_state.csv",
+    "deaths_malaysia.csv",
+    "deaths_state.csv",
+    "icu.csv",
+    "hospital.csv",
+    "pkrc.csv",
+    "tests_malaysia.csv",
+    "tests_state.csv",
+]
+VAX_FILES = ["vax_malaysia.csv", "vax_state.csv"]
+MYSEJAHTERA_FILES = [
+    "checkin_malaysia.csv",
+    "checkin_malaysia_time.csv",
+    "checkin_state.csv",
+    "trace_malaysia.csv",
+]
+REGISTRATION_FILES = ["vaxreg_malaysia.csv", "vaxreg_state.csv"]
+
+# Bucket object name: (repo, path in repo)
+SOURCE_FILES = {
+    **{i: ("MoH-Malaysia/covid19-public", f"epidemic/{i}") for i in EPIDEMIC_FILES},
+    **{i: ("CITF-Malaysia/citf-public", f"vaccination/{i}") for i in VAX_FILES},
+    **{
+        i: ("MoH-Malaysia/covid19-public", f"mysejahtera/{i}")
+        for i in MYSEJAHTERA_FILES
+    },
+    **{
+        i: ("CITF-Malaysia/citf-public", f"registration/{i}")
+        for i in REGISTRATION_FILES
+    },
+}
+
+
+# Bucket object name: (repo, path of the linelist the cube is built from)
+CUBE_FILES = {sources.file_name(i): j for i, j in sources.CUBES.items()}
+
+
+def raw_url(repo: str, path: str, base_url: str = RAW_BASE_URL) -> str:
+    return f"{base_url}/{repo}/main/{path}"
+
+
+def stored_etags(bucket) -> Dict[str, Optional[str]]:
+    """ETags of the source files last uploaded, kept in object metadata"""
+    return {
+        blob.name: (blob.metadata or {}).get("source_etag")
+        for blob in bucket.list_blobs()
+    }
+
+
+def fetch_and_upload(
+    bucket, name: str, url: str, etag: Optional[str], session: requests.Session
+) -> bool:
+    """
+    Upload the file at `url` to `name` in the bucket, unless it still has
+    ETag `etag`. The download is streamed into the upload, never to disk.
+
+    Returns whether the file was uploaded.
+    """
+    # Resumable uploads work out byte ranges from the stream position, which
+    # wouldn't match the bytes read if the response was compressed
+    headers = {"Accept-Encoding": "identity"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+
+    with session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as resp:
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+
+        blob = bucket.blob(name)
+        blob.metadata = {"source_etag": resp.headers.get("ETag")}
+        blob.cache_control = DATA_CACHE_CONTROL
+        blob.upload_from_file(resp.raw, content_type="text/csv")
+        return True
+
+
+def refresh_http(bucket, base_url: str = RAW_BASE_URL) -> Dict[str, bool]:
+    """
+    Download the files in `SOURCE_FILES` in parallel with conditional
+    requests, uploading those that changed. Failures are printed and leave
+    the previous file in place. Returns {name: uploaded}.
+    """
+    etags = stored_etags(bucket)
+    with requests.Session() as session, ThreadPoolExecutor(
+        max_workers=len(SOURCE_FILES)
+    ) as pool:
+        futures = {
+            name: pool.submit(
+                fetch_and_upload,
+                bucket,
+                name,
+                raw_url(repo, path, base_url),
+                etags.get(name),
+                session,
+            )
+            for name, (repo, path) in SOURCE_FILES.items()
+        }
+        uploaded = {}
+        for name, future in futures.items():
+            try:
+                uploaded[name] = future.result()
+            except (requests.RequestException, GoogleAPIError, OSError) as e:
+                print(f"Failed to fetch {name}: {e}")
+                uploaded[name] = False
+        return uploaded
+
+
+def upload_cube(bucket, name: str, cube: pd.DataFrame, etag: Optional[str] = None):
+    """Upload a cube built by `linelist.build_cube` as CSV, like the source files"""
+    blob = bucket.blob(name)
+    blob.metadata = {"source_etag": etag}
+    blob.cache_control = DATA_CACHE_CONTROL
+    blob.upload_from_string(
+        cube.to_csv(date_format="%Y-%m-%d"), content_type="text/csv"
+    )
+
+
+def fetch_and_build_cube(
+    bucket, name: str, url: str, etag: Optional[str], session: requests.Session
+) -> bool:
+    """
+    Build cube `name` from the linelist at `url` and upload it, unless the
+    linelist still has ETag `etag`. The linelist is streamed through in
+    chunks, so it's never held in memory or written to disk.
+
+    Returns whether the cube was uploaded.
+    """
+    headers = {"Accept-Encoding": "identity"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+
+    with session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as resp:
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+        cube = linelist.build_cube(resp.raw)
+
+    upload_cube(bucket, name, cube, resp.headers.get("ETag"))
+    return True
+
+
+def refresh_cubes_http(bucket, base_url: str = RAW_BASE_URL) -> Dict[str, bool]:
+    """
+    Rebuild the cubes in `CUBE_FILES` whose linelists changed. Failures are
+    printed and leave the previous cube in place. Returns {name: uploaded}.
+    """
+    etags = stored_etags(bucket)
+    uploaded = {}
+    with requests.Session() as session:
+        for name, (repo, path) in CUBE_FILES.items():
+            try:
+                uploaded[name] = fetch_and_build_cube(
+                    bucket,
+                    name,
+                    raw_url(repo, path, base_url),
+                    etags.get(name),
+                    session,
+                )
+            except (requests.RequestException, KeyError, ValueError) as e:
+                print(f"Failed to build {name}: {e}")
+                uploaded[name] = False
+    return uploaded
+
+
+def github_pushed_at(api_url: str = GITHUB_API_URL) -> Dict[str, str]:
+    """Last push time of each source repo, leaving out failed lookups"""
+    pushed_at = {}
+    for repo in sorted({i for i, _ in SOURCE_FILES.values()}):
+        try:
+            resp = requests.get(f"{api_url}/repos/{repo}", timeout=HTTP_TIMEOUT)
+            resp.raise_for_status()
+            pushed_at[repo] = resp.json()["pushed_at"]
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"Failed to look up {repo} on GitHub: {e}")
+    return pushed_at
+
+
+def uploaded_hashes(bucket) -> Dict[str, str]:
+    """MD5 of each source file and cube in the bucket, as the bucket has it"""
+    return {
+        blob.name: blob.md5_hash
+        for blob in bucket.list_blobs()
+        if blob.name in SOURCE_FILES or blob.name in CUBE_FILES
+    }
+
+
+def published_pushed_at(bucket) -> Dict[str, str]:
+    """Push times in the manifest last published, empty if there isn't one"""
+    try:
+        return manifest.pushed_at(
+            json.loads(bucket.blob(MANIFEST_NAME).download_as_bytes())
+        )
+    except NotFound:
+        return {}
+
+
+def publish_manifest(bucket, pushed_at: Dict[str, str], file_hashes: Dict[str, str]):
+    """
+    Publish when each repo was last pushed to, and the hashes of the files
+    uploaded (see `uploaded_hashes`). Repos missing from `pushed_at` keep the
+    time from the previous manifest.
+    """
+    blob = bucket.blob(MANIFEST_NAME)
+    try:
+        manifest = json.loads(blob.download_as_bytes())
+    except NotFound:
+        manifest = {}
+
+    repos = manifest.get("repos", {})
+    repos.update({i: {"pushed_at": j} for i, j in pushed_at.items()})
+    manifest = {
+        "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "repos": repos,
+        # What the API versions the data it serves by
+        "files": file_hashes,
+    }
+
+    blob.cache_control = DATA_CACHE_CONTROL
+    blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+
+
+class UploadedSource(sources.DataSource):
+    """
+    The tables in `bucket`, as the API will read them once a manifest with
+    `pushed_at` and `file_hashes` is out
+
+    Raises
+    ------
+    ValueError when reading a file that no longer has its hash
+    """
+
+    def __init__(self, bucket, pushed_at: Dict[str, str], file_hashes: Dict[str, str]):
+        self.bucket = bucket
+        self.times = pushed_at
+        self.hashes = file_hashes
+
+    def read(self, name: str) -> pd.DataFrame:
+        file_name = sources.file_name(name)
+        body = self.bucket.blob(file_name).download_as_bytes()
+        if manifest.md5_hash(body) != self.hashes.get(file_name):
+            raise ValueError(f"{file_name} changed since it was listed")
+        return sources.read_csv(io.BytesIO(body))
+
+    def pushed_at(self) -> Dict[str, str]:
+        return self.times
+
+    def file_hashes(self) -> Dict[str, str]:
+        return self.hashes
+
+
+def publish_static(
+    bucket, pushed_at: Dict[str, str], file_hashes: Dict[str, str], now=None
+) -> int:
+    """
+    Work out the answers to the default `/` and `/detailed` queries from the
+    tables in `bucket` as the API would, and publish them gzipped for the
+    data version of `file_hashes`. Returns how many were published.
+    """
+    if now is None:
+        now = pd.Timestamp.now(tz="Asia/Kuala_Lumpur")
+    data = Dataset(UploadedSource(bucket, pushed_at, file_hashes))
+
+    def upload(item):
+        name, body = item
+        blob = bucket.blob(name)
+        # Served decompressed to clients that don't accept gzip
+        blob.content_encoding = "gzip"
+        blob.cache_control = STATIC_CACHE_CONTROL
+        blob.upload_from_string(
+            gzip.compress(body, mtime=0), content_type="application/json"
+        )
+
+    items = [
+        i
+        for days in static.DAYS_AHEAD
+        for i in static.build(data, now + pd.Timedelta(days=days))
+    ]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(upload, items))
+    return len(items)
+
+
+def refresh_git(bucket) -> Dict[str, str]:
+    """
+    Clone both repos and upload the files in `SOURCE_FILES` and the cubes in
+    `CUBE_FILES`. Files from a repo that failed to clone are left as they
+    are in the bucket. Returns the time of the latest commit in each repo
+    cloned.
     """
-    print("Starting execution")
     mohdirobj = tempfile.TemporaryDirectory()
     mohdir_fp = Path(mohdirobj.name)
     citfdirobj = tempfile.TemporaryDirectory()
     citfdir_fp = Path(citfdirobj.name)
 
-    client = storage.Client()
-    bucket = client.lookup_bucket("msia-covid-api-data-bucket")
-    print("Set up storage client and bucket")
+    pushed_at = {}
 
     # Retrieve MOH repo
     try:
         mohrepo = git.Repo.clone_from(MOHREPO_URL, mohdir_fp, depth=1)
-        latest_mohrepo_commit_datetime = mohrepo.commit().committed_datetime
-
+        pushed_at["MoH-Malaysia/covid19-public"] = (
+            mohrepo.commit().committed_datetime.isoformat()
+        )
+        print("Cloned MOH repo")
     except git.GitCommandError as e:
         print("Failed to clone MOH repo! Thrown exception:")
         print(e)
 
-    print("Cloned MOH repo")
-
     # Retrieve CITF repo
     try:
         citfrepo = git.Repo.clone_from(CITFREPO_URL, citfdir_fp, depth=1)
-        latest_citfrepo_commit_datetime = citfrepo.commit().committed_datetime
-
+        pushed_at["CITF-Malaysia/citf-public"] = (
+            citfrepo.commit().committed_datetime.isoformat()
+        )
+        print("Cloned CITF repo")
     except git.GitCommandError as e:
         print("Failed to clone CITF repo! Thrown exception:")
         print(e)
 
-    print("Cloned CITF repo")
+    # Only repos cloned have a commit time
+    repo_dirs = {
+        repo: fp
+        for repo, fp in [
+            ("MoH-Malaysia/covid19-public", mohdir_fp),
+            ("CITF-Malaysia/citf-public", citfdir_fp),
+        ]
+        if repo in pushed_at
+    }
+    for name, (repo, path) in SOURCE_FILES.items():
+        if repo not in repo_dirs:
+            continue
+        blob = bucket.blob(name)
+        blob.cache_control = DATA_CACHE_CONTROL
+        blob.upload_from_filename(repo_dirs[repo] / path)
+
+    for name, (repo, path) in CUBE_FILES.items():
+        if repo not in repo_dirs:
+            continue
+        try:
+            upload_cube(bucket, name, linelist.build_cube(repo_dirs[repo] / path))
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Failed to build {name}: {e}")
+
+    return pushed_at
 
-    epidemic_files = [
-        "cases_malaysia.csv", "cases_state.csv", "deaths_malaysia.csv", "deaths_state.csv", "icu.csv", "hospital.csv", "pkrc.csv", "tests_malaysia.csv", "tests_state.csv"
-    ]
-    vax_files = ["vax_malaysia.csv", "vax_state.csv"]
 
-    # Upload files in epidemic/
-    for i in epidemic_files:
-        blob = bucket.blob(i)
-        blob.upload_from_filename(mohdir_fp / "epidemic" / i)
+def hello_pubsub(event, context):
+    """Triggered from a message on a Cloud Pub/Sub topic.
+    Args:
+         event (dict): Event payload.
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
+    print("Starting execution")
+
+    client = storage.Client()
+    bucket = client.lookup_bucket(BUCKET_NAME)
+    print("Set up storage client and bucket")
+
+    if FETCH_MODE == "git":
+        pushed_at = refresh_git(bucket)
+        print("Done cloning and uploading files to bucket!")
+    else:
+        uploaded = refresh_http(bucket)
+        print(
+            f"Done fetching files, uploaded {sum(uploaded.values())} changed, "
+            f"skipped {len(uploaded) - sum(uploaded.values())} unchanged"
+        )
+        built = refresh_cubes_http(bucket)
+        print(f"Done building cubes, rebuilt {[i for i, j in built.items() if j]}")
+        pushed_at = github_pushed_at()
 
-    # Upload files in vax/
-    for i in vax_files:
-        blob = bucket.blob(i)
-        blob.upload_from_filename(citfdir_fp / "vaccination" / i)
+    # Named by the data version the manifest is about to announce, so they're
+    # in place before any API instance looks for them. The API works answers
+    # out itself if this fails
+    pushed_at = {**published_pushed_at(bucket), **pushed_at}
+    # Whatever ended up in the bucket, even if some fetches failed
+    file_hashes = uploaded_hashes(bucket)
+    try:
+        count = publish_static(bucket, pushed_at, file_hashes)
+        print(f"Published {count} static answers")
+    except Exception as e:
+        print(f"Failed to publish static answers: {e!r}")
 
-    print("Done cloning and uploading files to bucket!")
+    # Only after the data, so the manifest is never ahead of it
+    publish_manifest(bucket, pushed_at, file_hashes)
+    print(f"Published {MANIFEST_NAME}")
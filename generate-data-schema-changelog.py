@@ -1,73 +1,160 @@
 import argparse
 import difflib
+import io
+import json
+import sqlite3
 import tempfile
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
-import shelve
 
 import git
 import pandas as pd
 from tqdm import tqdm
 
+# Data files tracked in each repo, as git pathspecs
+SCHEMA_PATHS = {
+    "moh": [":(glob)epidemic/**/*.csv", ":(glob)mysejahtera/**/*.csv"],
+    "citf": [":(glob)vaccination/**/*.csv", ":(glob)registration/**/*.csv"],
+}
 
-def return_moh_schema(filepath: Path) -> Tuple[Dict, Dict]:
-    schema = {}
-    errors = {}
-    for i in filepath.glob("epidemic/**/*.csv"):
-        try:
-            df = pd.read_csv(i)
-            schema[i.name] = list(df.columns)
-        except pd.errors.ParserError as e:
-            # Cater for key-in errors breaking the schema
-            one_file_error = []
-            one_file_error.append("Data entry error, cannot read directly as CSV")
-            print(f"Error reading file {i} with following exception:")
-            print(e)
-
-            with open(i, "r") as f:
-                # Read the header
-                cols = f.readline().strip()
-            cols = [i.strip() for i in cols.split(",")]
-            print("Columns parsed directly from file instead:")
-            print(cols)
-
-            schema[i.name] = cols
-            errors[i.name] = one_file_error
-
-    for i in filepath.glob("mysejahtera/**/*.csv"):
-        try:
-            df = pd.read_csv(i)
-            schema[i.name] = list(df.columns)
-        except pd.errors.ParserError as e:
-            # Cater for key-in errors breaking the schema
-            one_file_error = []
-            one_file_error.append("Data entry error, cannot read directly as CSV")
-
-            print(f"Error reading file {i} with following exception:")
-            print(e)
-            with open(i, "r") as f:
-                # Read the header
-                cols = f.readline().strip()
-            cols = [i.strip() for i in cols.split(",")]
-            print("Columns parsed directly from file instead:")
-            print(cols)
-
-            schema[i.name] = cols
-            errors[i.name] = one_file_error
+# Key-in errors in MOH data are recorded in the changelog instead of failing
+CATCH_PARSER_ERRORS = {"moh": True, "citf": False}
 
-    return schema, errors
+# Shared by both repos, see `SchemaCache`
+CACHE_FNAME = ".schema-cache.sqlite"
+
+
+class SchemaCache:
+    """
+    Columns and errors of data files, keyed by (blob SHA, path).
+
+    Blob SHAs are hashes of file contents, so an entry holds for every commit
+    and repo with that file, and the cache can be shared by both repos. Writes
+    are held back and committed in batches. WAL mode lets parallel workers
+    read while another writes, and entries are never updated, so concurrent
+    inserts of the same file are ignored rather than conflicting.
+    """
+
+    def __init__(self, fname: str = CACHE_FNAME, batch_size: int = 500):
+        self.conn = sqlite3.connect(fname, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS schemas ("
+                "blob_sha TEXT NOT NULL, path TEXT NOT NULL, "
+                "columns TEXT NOT NULL, errors TEXT, "
+                "PRIMARY KEY (blob_sha, path)) WITHOUT ROWID"
+            )
+        self.batch_size = batch_size
+        self.pending: Dict[Tuple[str, str], Tuple] = {}
+
+    def get(
+        self, blob_sha: str, path: str
+    ) -> Optional[Tuple[List[str], Optional[List[str]]]]:
+        """Returns columns and errors of the file, None if not cached"""
+        if (blob_sha, path) in self.pending:
+            return self.pending[(blob_sha, path)]
+
+        row = self.conn.execute(
+            "SELECT columns, errors FROM schemas WHERE blob_sha = ? AND path = ?",
+            (blob_sha, path),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), None if row[1] is None else json.loads(row[1])
+
+    def put(
+        self, blob_sha: str, path: str, cols: List[str], errors: Optional[List[str]]
+    ):
+        self.pending[(blob_sha, path)] = (cols, errors)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write pending entries in one transaction"""
+        if len(self.pending) == 0:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO schemas VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        blob_sha,
+                        path,
+                        json.dumps(cols),
+                        None if errors is None else json.dumps(errors),
+                    )
+                    for (blob_sha, path), (cols, errors) in self.pending.items()
+                ],
+            )
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def read_columns(
+    path: str, data: bytes, catch_errors: bool
+) -> Tuple[List[str], Optional[List[str]]]:
+    """Returns columns of the CSV at `path` with contents `data`, and errors"""
+    try:
+        df = pd.read_csv(io.BytesIO(data))
+        return list(df.columns), None
+    except pd.errors.ParserError as e:
+        if not catch_errors:
+            raise e
+
+        # Cater for key-in errors breaking the schema
+        one_file_error = []
+        one_file_error.append("Data entry error, cannot read directly as CSV")
+        print(f"Error reading file {path} with following exception:")
+        print(e)
+
+        # Read the header
+        cols = data.decode().split("\n", 1)[0].strip()
+        cols = [i.strip() for i in cols.split(",")]
+        print("Columns parsed directly from file instead:")
+        print(cols)
+
+        return cols, one_file_error
+
+
+def changed_csvs(
+    prev_commit: Optional[git.Commit], commit: git.Commit, paths: List[str]
+) -> Tuple[List[str], List[str]]:
+    """
+    Returns paths of data files added or modified between two commits, and
+    paths of those removed. Everything in `commit` is added if there is no
+    `prev_commit`.
+    """
+    if prev_commit is None:
+        # Which side of a diff against the empty tree is which varies between
+        # GitPython versions, but every file in it is new either way
+        diffs = commit.diff(git.NULL_TREE, paths=paths)
+        return [i.b_path or i.a_path for i in diffs], []
+
+    diffs = prev_commit.diff(commit, paths=paths)
+    changed, removed = [], []
+    for i in diffs:
+        if i.change_type in ("D", "R"):
+            removed.append(i.a_path)
+        if i.change_type != "D":
+            changed.append(i.b_path)
 
+    return changed, removed
 
-def return_citf_schema(filepath: Path) -> Tuple[Dict, Dict]:
+
+def files2schema(files: Dict[str, Tuple]) -> Tuple[Dict, Dict]:
+    """Returns schema and errors keyed by filename from per-path state"""
     schema = {}
     errors = {}
-    for i in filepath.glob("vaccination/**/*.csv"):
-        df = pd.read_csv(i)
-        schema[i.name] = list(df.columns)
-
-    for i in filepath.glob("registration/**/*.csv"):
-        df = pd.read_csv(i)
-        schema[i.name] = list(df.columns)
+    for path, (cols, one_file_error) in sorted(files.items()):
+        name = Path(path).name
+        schema[name] = cols
+        if one_file_error is not None:
+            errors[name] = one_file_error
 
     return schema, errors
 
@@ -96,10 +183,16 @@ def strf_diff_output(diffoutput: List) -> List:
     return pretty_output
 
 
-def main(repo: str, outfile: Optional[str]):
+def main(
+    repo: str,
+    outfile: Optional[str],
+    repo_url: Optional[str] = None,
+    cache_fname: str = CACHE_FNAME,
+):
     """
     Output list of changes in data schema from MOH and CITF repo.
-    Iterates over all commits in history and finds change in data columns.
+    Iterates over commits in history that touch data files, and finds change
+    in data columns. Only the data files changed in each commit are read.
 
     Usage
     -----
@@ -110,6 +203,8 @@ def main(repo: str, outfile: Optional[str]):
     ----
     repo: `moh` or `citf` repo
     outputfp: output filepath, defaults to <repo>-schema-changes.txt
+    repo_url: clone from here instead of GitHub e.g. a local mirror
+    cache_fname: SQLite file caching columns of each version of a data file
 
     Return
     ------
@@ -120,32 +215,33 @@ def main(repo: str, outfile: Optional[str]):
         outfile = repo + "-schema-changes.txt"
 
     if repo == "moh":
-        repo_url = "https://github.com/MoH-Malaysia/covid19-public"
-        cache_fname = ".moh-schema-cache"
-        return_schema = return_moh_schema
+        default_repo_url = "https://github.com/MoH-Malaysia/covid19-public"
     elif repo == "citf":
-        repo_url = "https://github.com/CITF-Malaysia/citf-public"
-        cache_fname = ".citf-schema-cache"
-        return_schema = return_citf_schema
+        default_repo_url = "https://github.com/CITF-Malaysia/citf-public"
+    if repo_url is None:
+        repo_url = default_repo_url
+
+    paths = SCHEMA_PATHS[repo]
+    catch_errors = CATCH_PARSER_ERRORS[repo]
 
     # Setup data schema
     dirobj = tempfile.TemporaryDirectory()
     dirfp = Path(dirobj.name)
 
-    # Clone
-    repo_obj = git.Repo.clone_from(repo_url, dirfp)
+    # Clone, files are read from git objects so no need to check out
+    repo_obj = git.Repo.clone_from(repo_url, dirfp, no_checkout=True)
 
     # Retrieve between two commits
-    # commits = [i for i in repo_obj.iter_commits("b70cdc..HEAD")]
+    # commits = [i for i in repo_obj.iter_commits("b70cdc..HEAD", paths=paths)]
 
-    # Retrieve all commits
-    commits = [i for i in repo_obj.iter_commits(all=True)]
+    # Retrieve all commits touching data files, others can't change the schema
+    commits = [i for i in repo_obj.iter_commits(all=True, paths=paths)]
     commits.reverse()  # Because commits are listed last first
 
     # Open cache
-    cache = shelve.open(cache_fname)
+    cache = SchemaCache(cache_fname)
 
-    print(f"Num commits total: {len(commits)}")
+    print(f"Num commits touching data files: {len(commits)}")
     num_schema_changes = 0
 
     # Setup header block
@@ -161,32 +257,36 @@ def main(repo: str, outfile: Optional[str]):
 
     writelines = []
 
-    # Loop across the commits
-    for i in tqdm(range(len(commits) - 1)):
-        if commits[i].hexsha in cache.keys():
-            prev_repo_schema, prev_errors = cache.get(commits[i].hexsha)
-        else:
-            repo_obj.git.checkout(commits[i])
+    def commit_files(i: int, prev_files: Dict) -> Dict[str, Tuple]:
+        """Data file state at commits[i], given the state at commits[i - 1]"""
+        prev_commit = commits[i - 1] if i > 0 else None
+        changed, removed = changed_csvs(prev_commit, commits[i], paths)
+
+        # Carry forward files the commit didn't touch
+        files = {j: k for j, k in prev_files.items() if j not in removed}
+        for path in changed:
+            blob = commits[i].tree / path
+            files[path] = cache.get(blob.hexsha, path)
+            if files[path] is not None:
+                continue
 
             try:
-                prev_repo_schema, prev_errors = return_schema(dirfp)
-                cache[commits[i].hexsha] = prev_repo_schema, prev_errors
+                files[path] = read_columns(path, blob.data_stream.read(), catch_errors)
             except Exception as e:
                 print(f"Errored out on commit {commits[i]} with following exception:")
                 print(e)
                 raise e
+            cache.put(blob.hexsha, path, *files[path])
 
-        if commits[i + 1].hexsha in cache.keys():
-            new_repo_schema, new_errors = cache.get(commits[i + 1].hexsha)
-        else:
-            repo_obj.git.checkout(commits[i + 1])
-            try:
-                new_repo_schema, new_errors = return_schema(dirfp)
-                cache[commits[i + 1].hexsha] = new_repo_schema, new_errors
-            except Exception as e:
-                print(f"Errored out on commit {commits[i+1]} with following exception:")
-                print(e)
-                raise e
+        return files
+
+    files = commit_files(0, {}) if len(commits) > 0 else {}
+
+    # Loop across the commits
+    for i in tqdm(range(len(commits) - 1)):
+        prev_repo_schema, prev_errors = files2schema(files)
+        files = commit_files(i + 1, files)
+        new_repo_schema, new_errors = files2schema(files)
 
         diffs = strf_diff_output(
             list(
@@ -253,7 +353,8 @@ def main(repo: str, outfile: Optional[str]):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""Output list of changes in data schema from MOH and CITF repo.
-    Iterates over all commits in history and finds change in data columns."""
+    Iterates over commits in history that touch data files and finds change in
+    data columns."""
     )
     parser.add_argument(
         "repo",
@@ -265,6 +366,17 @@ if __name__ == "__main__":
         type=str,
         help="Output file name, defaults to <repo>-schema-changes.txt",
     )
+    parser.add_argument(
+        "--repo-url",
+        type=str,
+        help="Clone from here instead of GitHub, e.g. a local mirror",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=CACHE_FNAME,
+        help=f"SQLite cache file, can be shared by both repos, defaults to {CACHE_FNAME}",
+    )
     args = parser.parse_args()
 
-    main(args.repo, args.outfile)
+    main(args.repo, args.outfile, args.repo_url, args.cache)
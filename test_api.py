@@ -1,6 +1,48 @@
-from main import app, MsianState
+import asyncio
+import gzip
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
+# Serve the bundled fixture data, so tests run offline
+os.environ.setdefault(
+    "DATA_SOURCE", f"local:{Path(__file__).parent / 'fixtures' / 'data'}"
+)
+
+# The live API is served from gcp-app-engine/, its entrypoint isn't a valid
+# module name so import it the same way uvicorn does
+sys.path.insert(0, str(Path(__file__).parent / "gcp-app-engine"))
+gcp_main = importlib.import_module("gcp-main")
+app, MsianState = gcp_main.app, gcp_main.MsianState
+import numpy as np  # noqa: E402
+from covidapi import (  # noqa: E402
+    accesslog,
+    aggregation,
+    answers,
+    coalesce,
+    derived,
+    linelist,
+    metrics,
+    plaintext,
+    profiling,
+    responsecache,
+    sources,
+    static,
+    warmup,
+)
+from covidapi.dataset import Dataset  # noqa: E402
+from covidapi.summary import SummaryTable  # noqa: E402
+from covidapi.tables import Table  # noqa: E402
+
 client = TestClient(app)
 
 
@@ -22,10 +64,135 @@ def test_read_summary_allstates():
     assert response.status_code == 200
 
 
+def test_summary_matches_join():
+    """The summary view gives what joining the tables per request used to"""
+    loaded = Dataset(sources.LocalSource(Path(__file__).parent / "fixtures" / "data"))
+    frames = {
+        i: loaded.frame(i)
+        for i in [
+            "cases_malaysia",
+            "deaths_malaysia",
+            "vax_malaysia",
+            "tests_malaysia",
+            "cases_state",
+            "deaths_state",
+            "vax_state",
+        ]
+    }
+    # A day missing from one table, nationally and for one state
+    missing = pd.Timestamp("2021-08-03")
+    frames["vax_malaysia"] = frames["vax_malaysia"].drop(index=missing)
+    deaths_state = frames["deaths_state"]
+    frames["deaths_state"] = deaths_state[
+        (deaths_state.index != missing) | (deaths_state["state"] != "Johor")
+    ]
+    start_date, end_date = "2021-08-01", "2021-08-05"
+
+    def with_stale(name, state=None):
+        """`frames[name]` with an earlier, stale copy of one row"""
+        df = frames[name]
+        row = df.loc[[pd.Timestamp("2021-08-02")]]
+        if state is not None:
+            row = row[row["state"] == state]
+        return pd.concat([row.assign(**{row.columns[-1]: -1}), df])
+
+    def served(ans):
+        ans = ans.fillna(value=-9999).astype(int, errors="ignore")
+        ans.index = ans.index.strftime("%Y-%m-%d")
+        # Duplicate columns used to be sent once
+        return ans.loc[:, ~ans.columns.duplicated()]
+
+    def assert_same(ans, expected):
+        pd.testing.assert_frame_equal(
+            ans, expected, check_dtype=False, check_names=False, check_freq=False
+        )
+
+    national = pd.concat(
+        [
+            frames["cases_malaysia"].loc[start_date:end_date, "cases_new"],
+            frames["deaths_malaysia"].loc[start_date:end_date, "deaths_new"],
+            frames["vax_malaysia"].loc[
+                start_date:end_date, ["cumul_partial", "cumul_full", "cumul_full"]
+            ],
+            frames["tests_malaysia"].loc[start_date:end_date, "total_tests"],
+        ],
+        axis="columns",
+    )
+    # Duplicate days keep the last row, as loaded tables do
+    summary = SummaryTable.national(
+        with_stale("cases_malaysia"),
+        frames["deaths_malaysia"],
+        frames["vax_malaysia"],
+        with_stale("tests_malaysia"),
+    )
+    ans = summary.select(start_date, end_date)
+    assert_same(ans, served(national))
+    assert ans.loc["2021-08-03", "cumul_full"] == -9999
+
+    summary = SummaryTable.by_state(
+        with_stale("cases_state", "Johor"),
+        frames["deaths_state"],
+        with_stale("vax_state", "W.P. Kuala Lumpur"),
+    )
+    for state in ["Johor", "W.P. Kuala Lumpur"]:
+        expected = pd.concat(
+            [
+                i[i["state"] == state].loc[start_date:end_date, columns]
+                for i, columns in [
+                    (frames["cases_state"], ["cases_new"]),
+                    (frames["deaths_state"], ["deaths_new"]),
+                    (
+                        frames["vax_state"],
+                        ["cumul_partial", "cumul_full", "cumul_full"],
+                    ),
+                ]
+            ],
+            axis="columns",
+        )
+        assert_same(summary.select(start_date, end_date, state=state), served(expected))
+
+    # allstates was an inner join, leaving out days missing from any table
+    merged = (
+        frames["cases_state"]
+        .loc[start_date:end_date, ["cases_new", "state"]]
+        .reset_index()
+        .merge(
+            frames["deaths_state"]
+            .loc[start_date:end_date, ["deaths_new", "state"]]
+            .reset_index(),
+            on=["state", "date"],
+            how="inner",
+        )
+        .merge(
+            frames["vax_state"]
+            .loc[
+                start_date:end_date,
+                ["cumul_partial", "cumul_full", "cumul_full", "state"],
+            ]
+            .reset_index(),
+            on=["state", "date"],
+            how="inner",
+        )
+    )
+    allstates = dict(summary.select_allstates(start_date, end_date))
+    assert list(allstates) == sorted(merged["state"].unique())
+    for state, expected in merged.groupby("state"):
+        expected = served(expected.set_index("date").drop(columns="state"))
+        assert_same(allstates[state], expected)
+    assert "2021-08-03" not in allstates["Johor"].index
+    assert "2021-08-03" in allstates["W.P. Kuala Lumpur"].index
+
+
 def test_read_detailed_national():
     response = client.get("/detailed")
     assert response.status_code == 200
 
+    response = client.get("/detailed?start_date=2021-09-01&end_date=2021-09-01")
+    ans = response.json()
+    for i in ["checkin_malaysia", "trace_malaysia", "vaxreg_malaysia"]:
+        assert len(ans[i]) == 1
+    assert "state" not in ans["vaxreg_malaysia"]["2021-09-01"]
+
 
 def test_read_detailed_state():
     for i in MsianState:
@@ -37,3 +204,805 @@ def test_read_detailed_state():
 def test_read_detailed_allstates():
     response = client.get("/detailed?state=allstates")
     assert response.status_code == 200
+
+
+def test_read_metrics():
+    client.get("/?state=selangor")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert (
+        'covidapi_requests_total{endpoint="/",state="selangor",status="200"}'
+        in response.text
+    )
+    assert 'endpoint="/",stage="to_dict"' in response.text
+    assert 'covidapi_startup_phase_seconds{phase="total"}' in response.text
+    assert 'covidapi_startup_phase_seconds{phase="warmup"}' in response.text
+
+
+def test_access_log(monkeypatch):
+    monkeypatch.setattr(accesslog, "ACCESS_LOG_SAMPLE_RATE", 1.0)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    accesslog.logger.addHandler(handler)
+    try:
+        client.get("/?state=kl&profile=secret")
+    finally:
+        accesslog.logger.removeHandler(handler)
+
+    assert records[-1].msg["path"] == "/"
+    assert records[-1].msg["query"] == {"state": "kl"}
+    assert records[-1].msg["status"] == 200
+
+
+def test_profiling(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "secret")
+    monkeypatch.setattr(profiling, "ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", tmp_path)
+    monkeypatch.setattr(profiling, "PROFILER", "cprofile")
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    accesslog.event_logger.addHandler(handler)
+    profiled_app = FastAPI()
+    try:
+
+        @profiled_app.get("/sum")
+        @profiling.profiled
+        def return_sum():
+            return sum(range(1000))
+
+        profiling.install(profiled_app)
+    finally:
+        accesslog.event_logger.removeHandler(handler)
+    assert records[-1].msg["event"] == "profiling_enabled"
+    assert records[-1].msg["profile_dir"] == str(tmp_path)
+
+    profiled_client = TestClient(profiled_app)
+    assert "x-profile-id" not in profiled_client.get("/sum").headers
+    response = profiled_client.get("/sum", headers={"X-Profile": "secret"})
+    assert response.json() == 499500
+    profile_id = response.headers["x-profile-id"]
+
+    url = f"/debug/profiles/{profile_id}"
+    assert "return_sum" in profiled_client.get(url, params={"profile": "secret"}).text
+    assert profiled_client.get(url, params={"profile": "wrong"}).status_code == 403
+    assert profiled_client.get(url).status_code == 403
+    response = profiled_client.get(
+        "/debug/profiles/unknown", params={"profile": "secret"}
+    )
+    assert response.status_code == 404
+
+
+def test_profiling_disabled(monkeypatch):
+    monkeypatch.setattr(profiling, "ENABLED", False)
+
+    def handler():
+        pass
+
+    assert profiling.profiled(handler) is handler
+    unprofiled_app = FastAPI()
+    routes = list(unprofiled_app.routes)
+    profiling.install(unprofiled_app)
+    assert unprofiled_app.routes == routes
+    assert unprofiled_app.user_middleware == []
+
+
+def test_profile_store(tmp_path):
+    store = profiling.ProfileStore(tmp_path, keep_slowest=2)
+    ids = {}
+    for duration in [0.3, 0.1, 0.2, 0.4]:
+        profile = profiling._RequestProfile(requested=False)
+        profile.report = f"took {duration}"
+        store.save(profile, duration, {"path": "/"})
+        ids[duration] = profile.profile_id
+    # Requested profiles are always kept, and left out of the index
+    requested = profiling._RequestProfile(requested=True)
+    requested.report = "requested"
+    store.save(requested, 0.01, {"path": "/"})
+
+    index = json.loads((tmp_path / "slowest.json").read_text())
+    assert [(i["profile_id"], i["duration_s"]) for i in index] == [
+        (ids[0.4], 0.4),
+        (ids[0.3], 0.3),
+    ]
+    assert index[0]["path"] == "/"
+    assert store.load(ids[0.4]) == "took 0.4"
+    assert store.load(requested.profile_id) == "requested"
+    # Evicted as faster ones came in, files deleted
+    assert store.load(ids[0.1]) is None
+    assert store.load(ids[0.2]) is None
+    assert sorted(i.name for i in tmp_path.iterdir()) == sorted(
+        [
+            f"{ids[0.4]}.txt",
+            f"{ids[0.3]}.txt",
+            f"{requested.profile_id}.txt",
+            "slowest.json",
+        ]
+    )
+    assert store.load("../slowest") is None
+
+
+def test_warmup(monkeypatch):
+    # /ascii for the default dates was rendered while warming up
+    hits = metrics.CACHE_REQUESTS.get(cache="ascii", result="hit")
+    client.get("/ascii")
+    assert metrics.CACHE_REQUESTS.get(cache="ascii", result="hit") == hits + 1
+
+    # Warm-up requests aren't counted or logged as traffic
+    monkeypatch.setattr(accesslog, "ACCESS_LOG_SAMPLE_RATE", 1.0)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    accesslog.logger.addHandler(handler)
+    requests = metrics.REQUESTS.get(endpoint="/", state="national", status=200)
+    try:
+        assert warmup.run(app, ["/", "/ascii"]) > 0
+    finally:
+        accesslog.logger.removeHandler(handler)
+    assert records == []
+    assert metrics.REQUESTS.get(endpoint="/", state="national", status=200) == requests
+
+
+def test_coalesce():
+    calls = []
+
+    async def slow_app(scope, receive, send):
+        calls.append(scope["query_string"])
+        await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": scope["query_string"]})
+
+    async def get(app, query: bytes) -> bytes:
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/detailed",
+            "query_string": query,
+            "headers": [],
+        }
+        body = []
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message["body"])
+
+        await app(scope, None, send)
+        return body[0]
+
+    app = coalesce.Coalescer(slow_app, version=lambda: "v1")
+
+    async def main():
+        return await asyncio.gather(
+            *[get(app, b"state=kl&end_date=2021-09-01")] * 3,
+            get(app, b"end_date=2021-09-01&state=kl"),
+            get(app, b"state=johor"),
+        )
+
+    ans = asyncio.run(main())
+    # Params in any order are the same query, answered once
+    assert calls == [b"state=kl&end_date=2021-09-01", b"state=johor"]
+    assert ans[:4] == [b"state=kl&end_date=2021-09-01"] * 4
+    assert ans[4] == b"state=johor"
+
+    # Answered afresh once done
+    assert app.in_flight == {}
+    asyncio.run(get(app, b"state=johor"))
+    assert len(calls) == 3
+
+
+def expected_derived(state=None):
+    """Derived series worked out row by row from the fixture CSVs"""
+
+    def rows(name):
+        df = pd.read_csv(Path(__file__).parent / "fixtures" / "data" / f"{name}.csv")
+        if state is not None:
+            df = df[df["state"] == state]
+        return df.set_index("date")
+
+    tests = rows("tests_malaysia" if state is None else "tests_state")
+    cases = rows("cases_malaysia" if state is None else "cases_state")
+    vax = rows("vax_malaysia" if state is None else "vax_state")
+    dates = [i for i in cases.index if i <= "2021-07-20"]
+    ans = {}
+    for i, date in enumerate(dates):
+        window = dates[i - 6 : i + 1] if i >= 6 else None
+        total_tests = tests.loc[date, "rtk-ag"] + tests.loc[date, "pcr"]
+        ans[date] = {
+            "cases_new_7d": (
+                -9999
+                if window is None
+                else sum(cases.loc[j, "cases_new"] for j in window) / 7
+            ),
+            "positivity_rate": cases.loc[date, "cases_new"] / total_tests,
+            "positivity_rate_7d": (
+                -9999
+                if window is None
+                else sum(cases.loc[j, "cases_new"] for j in window)
+                / sum(tests.loc[j, "rtk-ag"] + tests.loc[j, "pcr"] for j in window)
+            ),
+            "daily_partial_delta": (
+                -9999
+                if i == 0
+                else vax.loc[date, "cumul_partial"]
+                - vax.loc[dates[i - 1], "cumul_partial"]
+            ),
+            "daily_full_delta": (
+                -9999
+                if i == 0
+                else vax.loc[date, "cumul_full"] - vax.loc[dates[i - 1], "cumul_full"]
+            ),
+        }
+    return ans
+
+
+def check_derived(ans, expected):
+    assert len(ans) > 7
+    for date, row in ans.items():
+        for column, value in expected[date].items():
+            # Rounded to 2 and 4 places when served
+            tolerance = 0.006 if column == "cases_new_7d" else 0.00006
+            assert row[column] == pytest.approx(value, abs=tolerance), (date, column)
+    # Missing until there's a full window, or a day before to compare with
+    first = ans[min(ans)]
+    assert first["cases_new_7d"] == first["daily_partial_delta"] == -9999
+    assert isinstance(first["daily_full_delta"], int)
+    assert ans["2021-07-06"]["cases_new_7d"] == -9999
+    assert ans["2021-07-07"]["cases_new_7d"] > 0
+    assert ans["2021-07-07"]["positivity_rate_7d"] > 0
+
+
+def test_read_derived_national():
+    response = client.get("/derived")
+    assert response.status_code == 200
+
+    params = {"start_date": "2021-07-01", "end_date": "2021-07-20"}
+    check_derived(client.get("/derived", params=params).json(), expected_derived())
+
+
+def test_read_derived_state():
+    for i in MsianState:
+        response = client.get(f"/derived?state={i.value}")
+        assert response.status_code == 200
+
+    params = {"state": "kl", "start_date": "2021-07-01", "end_date": "2021-07-20"}
+    check_derived(
+        client.get("/derived", params=params).json(),
+        expected_derived("W.P. Kuala Lumpur"),
+    )
+
+
+def test_derived_missing_date():
+    data = Dataset(sources.LocalSource(Path(__file__).parent / "fixtures" / "data"))
+    frames = {
+        name: data.frame(name)
+        for name in [
+            "cases_malaysia",
+            "cases_state",
+            "deaths_malaysia",
+            "deaths_state",
+            "tests_malaysia",
+            "tests_state",
+            "vax_malaysia",
+            "vax_state",
+        ]
+    }
+    gap = pd.Timestamp("2021-07-10")
+    for name in ["cases_malaysia", "deaths_malaysia", "tests_malaysia", "vax_malaysia"]:
+        frames[name] = frames[name].drop(gap)
+    national, _ = derived.compute_derived(**frames)
+
+    # Windows reaching the missing day and the change from it are unknown,
+    # rather than spanning 8 calendar days
+    assert gap not in national.index
+    window = pd.date_range("2021-07-11", "2021-07-16")
+    assert national.loc[window, "cases_new_7d"].isna().all()
+    assert national.loc[window, "positivity_rate_7d"].isna().all()
+    assert np.isnan(national.loc["2021-07-11", "daily_partial_delta"])
+    assert national.loc["2021-07-12", "daily_partial_delta"] > 0
+
+    cases = frames["cases_malaysia"]["cases_new"]
+    after = pd.date_range("2021-07-11", "2021-07-17")
+    assert national.loc["2021-07-17", "cases_new_7d"] == pytest.approx(
+        cases[after].sum() / 7, abs=0.006
+    )
+
+
+def test_read_linelist_deaths():
+    params = {"start_date": "2021-09-01", "end_date": "2021-09-30"}
+    national = client.get("/linelist/deaths", params=params).json()
+    assert set(national["2021-09-01"][0]) == {
+        "age_band",
+        "vax_status",
+        "deaths",
+        "bid",
+        "comorb",
+    }
+
+    # Breakdowns add up to the totals, for each state and all states
+    totals = client.get("/linelist/deaths", params={**params, "by": ""}).json()
+    assert {i: j[0]["deaths"] for i, j in totals.items()} == {
+        i: sum(k["deaths"] for k in j) for i, j in national.items()
+    }
+    allstates = client.get(
+        "/linelist/deaths", params={**params, "state": "allstates", "by": ""}
+    ).json()
+    kl = client.get(
+        "/linelist/deaths", params={**params, "state": "kl", "by": ""}
+    ).json()
+    assert allstates["kl"] == kl
+    assert sum(j[0]["deaths"] for i in allstates.values() for j in i.values()) == sum(
+        j[0]["deaths"] for j in totals.values()
+    )
+
+    weekly = client.get(
+        "/linelist/deaths", params={**params, "by": "", "granularity": "week"}
+    ).json()
+    assert sum(j[0]["deaths"] for j in weekly.values()) == sum(
+        j[0]["deaths"] for j in totals.values()
+    )
+    assert pd.Timestamp(min(weekly)).dayofweek == 0
+
+    response = client.get("/linelist/deaths", params={"by": "brand"})
+    assert response.status_code == 422
+
+
+def test_build_cube(tmp_path):
+    fp = tmp_path / "linelist_deaths.csv"
+    fp.write_text(
+        "date,date_positive,date_dose1,date_dose2,date_dose3,state,age,bid,comorb\n"
+        "2021-09-01,2021-08-20,,,,Johor,65,0,1\n"
+        "2021-09-01,2021-08-20,2021-07-01,2021-08-10,,Johor,65,1,1\n"
+        "2021-09-01,2021-08-20,2021-07-01,2021-07-20,,Johor,,0,0\n"
+        "2021-09-02,,2021-07-01,2021-07-20,2021-08-01,Johor,85,0,0\n"
+        "2021-09-01,2021-08-20,,,,Johor,66,1,0\n"
+    )
+
+    # Same cube however the linelist is chunked
+    cube = linelist.build_cube(fp)
+    pd.testing.assert_frame_equal(linelist.build_cube(fp, chunksize=2), cube)
+    assert cube.reset_index().to_dict(orient="records") == [
+        {
+            "date": pd.Timestamp("2021-09-01"),
+            "state": "Johor",
+            "age_band": "60-69",
+            "vax_status": "unvax",
+            "deaths": 2,
+            "bid": 1,
+            "comorb": 1,
+        },
+        # Second dose less than 14 days before testing positive
+        {
+            "date": pd.Timestamp("2021-09-01"),
+            "state": "Johor",
+            "age_band": "60-69",
+            "vax_status": "pvax",
+            "deaths": 1,
+            "bid": 1,
+            "comorb": 1,
+        },
+        {
+            "date": pd.Timestamp("2021-09-01"),
+            "state": "Johor",
+            "age_band": "unknown",
+            "vax_status": "fvax",
+            "deaths": 1,
+            "bid": 0,
+            "comorb": 0,
+        },
+        # Date of death stands in for a missing positive test date
+        {
+            "date": pd.Timestamp("2021-09-02"),
+            "state": "Johor",
+            "age_band": "80+",
+            "vax_status": "boost",
+            "deaths": 1,
+            "bid": 0,
+            "comorb": 0,
+        },
+    ]
+
+
+def test_read_granularity():
+    for i in ["week", "month"]:
+        response = client.get(
+            f"/?start_date=2021-08-01&end_date=2021-08-31&granularity={i}"
+        )
+        assert response.status_code == 200
+        response = client.get(
+            f"/detailed?start_date=2021-08-01&end_date=2021-08-31&granularity={i}&state=allstates"
+        )
+        assert response.status_code == 200
+
+    response = client.get("/?granularity=year")
+    assert response.status_code == 422
+
+    def rows(name, start_date, end_date, state=None):
+        df = pd.read_csv(Path(__file__).parent / "fixtures" / "data" / f"{name}.csv")
+        if state is not None:
+            df = df[df["state"] == state]
+        return df[(df["date"] >= start_date) & (df["date"] <= end_date)]
+
+    # Weeks start on Monday, flows are summed and cumulative counts take the
+    # last day's value
+    params = {"start_date": "2021-08-01", "end_date": "2021-08-15"}
+    ans = client.get("/", params={**params, "granularity": "week"}).json()
+    assert list(ans) == ["2021-07-26", "2021-08-02", "2021-08-09"]
+    cases = rows("cases_malaysia", "2021-08-02", "2021-08-08")
+    vax = rows("vax_malaysia", "2021-08-02", "2021-08-08")
+    assert ans["2021-08-02"]["cases_new"] == cases["cases_new"].sum()
+    assert ans["2021-08-02"]["cumul_full"] == vax["cumul_full"].iloc[-1]
+    # Partial periods only cover the requested dates
+    cases = rows("cases_malaysia", "2021-08-01", "2021-08-01")
+    assert ans["2021-07-26"]["cases_new"] == cases["cases_new"].sum()
+
+    # Occupancy takes the mean, rounded, and vaxreg_* registrations the last
+    params = {"state": "kl", "start_date": "2021-08-01", "end_date": "2021-08-31"}
+    tables = "cases_state,hospital_state,vaxreg_state"
+    ans = client.get(
+        "/detailed", params={**params, "tables": tables, "granularity": "month"}
+    ).json()
+    state = "W.P. Kuala Lumpur"
+    cases = rows("cases_state", "2021-08-01", "2021-08-31", state)
+    hospital = rows("hospital", "2021-08-01", "2021-08-31", state)
+    vaxreg = rows("vaxreg_state", "2021-08-01", "2021-08-31", state)
+    assert len(cases) == len(hospital) == len(vaxreg) == 31
+    assert list(ans["cases_state"]) == ["2021-08-01"]
+    assert ans["cases_state"]["2021-08-01"]["cases_new"] == cases["cases_new"].sum()
+    month = ans["hospital_state"]["2021-08-01"]
+    assert month["beds"] == round(hospital["beds"].sum() / 31)
+    assert month["hosp_covid"] == round(hospital["hosp_covid"].sum() / 31)
+    assert month["admitted_covid"] == hospital["admitted_covid"].sum()
+    month = ans["vaxreg_state"]["2021-08-01"]
+    assert month["total"] == vaxreg["total"].iloc[-1]
+    assert month["oku"] == vaxreg["oku"].iloc[-1]
+
+
+def test_aggregation_policy():
+    # Registration counts are cumulative in vaxreg_* tables only
+    assert aggregation.aggregation_for("total", "vaxreg_state") == "last"
+    assert aggregation.aggregation_for("total", "cases_malaysia") == "sum"
+    assert aggregation.aggregation_for("total") == "sum"
+    assert aggregation.aggregation_for("cumul_full", "vaxreg_state") == "last"
+    assert aggregation.aggregation_for("icu_covid", "icu_state") == "mean"
+
+
+def test_period_starts():
+    # The same periods as resample_frame, whatever order dates come in
+    dates = pd.date_range("2021-07-01", "2021-10-31").delete([3, 40])[::-1]
+    df = pd.DataFrame({"cases_new": 1}, index=dates)
+    for granularity in ["week", "month"]:
+        starts = aggregation.period_starts(dates, granularity)
+        resampled = aggregation.resample_frame(df.sort_index(), granularity)
+        assert sorted(set(starts)) == list(resampled.index)
+        assert df.groupby(starts)["cases_new"].sum().tolist() == list(
+            resampled["cases_new"]
+        )
+    assert aggregation.period_starts(dates, "day") is dates
+
+
+def test_read_detailed_projection():
+    response = client.get(
+        "/detailed?tables=cases_malaysia,vax_malaysia&columns=cases_new,cumul_full"
+    )
+    assert response.status_code == 200
+    ans = response.json()
+    assert set(ans.keys()) == {"cases_malaysia", "vax_malaysia"}
+    for row in ans["cases_malaysia"].values():
+        assert list(row.keys()) == ["cases_new"]
+    for row in ans["vax_malaysia"].values():
+        assert list(row.keys()) == ["cumul_full"]
+
+    response = client.get("/detailed?state=allstates&tables=cases_state")
+    assert response.status_code == 200
+    assert all(list(i.keys()) == ["cases_state"] for i in response.json().values())
+
+    assert client.get("/detailed?tables=cases_state").status_code == 422
+    assert client.get("/detailed?columns=not_a_column").status_code == 422
+
+
+def test_batch(monkeypatch):
+    def clear_cache():
+        monkeypatch.setattr(
+            gcp_main.response_cache, "local", responsecache.LRUBackend(10**7)
+        )
+
+    queries = [
+        {"state": "kl", "start_date": "2021-08-01", "end_date": "2021-08-10"},
+        {"state": "kl", "start_date": "2021-08-05", "end_date": "2021-08-20"},
+        {"endpoint": "/detailed", "state": "allstates"},
+        {"endpoint": "/derived", "start_date": "2021-08-01"},
+        {"state": "kl", "start_date": "2021-08-01", "end_date": "2021-08-10"},
+    ]
+    # Worked out afresh each way, not answered from the cache
+    clear_cache()
+    response = client.post("/batch", json=queries)
+    assert response.status_code == 200
+    ans = response.json()
+    assert len(ans) == len(queries)
+    for query, query_ans in zip(queries, ans):
+        params = {i: j for i, j in query.items() if i != "endpoint"}
+        clear_cache()
+        expected = client.get(query.get("endpoint", "/"), params=params).json()
+        assert query_ans == expected
+
+    response = client.post("/batch", json=[{"endpoint": "/ascii"}])
+    assert response.status_code == 422
+
+
+def test_response_cache(monkeypatch, tmp_path):
+    def new_instance():
+        # Sharing a backend with instances before it, with a cold LRU
+        cache = gcp_main.response_cache
+        monkeypatch.setattr(cache, "local", responsecache.LRUBackend(10**7))
+        monkeypatch.setattr(cache, "shared", responsecache.FileBackend(tmp_path))
+
+    def shared_hits():
+        return metrics.CACHE_REQUESTS.get(cache="response_shared", result="hit")
+
+    url = "/detailed?state=kl&start_date=2021-08-01&end_date=2021-08-10"
+    new_instance()
+    first = client.get(url)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    new_instance()
+    hits = shared_hits()
+    response = client.get(url)
+    assert shared_hits() == hits + 1
+    assert response.content == first.content
+    assert response.headers["content-type"] == "application/json"
+
+    # Batch answers come from the cache, or are cached for GETs
+    query = {"endpoint": "/detailed", "state": "kl", "start_date": "2021-08-01"}
+    ans = client.post(
+        "/batch",
+        json=[query, {**query, "end_date": "2021-08-10"}],
+    ).json()
+    assert ans[1] == first.json()
+    new_instance()
+    params = {i: j for i, j in query.items() if i != "endpoint"}
+    hits = shared_hits()
+    assert client.get("/detailed", params=params).json() == ans[0]
+    assert shared_hits() == hits + 1
+
+
+def test_static_responses(monkeypatch, tmp_path):
+    class PublishedSource(sources.LocalSource):
+        def object_url(self, name):
+            return f"https://example.com/{name}"
+
+    # Fixture data with answers published next to it, as the refresh does
+    for fp in (Path(__file__).parent / "fixtures" / "data").iterdir():
+        shutil.copy(fp, tmp_path / fp.name)
+    data = Dataset(PublishedSource(tmp_path))
+    for name, body in static.build(data, pd.Timestamp.now(tz="Asia/Kuala_Lumpur")):
+        fp = tmp_path / name
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_bytes(gzip.compress(body))
+
+    def new_instance(mode):
+        # Nothing kept in the response cache, every GET reaches the middleware
+        monkeypatch.setattr(gcp_main, "data", data)
+        monkeypatch.setattr(
+            gcp_main.response_cache, "local", responsecache.LRUBackend(0)
+        )
+        responses = gcp_main.static_responses
+        monkeypatch.setattr(responses, "mode", mode)
+        monkeypatch.setattr(responses, "missing", set())
+        monkeypatch.setattr(responses, "found", set())
+
+    def static_hits():
+        return metrics.CACHE_REQUESTS.get(cache="static", result="hit")
+
+    new_instance("off")
+    computed = {
+        i: client.get(i, params={"state": "kl"}).content for i in ["/", "/detailed"]
+    }
+
+    new_instance("proxy")
+    for path, body in computed.items():
+        hits = static_hits()
+        response = client.get(path, params={"state": "kl"})
+        assert static_hits() == hits + 1
+        assert response.content == body
+        assert response.headers["content-type"] == "application/json"
+
+    # Other queries are worked out
+    hits = static_hits()
+    assert (
+        client.get("/", params={"state": "kl", "start_date": "2021-08-01"}).status_code
+        == 200
+    )
+    assert client.get("/", params={"state": "nowhere"}).status_code == 422
+    assert static_hits() == hits
+
+    # Warm-up runs the handlers, even for answers published or cached
+    monkeypatch.setattr(
+        gcp_main.response_cache, "local", responsecache.LRUBackend(2**24)
+    )
+    client.get("/")
+    calls = []
+    summary = answers.summary
+    monkeypatch.setattr(
+        answers, "summary", lambda *args: calls.append(args) or summary(*args)
+    )
+    hits = static_hits()
+    assert warmup.run(app, ["/"]) > 0
+    assert len(calls) == len(warmup.QUERIES["/"])
+    assert static_hits() == hits
+    monkeypatch.setattr(answers, "summary", summary)
+
+    new_instance("redirect")
+    response = client.get("/detailed", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://example.com/" + static.object_name(
+        data.version, answers.default_dates(None, None)[1], "/detailed", None
+    )
+
+    # Not published for this version, looked for once
+    monkeypatch.setattr(data, "version", "unpublished")
+    misses = metrics.CACHE_REQUESTS.get(cache="static", result="miss")
+    for _ in range(2):
+        assert client.get("/detailed").status_code == 200
+    assert metrics.CACHE_REQUESTS.get(cache="static", result="miss") == misses + 1
+
+
+def test_static_code_version(monkeypatch):
+    end_date = pd.Timestamp("2021-09-01").date()
+    name = static.object_name("data", end_date, "/", "kl")
+    assert name == f"static/{static.CODE_VERSION}/data/2021-09-01/summary/kl.json"
+    assert answers.code_version() == static.CODE_VERSION
+
+    # Code encoding answers differently, e.g. the API deployed with changes
+    # the refresh function doesn't have yet, looks for other names
+    monkeypatch.setattr(answers, "encode", lambda content: json.dumps(content).encode())
+    changed = answers.code_version()
+    assert changed != static.CODE_VERSION
+    assert static.object_name("data", end_date, "/", "kl", changed) != name
+
+    # So does changing how answers are worked out
+    monkeypatch.undo()
+    monkeypatch.setattr(answers, "ANSWER_MODULES", ["answers"])
+    assert answers.code_version() != static.CODE_VERSION
+
+
+def test_read_ascii():
+    params = {"start_date": "2021-08-01", "end_date": "2021-08-05"}
+    for state in [None, "selangor", "allstates"]:
+        if state is not None:
+            params["state"] = state
+        response = client.get("/ascii", params=params)
+        assert response.status_code == 200
+        # Served from the cache the second time round
+        assert client.get("/ascii", params=params).text == response.text
+
+    params["state"] = "selangor"
+    response = client.get("/ascii", params=params)
+    root = client.get("/", params=params).json()
+    for date, row in root.items():
+        assert date in response.text
+        assert f"{row['cases_new']:,}" in response.text
+
+
+def test_render_table():
+    values = np.array([0, 7, -9999, 1000, 123456789, -1000000, 999])
+    assert list(plaintext.format_thousands(values)) == [f"{i:,}" for i in values]
+
+    # Same layout as DataFrame.to_string, with separator lines added
+    df = pd.DataFrame(
+        {"cases_new": [1, 22_000], "cumul_full": [3, 4_000_000]},
+        index=["2021-01-01", "2021-01-02"],
+    )
+    assert plaintext.render_table(df).split("\n") == [
+        "           New cases Sum fully vax'ed",
+        "-------------------------------------",
+        "2021-01-01         1                3",
+        "2021-01-02    22,000        4,000,000",
+    ]
+    assert plaintext.render_table(df, line_width=30).split("\n") == [
+        "           New cases  \\",
+        "-----------------------",
+        "2021-01-01         1   ",
+        "2021-01-02    22,000   ",
+        "",
+        "           Sum fully vax'ed  ",
+        "-----------------------",
+        "2021-01-01                3  ",
+        "2021-01-02        4,000,000  ",
+    ]
+
+
+def test_table_select_state():
+    # States interleaved and out of date order, as upstream may give them
+    df = pd.DataFrame(
+        {
+            "state": ["Johor", "Kedah", "Johor", "Kedah", "Johor"],
+            "cases_new": [3, 20, 1, 10, None],
+        },
+        index=pd.to_datetime(
+            ["2021-01-03", "2021-01-02", "2021-01-01", "2021-01-01", "2021-01-02"]
+        ),
+    )
+    table = Table(df)
+
+    ans = table.select("2021-01-02", "2021-01-03", state="Johor")
+    assert ans.to_dict(orient="index") == {
+        "2021-01-02": {"cases_new": -9999},
+        "2021-01-03": {"cases_new": 3},
+    }
+    assert list(table.select("2021-01-01", "2021-01-05", state="Kedah").index) == [
+        "2021-01-01",
+        "2021-01-02",
+    ]
+    assert len(table.select("2021-01-01", "2021-01-05", state="Perlis")) == 0
+    assert len(table.select("2021-01-05", "2021-01-01", state="Johor")) == 0
+    assert [i for i, _ in table.select_allstates("2021-01-03", "2021-01-05")] == [
+        "Johor"
+    ]
+
+
+def test_table_duplicates():
+    df = pd.DataFrame(
+        {
+            "state": ["Johor", "Kedah", "Johor", "Kedah", "Johor", "Kedah"],
+            "cases_new": [1, 10, 2, 20, 3, 30],
+        },
+        index=pd.to_datetime(
+            [
+                "2021-01-01",
+                "2021-01-01",
+                "2021-01-02",
+                "2021-01-01",
+                "2021-01-02",
+                "2021-01-02",
+            ]
+        ),
+    )
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    accesslog.event_logger.addHandler(handler)
+    try:
+        table = Table(df, name="cases_state")
+    finally:
+        accesslog.event_logger.removeHandler(handler)
+
+    # The later of each duplicate is kept
+    assert table.dropped == 2
+    assert records[-1].msg["event"] == "duplicate_dates"
+    assert records[-1].msg["table"] == "cases_state"
+    assert records[-1].msg["dropped"] == 2
+    assert table.offsets == {"Johor": (0, 2), "Kedah": (2, 4)}
+    assert table.rows("2021-01-02", "2021-01-02", "Johor") == slice(1, 2)
+    assert table.rows("2021-01-01", "2021-01-02", "Kedah") == slice(2, 4)
+    assert table.select("2021-01-01", "2021-01-02", state="Johor").to_dict() == {
+        "cases_new": {"2021-01-01": 1, "2021-01-02": 3}
+    }
+    assert table.select("2021-01-01", "2021-01-02", state="Kedah").to_dict() == {
+        "cases_new": {"2021-01-01": 20, "2021-01-02": 30}
+    }
+    assert Table(df.iloc[[0, 1]]).dropped == 0
+
+
+def test_table_compact():
+    # Blanks, a column too wide for int32 and one that fits int8
+    df = pd.DataFrame(
+        {
+            "state": ["Johor", "Kedah", "Johor", "Kedah"],
+            "checkins": [3e9, 2e9, None, 1e9],
+            "hide_small": [1, 2, 3, 4],
+        },
+        index=pd.to_datetime(["2021-01-04", "2021-01-04", "2021-01-05", "2021-01-05"]),
+    )
+    table, compact = Table(df), Table(df, compact=True)
+    assert compact.served["hide_small"].dtype == "int8"
+    assert compact.raw["checkins"].dtype == "Int64"
+
+    for granularity in ["day", "week"]:
+        ans = compact.select("2021-01-01", "2021-01-31", "Johor", granularity)
+        assert ans.to_dict(orient="index") == table.select(
+            "2021-01-01", "2021-01-31", "Johor", granularity
+        ).to_dict(orient="index")
+    row = compact.select("2021-01-04", "2021-01-04", "Johor").to_dict(orient="index")
+    assert all(type(i) is int for i in row["2021-01-04"].values())
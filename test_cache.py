@@ -0,0 +1,61 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "gcp-app-engine"))
+from covidapi import responsecache  # noqa: E402
+
+
+def test_lru_backend():
+    cache = responsecache.LRUBackend(maxbytes=10)
+    cache.set_many({"a": b"1234", "b": b"1234"})
+    assert cache.get_many(["a"]) == [b"1234"]
+
+    # Least recently used dropped past the size limit, too large never kept
+    cache.set_many({"c": b"1234", "d": b"12345678901"})
+    assert cache.get_many(["a", "b", "c", "d"]) == [b"1234", None, b"1234", None]
+    assert cache.nbytes == 8
+
+
+def test_file_backend(tmp_path):
+    cache = responsecache.FileBackend(tmp_path)
+    cache.set_many({"a": b"1", "b": b"2"})
+    assert cache.get_many(["b", "a", "c"]) == [b"2", b"1", None]
+    # Another instance sees the same entries
+    assert responsecache.FileBackend(tmp_path).get_many(["a"]) == [b"1"]
+
+    expired = responsecache.FileBackend(tmp_path, ttl=-1)
+    assert expired.get_many(["a"]) == [None]
+
+
+def test_tiered_cache(tmp_path):
+    shared = responsecache.FileBackend(tmp_path)
+    cache = responsecache.TieredCache(responsecache.LRUBackend(100), shared)
+    cache.set_many({"a": b"1"})
+
+    other = responsecache.TieredCache(responsecache.LRUBackend(100), shared)
+    assert other.get_many(["a", "b"]) == [b"1", None]
+    # Shared hits are kept locally
+    assert other.local.get_many(["a"]) == [b"1"]
+
+    class Down(responsecache.CacheBackend):
+        def get_many(self, keys):
+            raise ConnectionError("down")
+
+        def set_many(self, items):
+            raise ConnectionError("down")
+
+    # A shared backend that's down is only a miss
+    cache = responsecache.TieredCache(responsecache.LRUBackend(100), Down())
+    cache.set_many({"a": b"1"})
+    assert cache.get_many(["a", "b"]) == [b"1", None]
+
+
+def test_from_spec(tmp_path):
+    assert responsecache.from_spec("") is None
+    assert isinstance(
+        responsecache.from_spec(f"file:{tmp_path}"), responsecache.FileBackend
+    )
+    with pytest.raises(ValueError):
+        responsecache.from_spec("memcached://localhost")
@@ -0,0 +1,73 @@
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import git
+
+spec = importlib.util.spec_from_file_location(
+    "changelog", Path(__file__).parent / "generate-data-schema-changelog.py"
+)
+changelog = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(changelog)
+
+
+def commit(repo, files, message):
+    """Write `files` {path: contents or None to delete} and commit them"""
+    root = Path(repo.working_tree_dir)
+    for path, contents in files.items():
+        if contents is None:
+            repo.index.remove([path], working_tree=True)
+            continue
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(contents)
+        repo.index.add([path])
+    repo.index.commit(message)
+
+
+def test_changelog(tmp_path, monkeypatch):
+    repo = git.Repo.init(tmp_path / "src")
+    commit(
+        repo,
+        {"epidemic/cases_malaysia.csv": "date,cases\n1,2\n", "README.md": "x\n"},
+        "Initial data",
+    )
+    commit(repo, {"README.md": "y\n"}, "Docs only")
+    commit(
+        repo,
+        {
+            "epidemic/cases_malaysia.csv": "date,cases,cases_new\n1,2,3\n",
+            "mysejahtera/checkin.csv": "date,checkins\n1,2\n",
+        },
+        "Add column and file",
+    )
+    commit(repo, {"epidemic/linelist/deaths.csv": "date,a,b\n1,2\n3,4,5,6\n"}, "Typo")
+    commit(repo, {"epidemic/linelist/deaths.csv": "date,a,b\n1,2,3\n"}, "Fix typo")
+    commit(repo, {"epidemic/cases_malaysia.csv": None}, "Remove file")
+
+    # Commits not touching data files are skipped
+    commits = list(repo.iter_commits(paths=changelog.SCHEMA_PATHS["moh"]))
+    assert [i.message for i in commits][-1] == "Initial data"
+    assert "Docs only" not in [i.message for i in commits]
+
+    # Only the data files a commit changed are read
+    changed, removed = changelog.changed_csvs(
+        commits[-2], commits[-3], changelog.SCHEMA_PATHS["moh"]
+    )
+    assert changed == ["epidemic/linelist/deaths.csv"] and removed == []
+
+    monkeypatch.chdir(tmp_path)
+    outfile = tmp_path / "moh-schema-changes.txt"
+    for _ in range(2):  # Second run is read from the cache
+        changelog.main("moh", outfile, repo_url=str(tmp_path / "src"))
+        text = outfile.read_text()
+        assert "+cases_malaysia.csv: cases_new\n" in text
+        assert "+cases_malaysia.csv: cases\n" not in text
+        assert "+checkin.csv: date\n" in text
+        assert "error: deaths.csv: Data entry error" in text
+        assert "fixed: deaths.csv: Data entry error" in text
+        assert "-cases_malaysia.csv: cases_new\n" in text
+
+    # One entry per version of each data file
+    conn = sqlite3.connect(tmp_path / changelog.CACHE_FNAME)
+    assert conn.execute("SELECT COUNT(*) FROM schemas").fetchone() == (5,)
+    conn.close()
@@ -0,0 +1,297 @@
+import base64
+import gzip
+import hashlib
+import json
+import shutil
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import git
+import pandas as pd
+import pytest
+from google.api_core.exceptions import NotFound
+
+sys.path.insert(0, str(Path(__file__).parent / "gcp-cloud-function"))
+sys.path.insert(0, str(Path(__file__).parent / "gcp-app-engine"))
+import refresh  # noqa: E402
+from covidapi import manifest, sources, static  # noqa: E402
+from covidapi.dataset import Dataset  # noqa: E402
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures" / "data"
+
+
+class RawFileHandler(SimpleHTTPRequestHandler):
+    """Serves files like raw.githubusercontent.com, with ETags"""
+
+    def do_GET(self):
+        fp = Path(self.translate_path(self.path))
+        if not fp.is_file():
+            self.send_error(404)
+            return
+
+        body = fp.read_bytes()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Blob:
+    def __init__(self, bucket, name):
+        self.bucket, self.name, self.metadata = bucket, name, None
+
+    def _store(self, data):
+        self.data = data
+        # Base64 MD5, as the bucket reports it
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.bucket.blobs[self.name] = self
+
+    def upload_from_file(self, file_obj, content_type=None):
+        self._store(file_obj.read())
+
+    def upload_from_string(self, data, content_type=None):
+        self._store(data.encode() if isinstance(data, str) else data)
+
+    def upload_from_filename(self, filename, content_type=None):
+        self._store(Path(filename).read_bytes())
+
+    def download_as_bytes(self):
+        if self.name not in self.bucket.blobs:
+            raise NotFound(self.name)
+        return self.bucket.blobs[self.name].data
+
+
+class Bucket:
+    """In-memory stand-in for a storage bucket"""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def blob(self, name):
+        return Blob(self, name)
+
+    def list_blobs(self):
+        return list(self.blobs.values())
+
+
+@pytest.fixture
+def raw_server(tmp_path):
+    for repo, path in refresh.SOURCE_FILES.values():
+        fp = tmp_path / repo / "main" / path
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_text(f"date,value\n2021-08-01,{len(path)}\n")
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(RawFileHandler, directory=str(tmp_path))
+    )
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, tmp_path
+    server.shutdown()
+
+
+def test_refresh_http(raw_server):
+    server, root = raw_server
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    bucket = Bucket()
+
+    uploaded = refresh.refresh_http(bucket, base_url)
+    assert all(uploaded.values())
+    assert set(bucket.blobs) == set(refresh.SOURCE_FILES)
+    fp = root / "CITF-Malaysia/citf-public/main/vaccination/vax_state.csv"
+    assert bucket.blobs["vax_state.csv"].data == fp.read_bytes()
+    # Never served older than the manifest listing it
+    assert bucket.blobs["vax_state.csv"].cache_control == "no-cache"
+
+    # Nothing changed upstream, nothing is uploaded
+    server.requests.clear()
+    uploaded = refresh.refresh_http(bucket, base_url)
+    assert not any(uploaded.values())
+    assert all(etag is not None for _, etag in server.requests)
+
+    # Only the changed file is uploaded
+    fp = root / "MoH-Malaysia/covid19-public/main/epidemic/cases_state.csv"
+    fp.write_text("date,value\n2021-08-02,1\n")
+    uploaded = refresh.refresh_http(bucket, base_url)
+    assert [i for i, j in uploaded.items() if j] == ["cases_state.csv"]
+    assert bucket.blobs["cases_state.csv"].data == fp.read_bytes()
+
+    # A file that fails to download is left as it was, the rest still go up
+    (root / "MoH-Malaysia/covid19-public/main/epidemic/icu.csv").unlink()
+    fp.write_text("date,value\n2021-08-03,1\n")
+    uploaded = refresh.refresh_http(bucket, base_url)
+    assert [i for i, j in uploaded.items() if j] == ["cases_state.csv"]
+    assert bucket.blobs["cases_state.csv"].data == fp.read_bytes()
+    assert "icu.csv" in bucket.blobs
+
+
+def test_refresh_git(raw_server, monkeypatch):
+    _, root = raw_server
+    bucket = Bucket()
+    bucket.blob("vax_state.csv").upload_from_string("date,value\n")
+
+    class Repo:
+        def commit(self):
+            return SimpleNamespace(
+                committed_datetime=pd.Timestamp("2021-08-13T09:27:11Z")
+            )
+
+    def clone_from(url, to_path, depth=None):
+        if url == refresh.CITFREPO_URL:
+            raise git.GitCommandError("clone", 128)
+        shutil.copytree(root / manifest.MOH_REPO / "main", to_path, dirs_exist_ok=True)
+        return Repo()
+
+    monkeypatch.setattr(refresh.git.Repo, "clone_from", clone_from)
+    pushed_at = refresh.refresh_git(bucket)
+
+    # The repo that failed to clone keeps its files as they were
+    assert list(pushed_at) == [manifest.MOH_REPO]
+    moh_files = {
+        i for i, (j, _) in refresh.SOURCE_FILES.items() if j == manifest.MOH_REPO
+    }
+    assert set(bucket.blobs) == moh_files | {"vax_state.csv"}
+    assert bucket.blobs["vax_state.csv"].data == b"date,value\n"
+
+
+def test_refresh_cubes_http(raw_server):
+    server, root = raw_server
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    bucket = Bucket()
+
+    fixture_dir = Path(__file__).parent / "fixtures"
+    for name, (repo, path) in refresh.CUBE_FILES.items():
+        fp = root / repo / "main" / path
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_bytes((fixture_dir / "linelist" / Path(path).name).read_bytes())
+
+    # Same as the fixture dataset, which has the cubes as the API reads them
+    assert refresh.refresh_cubes_http(bucket, base_url) == {"deaths_cube.csv": True}
+    for name in refresh.CUBE_FILES:
+        assert bucket.blobs[name].data == (fixture_dir / "data" / name).read_bytes()
+
+    # Unchanged linelists aren't read again
+    assert refresh.refresh_cubes_http(bucket, base_url) == {"deaths_cube.csv": False}
+
+    # Nor do missing ones fail the refresh
+    fp.unlink()
+    bucket.blobs.clear()
+    assert refresh.refresh_cubes_http(bucket, base_url) == {"deaths_cube.csv": False}
+
+
+def test_manifest(raw_server):
+    server, root = raw_server
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    bucket = Bucket()
+
+    # Stand in for the GitHub API, which only knows about one of the repos
+    fp = root / "repos" / manifest.MOH_REPO
+    fp.parent.mkdir(parents=True)
+    fp.write_text(json.dumps({"pushed_at": "2021-08-13T09:27:11Z"}))
+
+    pushed_at = refresh.github_pushed_at(base_url)
+    assert pushed_at == {manifest.MOH_REPO: "2021-08-13T09:27:11Z"}
+    refresh.publish_manifest(bucket, pushed_at, {})
+    refresh.publish_manifest(
+        bucket, {manifest.CITF_REPO: "2021-08-13T10:00:00+00:00"}, {}
+    )
+
+    # Read it back the way the API does
+    (root / refresh.MANIFEST_NAME).write_bytes(bucket.blobs["manifest.json"].data)
+    source = sources.BucketSource(f"{base_url}/")
+    commit_times = manifest.CommitTimes()
+    assert commit_times.update(source.pushed_at())
+    assert commit_times.get(manifest.MOH_REPO) == pd.Timestamp(
+        "2021-08-13 17:27:11+08:00"
+    )
+    assert commit_times.age(manifest.CITF_REPO) > 0
+
+    # Missing manifest doesn't fail, leaves times unknown
+    assert manifest.fetch_manifest(f"{base_url}/missing.json") == {}
+    commit_times = manifest.CommitTimes()
+    assert not commit_times.update(
+        sources.BucketSource(f"{base_url}/none/").pushed_at()
+    )
+    assert commit_times.age(manifest.MOH_REPO) is None
+
+
+def test_source_files():
+    # The API reads from the bucket what the refresh function uploads
+    assert refresh.SOURCE_FILES == {
+        sources.file_name(i): j for i, j in sources.FILES.items()
+    }
+
+
+def fixture_bucket():
+    """Bucket with the fixture data uploaded, and its file hashes"""
+    bucket = Bucket()
+    for fp in FIXTURE_DIR.glob("*.csv"):
+        bucket.blob(fp.name).upload_from_string(fp.read_bytes())
+    return bucket, refresh.uploaded_hashes(bucket)
+
+
+def test_data_version():
+    bucket, file_hashes = fixture_bucket()
+    pushed_at = sources.LocalSource(FIXTURE_DIR).pushed_at()
+    refresh.publish_manifest(bucket, pushed_at, file_hashes)
+    published = json.loads(bucket.blobs[refresh.MANIFEST_NAME].data)
+    assert published["files"] == file_hashes
+    assert set(file_hashes) == set(refresh.SOURCE_FILES) | set(refresh.CUBE_FILES)
+
+    # The API versions data as the refresh function does
+    version = Dataset(refresh.UploadedSource(bucket, pushed_at, file_hashes)).version
+    assert version == Dataset(sources.LocalSource(FIXTURE_DIR)).version
+
+    # A file that changed changes the version, even with push times as they
+    # were, e.g. when looking them up failed
+    df = pd.read_csv(FIXTURE_DIR / "cases_state.csv")
+    df.loc[0, "cases_new"] += 1
+    bucket.blob("cases_state.csv").upload_from_string(df.to_csv(index=False))
+    with pytest.raises(ValueError):
+        refresh.UploadedSource(bucket, pushed_at, file_hashes).read("cases_state")
+    changed = refresh.uploaded_hashes(bucket)
+    assert (
+        Dataset(refresh.UploadedSource(bucket, pushed_at, changed)).version != version
+    )
+
+
+def test_publish_static():
+    bucket, file_hashes = fixture_bucket()
+    pushed_at = sources.LocalSource(FIXTURE_DIR).pushed_at()
+
+    now = pd.Timestamp("2021-09-01 12:00", tz="Asia/Kuala_Lumpur")
+    count = refresh.publish_static(bucket, pushed_at, file_hashes, now)
+
+    # What the API would have answered, for today and tomorrow
+    data = Dataset(sources.LocalSource(FIXTURE_DIR))
+    expected = {
+        name: body
+        for days in static.DAYS_AHEAD
+        for name, body in static.build(data, now + pd.Timedelta(days=days))
+    }
+    published = {
+        i: gzip.decompress(j.data) for i, j in bucket.blobs.items() if "/" in i
+    }
+    assert count == len(expected) == 2 * 2 * 18
+    assert published == expected
+    assert (
+        f"static/{static.CODE_VERSION}/{data.version}/2021-09-02/detailed/kl.json"
+        in published
+    )
+    assert published[static.object_name(data.version, now.date(), "/", "kl")] != b"{}"
@@ -0,0 +1,181 @@
+import json
+import shutil
+import sys
+import threading
+from pathlib import Path
+
+import git
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "gcp-app-engine"))
+from covidapi import manifest, sources  # noqa: E402
+from covidapi.dataset import Dataset  # noqa: E402
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures" / "data"
+LINELIST_DIR = Path(__file__).parent / "fixtures" / "linelist"
+
+
+def assert_same_data(a: Dataset, b: Dataset):
+    pd.testing.assert_frame_equal(a.summary_state.filled, b.summary_state.filled)
+    for name, table in a.detailed_malaysia.items():
+        pd.testing.assert_frame_equal(table.served, b.detailed_malaysia[name].served)
+    pd.testing.assert_frame_equal(a.derived_state.served, b.derived_state.served)
+    pd.testing.assert_frame_equal(a.deaths_cube.df, b.deaths_cube.df)
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    """Stand-ins for the MOH and CITF repos, made from the fixture data"""
+    repo_urls = {}
+    for repo in [manifest.MOH_REPO, manifest.CITF_REPO]:
+        fp = tmp_path / "upstream" / repo
+        repo_obj = git.Repo.init(fp)
+        for name, (file_repo, path) in sources.FILES.items():
+            if file_repo == repo:
+                (fp / path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(FIXTURE_DIR / sources.file_name(name), fp / path)
+                repo_obj.index.add([path])
+        for file_repo, path in sources.CUBES.values():
+            if file_repo == repo:
+                (fp / path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(LINELIST_DIR / Path(path).name, fp / path)
+                repo_obj.index.add([path])
+        repo_obj.index.commit("Add data")
+        repo_urls[repo] = f"file://{fp}"
+    return repo_urls
+
+
+def test_git_source(tmp_path, upstream):
+    expected = Dataset(sources.LocalSource(FIXTURE_DIR))
+
+    source = sources.GitSource(tmp_path / "cache", repo_urls=upstream)
+    loaded = Dataset(source)
+    assert_same_data(loaded, expected)
+    assert set(source.pushed_at()) == {manifest.MOH_REPO, manifest.CITF_REPO}
+
+    # Clones already there are brought up to date
+    fp = Path(upstream[manifest.MOH_REPO][len("file://") :])
+    df = pd.read_csv(fp / "epidemic/cases_state.csv")
+    df.loc[0, "cases_new"] = 123456
+    df.to_csv(fp / "epidemic/cases_state.csv", index=False)
+    repo_obj = git.Repo(fp)
+    repo_obj.index.add(["epidemic/cases_state.csv"])
+    repo_obj.index.commit("Update data")
+
+    # Unless asked not to, to start serving right away
+    stale = sources.GitSource(tmp_path / "cache", repo_urls=upstream, update=False)
+    assert not stale.updated
+    assert stale.read("cases_state")["cases_new"].iloc[0] != 123456
+
+    updated = sources.GitSource(tmp_path / "cache", repo_urls=upstream)
+    assert updated.updated
+    assert updated.read("cases_state")["cases_new"].iloc[0] == 123456
+    # Versioned by the commits read from
+    assert Dataset(updated).version != loaded.version
+    assert set(updated.file_hashes()) == {manifest.MOH_REPO, manifest.CITF_REPO}
+
+    # A failed fetch leaves the clone as it was
+    clone = git.Repo(tmp_path / "cache" / manifest.MOH_REPO.split("/")[1])
+    clone.remote().set_url(f"file://{tmp_path / 'gone'}")
+    offline = sources.GitSource(tmp_path / "cache", repo_urls=upstream)
+    assert not offline.updated
+    assert offline.file_hashes() == updated.file_hashes()
+
+
+def test_bucket_source(tmp_path):
+    # Read over file:// URLs, the same way as from the bucket over HTTP
+    source = sources.from_spec(f"bucket:{FIXTURE_DIR.as_uri()}/")
+    assert_same_data(Dataset(source), Dataset(sources.LocalSource(FIXTURE_DIR)))
+    assert set(source.pushed_at()) == {manifest.MOH_REPO, manifest.CITF_REPO}
+
+    assert sources.BucketSource(f"{tmp_path.as_uri()}/").pushed_at() == {}
+
+
+def test_bucket_source_hashes(tmp_path):
+    # Files that don't match the manifest would be served under its version
+    shutil.copytree(FIXTURE_DIR, tmp_path, dirs_exist_ok=True)
+    (tmp_path / "cases_state.csv").write_text("date,state,cases_new\n")
+    source = sources.BucketSource(f"{tmp_path.as_uri()}/")
+    with pytest.raises(ValueError, match="cases_state.csv"):
+        source.read("cases_state")
+    assert len(source.read("cases_malaysia")) > 0
+
+
+def test_data_version(tmp_path):
+    # The same files give the same version, whatever they're read from
+    expected = Dataset(sources.LocalSource(FIXTURE_DIR)).version
+    bucket = sources.BucketSource(f"{FIXTURE_DIR.as_uri()}/")
+    assert Dataset(bucket).version == expected
+    assert len(bucket.file_hashes()) == len(sources.FILES) + len(sources.CUBES)
+
+    # Without hashes, e.g. an older manifest, every load is a version apart
+    # even with the same push times
+    published = json.loads((FIXTURE_DIR / manifest.MANIFEST_NAME).read_text())
+    del published["files"]
+    (tmp_path / manifest.MANIFEST_NAME).write_text(json.dumps(published))
+    source = sources.LocalSource(tmp_path)
+    assert source.pushed_at() == bucket.pushed_at()
+    assert Dataset(source).version != Dataset(source).version
+
+
+def test_snapshot_source(tmp_path):
+    expected = Dataset(sources.from_spec(f"local:{FIXTURE_DIR}"))
+    sources.write_snapshot(
+        tmp_path / "snapshot.pkl",
+        expected.tables,
+        expected.pushed_at,
+        expected.file_hashes,
+    )
+
+    loaded = Dataset(sources.from_spec(f"snapshot:{tmp_path / 'snapshot.pkl'}"))
+    assert_same_data(loaded, expected)
+    assert loaded.pushed_at == expected.pushed_at
+    assert loaded.version == expected.version
+
+    with pytest.raises(ValueError):
+        sources.from_spec("local")
+
+
+class CountingSource(sources.LocalSource):
+    """Fixture data, counting reads of each table"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.reads = {}
+
+    def read(self, name: str) -> pd.DataFrame:
+        self.reads[name] = self.reads.get(name, 0) + 1
+        return super().read(name)
+
+
+def test_dataset_lazy_loading():
+    source = CountingSource(FIXTURE_DIR)
+    loaded = Dataset(source)
+    assert source.reads == {}
+
+    # The national summary only waits on its own tables, read once between
+    # requests arriving together
+    threads = [
+        threading.Thread(target=lambda: loaded.summary_malaysia) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert source.reads == {
+        "cases_malaysia": 1,
+        "deaths_malaysia": 1,
+        "vax_malaysia": 1,
+        "tests_malaysia": 1,
+    }
+
+    # Listing /detailed tables doesn't read them
+    assert "icu_state" in list(loaded.detailed_state)
+    assert len(source.reads) == 4
+    loaded.detailed_state["icu_state"]
+    assert source.reads["icu_state"] == 1 and "hospital_state" not in source.reads
+
+    loaded.prefetch()
+    assert source.reads == {i: 1 for i in [*sources.FILES, *sources.CUBES]}
+    assert_same_data(loaded, Dataset(sources.LocalSource(FIXTURE_DIR)))
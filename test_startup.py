@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+
+APP_DIR = Path(__file__).parent / "gcp-app-engine"
+FIXTURE_DIR = Path(__file__).parent / "fixtures" / "data"
+
+# Seconds from starting Python to listening on a port, with data loading and
+# warm-up left out. Cold starts on App Engine F1 instances are user-visible,
+# raise this only knowing what made imports slower, see benchmarks/imports.py
+IMPORT_BUDGET = float(os.environ.get("IMPORT_BUDGET", "3.0"))
+
+# Imports the app as uvicorn does, then binds a port
+CHILD = """
+import importlib, json, socket, sys
+app = importlib.import_module("gcp-main").app
+sock = socket.socket()
+sock.bind(("127.0.0.1", 0))
+sock.listen()
+print(json.dumps(sorted(sys.modules)), flush=True)
+"""
+
+
+def test_import_budget():
+    env = dict(
+        os.environ,
+        DATA_SOURCE=f"local:{FIXTURE_DIR}",
+        DATA_PREFETCH="0",
+        WARMUP_ENDPOINTS="",
+        ACCESS_LOG_SAMPLE_RATE="0",
+    )
+
+    # Fastest of a few runs, the first also pays for a cold disk cache
+    elapsed = float("inf")
+    for _ in range(3):
+        start = timer()
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=APP_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        elapsed = min(elapsed, timer() - start)
+    assert elapsed < IMPORT_BUDGET
+
+    # Only imported once a request or data source needs them
+    modules = json.loads(result.stdout.splitlines()[-1])
+    for name in ["git", "requests", "cProfile"]:
+        assert name not in modules
+
+
+def test_boot_without_snapshot(tmp_path):
+    # An unreadable snapshot, or a cache dir not made yet, falls back to
+    # opening the data source
+    (tmp_path / "snapshot.pkl").write_bytes(b"not a pickle")
+    for cache_dir in [tmp_path, tmp_path / "missing"]:
+        env = dict(
+            os.environ,
+            DATA_SOURCE=f"local:{FIXTURE_DIR}",
+            DATA_CACHE_DIR=str(cache_dir),
+            DATA_PREFETCH="0",
+            WARMUP_ENDPOINTS="",
+            ACCESS_LOG_SAMPLE_RATE="0",
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=APP_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert f"Opened data source local:{FIXTURE_DIR}" in result.stdout